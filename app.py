@@ -1,33 +1,91 @@
-from flask import Flask, request, jsonify, send_from_directory, Response
+import time
+_STARTUP_BEGIN = time.perf_counter()
+
+from flask import Flask, request, jsonify, send_from_directory, Response, g
 import os
-import asyncio
-import pandas as pd
+import sys
 from pathlib import Path
 import json
+import math
+import uuid
 import traceback
-import time
 from flask_cors import CORS  # 导入CORS扩展
 
-# 导入弹幕相关模块
-from danmaku_loader import TencentVideoScraper, AiqiyiVideoScraper, BilibiliVideoScraper, MgtvVideoScraper
-from get_youkudanmuku import search_videos, get_video_episodes, download_danmu
+# 导入弹幕相关模块（各平台爬虫在首次请求时才导入并初始化）
+from danmaku_loader import PROFILE_STARTUP
+from response_utils import build_cached_json_response, file_version
+from async_runtime import run_coro
+from circuit_breaker import is_transient
+import danmaku_service
+import download_jobs
+import danmu_refresh
+import danmu_search_index
+import danmu_metrics
+import danmu_tracing
+from danmu_negative import REASON_CODES, EpisodeUnavailableError
+from danmu_store import DANMU_STORE
+from danmu_merge import merge_danmaku
+from danmu_records import read_danmu_csv
+from danmu_density import DENSITY_BUCKET_SECONDS, limit_density
 
 app = Flask(__name__, static_folder=".")
 CORS(app)  # 启用CORS支持，允许所有域的请求
 
-# 初始化弹幕爬取器
-tencent_scraper = TencentVideoScraper(base_dir="danmu_data")
-aiqiyi_scraper = AiqiyiVideoScraper(base_dir="danmu_data")
-bilibili_scraper = BilibiliVideoScraper(base_dir="danmu_data")
-mgtv_scraper = MgtvVideoScraper(base_dir="danmu_data")
-
 # 确保弹幕数据目录存在
 os.makedirs("danmu_data", exist_ok=True)
 os.makedirs("danmu_data/youku", exist_ok=True)
 os.makedirs("danmu_data/dplayer", exist_ok=True)  # DPlayer弹幕数据目录
 
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    # 按采样率（或 X-Danmu-Trace 请求头）决定是否追踪本次请求，根 span 在 teardown 时结束并导出
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    root = danmu_tracing.start_trace(
+        f"{request.method} {endpoint}", danmu_tracing.should_sample(request.headers.get(danmu_tracing.TRACE_HEADER)),
+        source=request.args.get('source', ''), path=request.path
+    )
+    g.trace_span, g.trace_token = root, danmu_tracing.activate(root)
+
+@app.after_request
+def _record_request_metrics(response):
+    """按路由规则与弹幕源记录请求耗时（异步服务模式下桥接到 Flask 的路由也在这里记录）"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        source = danmu_metrics.source_label(request.args.get('source', ''))
+        danmu_metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, source)
+        danmu_metrics.HTTP_REQUESTS.inc(endpoint, source, str(response.status_code))
+    root = g.get('trace_span')
+    if root is not None and root.sampled:
+        root.set_attributes(status=response.status_code, bytes=response.calculate_content_length() or 0)
+        response.headers['X-Danmu-Trace-Id'] = root.trace_id
+    return response
+
+@app.teardown_request
+def _finish_request_trace(exc):
+    root, token = g.pop('trace_span', None), g.pop('trace_token', None)
+    if root is not None:
+        danmu_tracing.finish(root, exc)
+        danmu_tracing.deactivate(token)
+
 # DPlayer弹幕数据存储
 DPLAYER_DANMAKU_DATA = {}  # 内存中存储弹幕数据，格式: {id: [弹幕列表]}
+DPLAYER_DANMAKU_VERSION = {}  # 弹幕数据版本，格式: {id: 版本标识}，用于生成 ETag
+
+def danmaku_cached_response(key, version, payload_fn):
+    """返回支持 gzip/br 协商压缩与 ETag/304 的 JSON 响应，响应体取自预序列化缓存，未命中时才调用 payload_fn 构建"""
+    status, headers, body = build_cached_json_response(danmaku_service.RESPONSE_BODY_CACHE, key, version, payload_fn, request.headers)
+    return Response(body, status=status, headers=headers)
+
+def get_dplayer_version(id):
+    """获取 DPlayer 弹幕数据版本，未记录时以持久化文件的状态为准"""
+    version = DPLAYER_DANMAKU_VERSION.get(id)
+    if version is None:
+        file_path = os.path.join("danmu_data", "dplayer", f"{id}.json")
+        version = file_version(file_path) if os.path.exists(file_path) else uuid.uuid4().hex
+        DPLAYER_DANMAKU_VERSION[id] = version
+    return version
 
 # DPlayer弹幕API路由
 @app.route('/api/dplayer/v3/', methods=['GET', 'POST'])
@@ -35,7 +93,16 @@ def dplayer_danmaku():
     if request.method == 'GET':
         # 获取弹幕
         id = request.args.get('id')
-        max_count = int(request.args.get('max', 1000))
+        # 降采样参数：默认按时间桶均匀降采样（density=0 时退回截取前 max_count 条）
+        density = request.args.get('density', '1') != '0'
+        try:
+            max_count = int(request.args.get('max', 1000))
+            bucket_seconds = float(request.args.get('bucket', DENSITY_BUCKET_SECONDS)) or DENSITY_BUCKET_SECONDS
+            per_bucket = int(request.args.get('perBucket', 0)) or None
+        except ValueError:
+            return jsonify({"code": 400, "message": "max / perBucket 需为整数，bucket 需为数值（秒）"})
+        if not math.isfinite(bucket_seconds) or bucket_seconds < 0 or (per_bucket or 0) < 0:
+            return jsonify({"code": 400, "message": "bucket 需为非负有限数值（秒），perBucket 不能为负数"})
         
         if not id:
             return jsonify({"code": 0, "data": []})
@@ -67,11 +134,26 @@ def dplayer_danmaku():
             except Exception as e:
                 print(f"导入其他平台弹幕失败: {e}")
         
+        if not danmaku_list:
+            return jsonify({"code": 0, "data": []})
+        
         # 返回弹幕，最多max_count条
-        return jsonify({
-            "code": 0,
-            "data": danmaku_list[:max_count]
-        })
+        params = (max_count, density, bucket_seconds, per_bucket)
+
+        def build_payload():
+            if not density:
+                return {"code": 0, "data": danmaku_list[:max_count]}
+            # POST 追加的弹幕可能打乱时间顺序，降采样前确保有序
+            ordered = danmaku_list
+            if any(float(ordered[i][0]) > float(ordered[i + 1][0]) for i in range(len(ordered) - 1)):
+                ordered = sorted(ordered, key=lambda x: float(x[0]))
+            return {"code": 0, "data": limit_density(ordered, max_count, bucket_seconds, per_bucket)}
+
+        return danmaku_cached_response(
+            ("dplayer", id) + params,
+            (id, get_dplayer_version(id)) + params,
+            build_payload
+        )
     
     elif request.method == 'POST':
         # 发送弹幕
@@ -104,12 +186,21 @@ def save_dplayer_danmaku(id, danmaku_list):
         file_path = os.path.join("danmu_data", "dplayer", f"{id}.json")
         with open(file_path, 'w', encoding='utf-8') as f:
             json.dump(danmaku_list, f, ensure_ascii=False)
+        DPLAYER_DANMAKU_VERSION[id] = file_version(file_path)
     except Exception as e:
         print(f"保存弹幕文件失败: {e}")
+        DPLAYER_DANMAKU_VERSION[id] = uuid.uuid4().hex
+
+def read_platform_danmaku(file_path):
+    """读取一个平台弹幕 CSV，返回按时间排序的 [(时间秒, 文本)]（列选择与时间解析见 danmu_records）"""
+    with open(file_path, 'r', encoding='utf-8-sig', errors='ignore', newline='') as f:
+        items = [(time_ms / 1000, text) for time_ms, text in read_danmu_csv(f) if text]
+    items.sort(key=lambda x: x[0])
+    return items
 
 def import_danmaku_from_other_sources(id):
-    """从其他平台导入已下载的弹幕到DPlayer格式"""
-    danmaku_list = []
+    """从其他平台导入已下载的弹幕到DPlayer格式，多个来源按时间轴对齐后合并并抑制近似重复"""
+    streams = {}
     
     # 保存弹幕ID的部分用于匹配文件
     # 需要防止ID过长或包含无效字符
@@ -136,50 +227,17 @@ def import_danmaku_from_other_sources(id):
             try:
                 file_path = os.path.join(dir_path, file_name)
                 print(f"找到匹配的弹幕文件: {file_path}")
-                
-                # 读取CSV文件
-                df = pd.read_csv(file_path)
-                
-                # 根据不同平台处理数据格式
-                if platform == 'tencent':
-                    for _, row in df.iterrows():
-                        time_ms = int(row.get('time_offset', 0))
-                        text = row.get('content', '')
-                        if text:
-                            # DPlayer格式: [time, type, color, author, text]
-                            danmaku_list.append([time_ms/1000, 0, 16777215, 'guest', text])
-                else:
-                    # 尝试获取时间和内容列
-                    time_col = next((col for col in df.columns if 'time' in col.lower()), df.columns[0])
-                    text_col = next((col for col in df.columns if 'content' in col.lower() or 'text' in col.lower()), df.columns[-1])
-                    
-                    for _, row in df.iterrows():
-                        try:
-                            time_val = row[time_col]
-                            text = row[text_col]
-                            
-                            # 处理不同格式的时间
-                            if isinstance(time_val, str) and ':' in time_val:
-                                # 时:分:秒 格式转换为秒
-                                parts = time_val.split(':')
-                                if len(parts) == 3:
-                                    time_val = int(parts[0]) * 3600 + int(parts[1]) * 60 + float(parts[2])
-                                elif len(parts) == 2:
-                                    time_val = int(parts[0]) * 60 + float(parts[1])
-                            else:
-                                # 假设是毫秒，转换为秒
-                                time_val = float(time_val) / 1000
-                            
-                            if text:
-                                danmaku_list.append([time_val, 0, 16777215, 'guest', str(text)])
-                        except Exception as e:
-                            print(f"处理弹幕数据出错: {e}")
-                            continue
+                # 每个文件作为一个独立来源参与对齐与合并
+                streams[f"{platform}/{file_name}"] = read_platform_danmaku(file_path)
             except Exception as e:
                 print(f"读取弹幕文件出错: {e}")
     
-    # 按时间排序
-    danmaku_list.sort(key=lambda x: x[0])
+    merged, offsets = merge_danmaku(streams)
+    total = sum(len(items) for items in streams.values())
+    if len(streams) > 1:
+        print(f"合并 {len(streams)} 个弹幕来源，时间偏移: {offsets}，去重 {total - len(merged)} 条")
+    # DPlayer格式: [time, type, color, author, text]
+    danmaku_list = [[t, 0, 16777215, 'guest', text] for t, text, _ in merged]
     print(f"导入了 {len(danmaku_list)} 条弹幕")
     
     return danmaku_list
@@ -193,8 +251,12 @@ def index():
 def clear_danmaku_cache():
     try:
         # 清空内存中的弹幕数据
-        global DPLAYER_DANMAKU_DATA
+        global DPLAYER_DANMAKU_DATA, DPLAYER_DANMAKU_VERSION
         DPLAYER_DANMAKU_DATA = {}
+        DPLAYER_DANMAKU_VERSION = {}
+        danmaku_service.RESPONSE_BODY_CACHE.clear()
+        DANMU_STORE.clear()
+        deleted_indexes = danmu_search_index.remove_all()
         
         # 清空各平台本地弹幕文件
         platforms = ['bilibili', 'youku', 'tencent', 'iqiyi', 'mgtv', 'dplayer']
@@ -214,12 +276,17 @@ def clear_danmaku_cache():
                     except Exception as e:
                         print(f"删除文件 {file_path} 失败: {e}")
         
-        return jsonify({"code": 200, "message": f"已清空弹幕缓存，删除了 {deleted_files} 个文件"})
+        return jsonify({"code": 200, "message": f"已清空弹幕缓存，删除了 {deleted_files} 个文件、{deleted_indexes} 个检索索引"})
     except Exception as e:
         print(f"清空弹幕缓存失败: {e}")
         print(traceback.format_exc())
         return jsonify({"code": 500, "message": f"清空弹幕缓存失败: {str(e)}"})
 
+# Prometheus 指标
+@app.route('/metrics')
+def metrics():
+    return Response(danmu_metrics.render(), headers={'Content-Type': danmu_metrics.CONTENT_TYPE})
+
 @app.route('/<path:path>')
 def static_file(path):
     return send_from_directory('.', path)
@@ -229,50 +296,7 @@ def static_file(path):
 def search_danmaku():
     keyword = request.args.get('keyword', '')
     source = request.args.get('source', '企鹅')
-
-    if not keyword:
-        return jsonify({"code": 400, "message": "请提供搜索关键词"})
-
-    try:
-        if source == "企鹅":
-            video_list = tencent_scraper.get_video_list(keyword)
-            return jsonify({
-                "code": 200,
-                "videos": [{"id": v["id"], "title": v["title"]} for v in video_list]
-            })
-        elif source == "奇异":
-            video_list, _ = aiqiyi_scraper.get_video_list(keyword)
-            return jsonify({
-                "code": 200,
-                "videos": [{"id": v["qipuId"], "title": v["title"]} for v in video_list]
-            })
-        elif source == "阿B":
-            video_list, _ = bilibili_scraper.get_video_list(keyword)
-            return jsonify({
-                "code": 200,
-                "videos": [{"id": v["id"], "title": v["title"]} for v in video_list]
-            })
-        elif source == "阿酷":
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            videos, _ = loop.run_until_complete(search_videos(keyword))
-            loop.close()
-            return jsonify({
-                "code": 200,
-                "videos": [{"id": v["vid"], "title": v["title"]} for v in videos]
-            })
-        elif source == "阿芒":
-            videos, _ = mgtv_scraper.get_video_list(keyword)
-            return jsonify({
-                "code": 200,
-                "videos": [{"id": v["vid"], "title": v["title"]} for v in videos]
-            })
-        else:
-            return jsonify({"code": 400, "message": f"不支持的弹幕源: {source}"})
-    except Exception as e:
-        print(f"搜索弹幕失败: {str(e)}")
-        print(traceback.format_exc())
-        return jsonify({"code": 500, "message": f"搜索弹幕失败: {str(e)}"})
+    return jsonify(run_coro(danmaku_service.search(source, keyword)))
 
 # 获取集数API
 @app.route('/api/danmaku/episodes')
@@ -280,237 +304,14 @@ def get_danmaku_episodes():
     video_id = request.args.get('videoId', '')
     source = request.args.get('source', '企鹅')
     keyword = request.args.get('keyword', '')  # 确保获取keyword参数
-
-    if not video_id:
-        return jsonify({"code": 400, "message": "请提供视频ID"})
-
-    try:
-        if source == "企鹅":
-            episode_list = tencent_scraper.get_video_info(video_id)
-            return jsonify({
-                "code": 200,
-                "episodes": [{"id": episode["vid"], "title": episode["playTitle"]} for episode in episode_list]
-            })
-        elif source == "奇异":
-            # 对于爱奇艺，需要调用另一个API方法
-            try:
-                # 先使用传入的keyword或video_id进行搜索
-                search_term = keyword if keyword else video_id
-                print(f"爱奇艺弹幕搜索关键词: {search_term}")
-                
-                video_list, data = aiqiyi_scraper.get_video_list(search_term)
-                if not video_list:
-                    return jsonify({"code": 404, "message": "未找到视频信息"})
-                
-                # 尝试匹配视频ID
-                matched_video = None
-                for video in video_list:
-                    if str(video["qipuId"]) == str(video_id):
-                        matched_video = video
-                        break
-                
-                if not matched_video:
-                    print(f"未找到匹配的爱奇艺视频ID: {video_id}")
-                    # 如果找不到匹配的视频，使用第一个
-                    matched_video = video_list[0]
-                    print(f"使用第一个视频: {matched_video['title']} (ID: {matched_video['qipuId']})")
-                
-                # 获取视频集数信息
-                video_info = aiqiyi_scraper.get_video_info(data, int(matched_video["qipuId"]))
-                
-                # 检查返回结果类型
-                if isinstance(video_info, list):
-                    # 如果返回的是集数列表，提取每集信息
-                    episodes = []
-                    for episode in video_info:
-                        if 'playUrl' in episode and episode['playUrl']:
-                            episodes.append({
-                                "id": episode["playUrl"],
-                                "title": episode["title"],
-                                "qipuId": episode.get("qipuId", "")
-                            })
-                    
-                    if not episodes:
-                        return jsonify({"code": 404, "message": "未找到集数信息"})
-                    
-                    print(f"找到 {len(episodes)} 个集数")
-                    return jsonify({"code": 200, "episodes": episodes})
-                
-                elif video_info:  # 单个视频情况
-                    return jsonify({
-                        "code": 200,
-                        "episodes": [{
-                            "id": video_info["playUrl"], 
-                            "title": video_info["title"]
-                        }]
-                    })
-                else:
-                    # 尝试获取更多集数信息
-                    episodes = []
-                    if data and 'data' in data:
-                        for template in data.get('data', {}).get('templates', []):
-                            if 'albumInfo' in template and str(template['albumInfo'].get('qipuId', '')) == str(matched_video["qipuId"]):
-                                # 如果是剧集，检查videos数组
-                                videos = template['albumInfo'].get('videos', [])
-                                if videos:
-                                    for video in videos:
-                                        play_url = ""
-                                        if video.get('playUrl'):
-                                            parts = video.get('playUrl').split(';')
-                                            if parts and '=' in parts[0]:
-                                                play_url = parts[0].split('=')[1]
-                                        
-                                        episodes.append({
-                                            "id": play_url,
-                                            "title": video.get('title', '未命名'),
-                                            "qipuId": video.get('qipuId', '')
-                                        })
-                                else:
-                                    # 如果没有videos数组，直接添加当前项
-                                    play_url = ""
-                                    if template['albumInfo'].get('playUrl'):
-                                        parts = template['albumInfo'].get('playUrl').split(';')
-                                        if parts and '=' in parts[0]:
-                                            play_url = parts[0].split('=')[1]
-                                    
-                                    episodes.append({
-                                        "id": play_url,
-                                        "title": template['albumInfo'].get('title', '未命名'),
-                                        "qipuId": template['albumInfo'].get('qipuId', '')
-                                    })
-                                break
-                    
-                    if not episodes:
-                        return jsonify({"code": 404, "message": "未找到集数信息"})
-                    
-                    return jsonify({"code": 200, "episodes": episodes})
-            except Exception as e:
-                print(f"获取爱奇艺集数失败: {str(e)}")
-                print(traceback.format_exc())
-                return jsonify({"code": 500, "message": f"获取集数失败: {str(e)}"})
-        elif source == "阿B":
-            # 对于B站，需要先获取视频数据
-            try:
-                # 使用关键词或视频ID进行搜索
-                search_keyword = keyword if keyword else video_id
-                print(f"使用关键词搜索B站视频: {search_keyword}")
-                
-                # 先用关键词搜索获取视频列表和数据
-                videos, data = bilibili_scraper.get_video_list(search_keyword)
-                
-                if not videos:
-                    print(f"未找到与关键词匹配的视频: {search_keyword}")
-                    return jsonify({"code": 404, "message": "未找到视频信息"})
-                
-                # 然后使用视频ID获取集数信息
-                print(f"使用视频ID获取集数列表: {video_id}")
-                episode_list = bilibili_scraper.get_video_info(data, video_id)
-                
-                if not episode_list:
-                    print(f"找到视频但未找到集数信息，ID: {video_id}")
-                    return jsonify({"code": 200, "episodes": []})
-                
-                # 返回集数列表
-                return jsonify({
-                    "code": 200,
-                    "episodes": [{"id": episode["playUrl"], "title": episode["title"]} for episode in episode_list]
-                })
-            except Exception as e:
-                print(f"获取B站集数失败: {str(e)}")
-                print(traceback.format_exc())
-                return jsonify({"code": 500, "message": f"获取集数失败: {str(e)}"})
-        elif source == "阿酷":
-            try:
-                # 使用关键词进行搜索
-                search_term = keyword if keyword else video_id
-                print(f"使用关键词搜索优酷视频: {search_term}")
-                
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-                # 先进行搜索获取search_result
-                videos, search_result = loop.run_until_complete(search_videos(search_term))
-                
-                if not videos:
-                    print(f"未找到与关键词匹配的优酷视频: {search_term}")
-                    return jsonify({"code": 404, "message": "未找到视频信息"})
-                
-                # 查找匹配视频ID的视频标题
-                video_title = None
-                for video in videos:
-                    # 尝试完全匹配视频ID
-                    if video["vid"] == video_id:
-                        video_title = video["title"]
-                        print(f"找到精确匹配的优酷视频: {video_title}")
-                        break
-                
-                # 如果找不到精确匹配，默认使用第一个视频的标题
-                if not video_title:
-                    video_title = videos[0]["title"]
-                    print(f"未找到精确匹配，使用第一个视频: {video_title}")
-                
-                # 使用标题来获取集数
-                print(f"使用标题 '{video_title}' 获取集数")
-                episodes = loop.run_until_complete(get_video_episodes(search_result, video_title))
-                loop.close()
-                
-                if not episodes:
-                    print(f"未找到 '{video_title}' 的集数信息")
-                    return jsonify({"code": 404, "message": "未找到集数信息"})
-                
-                print(f"找到 {len(episodes)} 个集数")
-                return jsonify({
-                    "code": 200,
-                    "episodes": [{"id": episode["vid"], "title": episode["Title"]} for episode in episodes]
-                })
-            except Exception as e:
-                print(f"获取优酷集数失败: {str(e)}")
-                print(traceback.format_exc())
-                return jsonify({"code": 500, "message": f"获取集数失败: {str(e)}"})
-        elif source == "阿芒":
-            # 对于芒果TV，需要先获取视频信息
-            try:
-                # 使用关键词或视频ID进行搜索
-                search_term = keyword if keyword else video_id
-                print(f"使用关键词搜索芒果TV视频: {search_term}")
-                
-                videos, search_result = mgtv_scraper.get_video_list(search_term)
-                
-                if not videos:
-                    print(f"未找到芒果TV视频: {search_term}")
-                    return jsonify({"code": 404, "message": "未找到视频信息"})
-                
-                # 查找匹配的视频ID
-                matched_video = None
-                for v in videos:
-                    if v["vid"] == video_id:
-                        matched_video = v
-                        break
-                
-                if not matched_video:
-                    # 如果找不到匹配的视频，使用第一个
-                    matched_video = videos[0]
-                
-                episodes = mgtv_scraper.get_video_info(search_result, matched_video["vid"])
-                
-                if not episodes:
-                    print(f"找到视频但未找到集数信息，ID: {matched_video['vid']}")
-                    return jsonify({"code": 200, "episodes": []})
-                
-                return jsonify({
-                    "code": 200,
-                    "episodes": [{"id": episode["url"], "title": episode["title"]} for episode in episodes]
-                })
-            except Exception as e:
-                print(f"获取芒果TV集数失败: {str(e)}")
-                print(traceback.format_exc())
-                return jsonify({"code": 500, "message": f"获取集数失败: {str(e)}"})
-        else:
-            return jsonify({"code": 400, "message": f"不支持的弹幕源: {source}"})
-    except Exception as e:
-        print(f"获取集数失败: {str(e)}")
-        print(traceback.format_exc())
-        return jsonify({"code": 500, "message": f"获取集数失败: {str(e)}"})
+    result = run_coro(danmaku_service.episodes(source, video_id, keyword))
+    # prefetch=1 时在后台预取整季弹幕，之后切换剧集可直接命中本地数据
+    if request.args.get('prefetch') == '1' and result.get("code") == 200:
+        # 个别平台的集数条目可能缺少ID，跳过这些条目
+        episode_ids = [str(e["id"]) for e in result.get("episodes", []) if isinstance(e, dict) and e.get("id")]
+        if episode_ids:
+            download_jobs.prefetch_episodes(source, episode_ids, keyword)
+    return jsonify(result)
 
 # 下载弹幕API
 @app.route('/api/danmaku/download')
@@ -518,163 +319,123 @@ def download_danmaku():
     danmaku_id = request.args.get('danmakuId', '')
     source = request.args.get('source', '企鹅')
     keyword = request.args.get('keyword', '')  # 获取关键词参数用于标题处理
+    refresh = request.args.get('refresh') == '1'  # 忽略本地存储，强制重新抓取
+    status, headers, body = run_coro(danmaku_service.download(source, danmaku_id, keyword, dict(request.headers), refresh))
+    return Response(body, status=status, headers=headers)
+
+# 弹幕热度图API：返回每个时间桶的弹幕条数，用于绘制“高能时刻”进度条
+@app.route('/api/danmaku/heatmap')
+def danmaku_heatmap():
+    danmaku_id = request.args.get('danmakuId', '')
+    source = request.args.get('source', '企鹅')
+    keyword = request.args.get('keyword', '')
+    try:
+        resolution = int(request.args.get('resolution', 10))
+    except ValueError:
+        return jsonify({"code": 400, "message": "resolution 需为整数秒"})
+    status, headers, body = run_coro(danmaku_service.heatmap(source, danmaku_id, keyword, resolution, dict(request.headers)))
+    return Response(body, status=status, headers=headers)
 
+# 单集弹幕关键词检索API：返回包含关键词的弹幕时间，便于跳转到对应片段
+@app.route('/api/danmaku/find')
+def find_in_danmaku():
+    danmaku_id = request.args.get('danmakuId', '')
+    source = request.args.get('source', '企鹅')
+    keyword = request.args.get('keyword', '')
+    query = request.args.get('q', '')
+    status, headers, body = run_coro(danmaku_service.search_in_episode(source, danmaku_id, keyword, query, dict(request.headers)))
+    return Response(body, status=status, headers=headers)
+
+# 后台下载任务API：提交后立即返回任务ID，长时间抓取不再占用前端连接
+@app.route('/api/danmaku/jobs', methods=['POST'])
+def submit_danmaku_job():
+    params = request.get_json(silent=True) or request.values
+    danmaku_id = params.get('danmakuId', '')
+    source = params.get('source', '企鹅')
+    keyword = params.get('keyword', '')
     if not danmaku_id:
         return jsonify({"code": 400, "message": "请提供弹幕ID"})
+    job = download_jobs.submit_job(source, danmaku_id, keyword)
+    return jsonify({"code": 202, "job": job})
+
+# 预取后续剧集弹幕：低优先级后台任务，结果写入本地弹幕存储
+@app.route('/api/danmaku/prefetch', methods=['POST'])
+def prefetch_danmaku():
+    params = request.get_json(silent=True) or {}
+    source = params.get('source', '企鹅')
+    keyword = params.get('keyword', '')
+    # episodes 可以是 /api/danmaku/episodes 返回的集数列表，也可以直接是弹幕ID列表
+    episodes = params.get('episodes', [])
+    if not isinstance(episodes, list) or not episodes:
+        return jsonify({"code": 400, "message": "请提供集数列表"})
+    episode_ids = [e.get("id") if isinstance(e, dict) else e for e in episodes]
+    if not all(isinstance(i, (str, int)) and not isinstance(i, bool) and str(i) for i in episode_ids):
+        return jsonify({"code": 400, "message": "集数列表中的每一项需为弹幕ID或带 id 字段的集数"})
+    episode_ids = [str(i) for i in episode_ids]
+    jobs = download_jobs.prefetch_episodes(source, episode_ids, keyword, params.get('currentId'))
+    return jsonify({"code": 202, "jobs": jobs})
 
+# 增量刷新已下载的弹幕：只重新请求到期的分段，新弹幕按ID去重后合并
+@app.route('/api/danmaku/refresh', methods=['POST'])
+def refresh_danmaku():
+    params = request.get_json(silent=True) or request.values
+    danmaku_id = params.get('danmakuId', '')
+    source = params.get('source', '企鹅')
+    keyword = params.get('keyword', '')
+    if not danmaku_id:
+        return jsonify({"code": 400, "message": "请提供弹幕ID"})
     try:
-        filepath = None
-        # 使用关键词或ID作为标题基础
-        title_base = keyword if keyword else danmaku_id
-        
-        if source == "企鹅":
-            filepath = tencent_scraper.fetch_danmu(danmaku_id)
-        elif source == "奇异":
-            # 爱奇艺弹幕获取，需要视频id和时长
-            duration = 7200000  # 默认2小时
-            
-            # 先尝试通过API搜索获取相关信息
-            if keyword:
-                try:
-                    print(f"搜索爱奇艺视频: {keyword}")
-                    video_list, data = aiqiyi_scraper.get_video_list(keyword)
-                    
-                    if video_list:
-                        # 尝试找到匹配的视频
-                        matched_video = None
-                        for video in video_list:
-                            # 比较qipuId
-                            if str(video.get('qipuId', '')) == str(danmaku_id):
-                                matched_video = video
-                                break
-                                
-                            # 在playUrl中查找
-                            play_url = video.get('playUrl', '')
-                            if play_url and danmaku_id in play_url:
-                                matched_video = video
-                                break
-                        
-                        # 如果找到匹配视频
-                        if matched_video:
-                            # 获取视频详细信息
-                            video_info = aiqiyi_scraper.get_video_info(data, matched_video['qipuId'])
-                            
-                            # 可能返回列表(剧集)或单个对象(单视频)
-                            if isinstance(video_info, list):
-                                # 在视频列表中查找匹配ID的视频
-                                for episode in video_info:
-                                    if str(episode.get('qipuId', '')) == str(danmaku_id) or episode.get('playUrl', '') == danmaku_id:
-                                        duration = episode.get('duration', 7200000)
-                                        print(f"从视频列表中找到匹配视频: {episode.get('title')}, 时长: {duration}")
-                                        break
-                            elif video_info:
-                                duration = video_info.get('duration', 7200000)
-                                print(f"找到视频信息: {video_info.get('title')}, 时长: {duration}")
-                except Exception as e:
-                    print(f"搜索爱奇艺视频信息失败: {e}")
-                    
-            print(f"获取爱奇艺弹幕: ID={danmaku_id}, 时长={duration}")
-            filepath = aiqiyi_scraper.fetch_danmu(danmaku_id, duration)
-        elif source == "阿B":
-            filepath = bilibili_scraper.fetch_danmu(danmaku_id, title_base)
-        elif source == "阿酷":
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            danmus = loop.run_until_complete(download_danmu(danmaku_id, title_base))
-            loop.close()
-            
-            if danmus:
-                # 查找最新的弹幕文件
-                base_dir = "danmu_data/youku"
-                files = [f for f in os.listdir(base_dir) if f.endswith('.csv')]
-                if files:
-                    latest_file = max(files, key=lambda x: os.path.getmtime(os.path.join(base_dir, x)))
-                    filepath = os.path.join(base_dir, latest_file)
-        elif source == "阿芒":
-            filepath = mgtv_scraper.fetch_danmu(danmaku_id, title_base)
-        else:
-            return jsonify({"code": 400, "message": f"不支持的弹幕源: {source}"})
-
-        if not filepath or not os.path.exists(filepath):
-            return jsonify({"code": 404, "message": "未找到弹幕数据"})
-
-        # 读取弹幕数据
-        danmakus = []
-        try:
-            # 先读取并清理文件内容
-            with open(filepath, 'rb') as f:
-                content = f.read()
-                # 移除 NUL 字符
-                content = content.replace(b'\x00', b'')
-            
-            # 将清理后的内容写回临时文件
-            temp_filepath = filepath + '.temp'
-            with open(temp_filepath, 'wb') as f:
-                f.write(content)
-            
-            # 读取清理后的文件
-            with open(temp_filepath, 'r', encoding='utf-8') as f:
-                df = pd.read_csv(f)
-                
-                # 根据不同的弹幕源，处理不同格式的CSV
-                if source == "企鹅":
-                    # 企鹅视频的弹幕格式：time_offset, create_time, content
-                    for _, row in df.iterrows():
-                        danmakus.append({
-                            "time": int(row['time_offset']),
-                            "text": row['content']
-                        })
-                elif source in ["奇异", "阿B", "阿酷", "阿芒"]:
-                    # 其他源的弹幕格式可能不同，需要适配
-                    for _, row in df.iterrows():
-                        # 检查列名
-                        time_col = next((col for col in df.columns if 'time' in col.lower()), df.columns[0])
-                        text_col = next((col for col in df.columns if 'content' in col.lower() or 'text' in col.lower()), df.columns[-1])
-                        
-                        try:
-                            # 尝试提取时间
-                            time_val = row[time_col]
-                            if isinstance(time_val, str) and ':' in time_val:
-                                # 如果是时分秒格式，转换为毫秒
-                                parts = time_val.split(':')
-                                if len(parts) == 3:
-                                    time_val = (int(parts[0]) * 3600 + int(parts[1]) * 60 + float(parts[2])) * 1000
-                                elif len(parts) == 2:
-                                    time_val = (int(parts[0]) * 60 + float(parts[1])) * 1000
-                            
-                            danmakus.append({
-                                "time": int(float(time_val)),
-                                "text": str(row[text_col])
-                            })
-                        except (ValueError, TypeError) as e:
-                            print(f"处理弹幕行时出错: {e}, 原行: {row}")
-                            continue
-            
-            # 删除临时文件
-            try:
-                os.remove(temp_filepath)
-            except:
-                pass
-            
-            # 按时间排序
-            danmakus.sort(key=lambda x: x["time"])
-            
-            # 输出日志
-            print(f"成功加载 {len(danmakus)} 条弹幕")
-            
-            return jsonify({
-                "code": 200,
-                "danmakus": danmakus,
-                "count": len(danmakus)
-            })
-        except Exception as e:
-            print(f"读取弹幕数据失败: {str(e)}")
-            print(traceback.format_exc())
-            return jsonify({"code": 500, "message": f"读取弹幕数据失败: {str(e)}"})
+        stats = run_coro(danmu_refresh.refresh_episode(source, danmaku_id, keyword))
+    except EpisodeUnavailableError as e:
+        return jsonify(e.to_payload())
     except Exception as e:
-        print(f"下载弹幕失败: {str(e)}")
+        if is_transient(e):
+            return jsonify(danmaku_service.transient_payload(e))
+        print(f"增量刷新弹幕失败: {str(e)}")
         print(traceback.format_exc())
-        return jsonify({"code": 500, "message": f"下载弹幕失败: {str(e)}"})
+        return jsonify({"code": 500, "message": f"增量刷新弹幕失败: {str(e)}"})
+    return jsonify({"code": 200, "refresh": stats})
+
+# 查询任务状态（分段进度）
+@app.route('/api/danmaku/jobs/<job_id>')
+def get_danmaku_job(job_id):
+    described = download_jobs.job_status(job_id)
+    if described is None:
+        return jsonify({"code": 404, "message": "任务不存在或已过期"})
+    job, _ = described
+    return jsonify({"code": 200, "job": job})
+
+# 获取任务结果，格式与下载弹幕API一致
+@app.route('/api/danmaku/jobs/<job_id>/result')
+def get_danmaku_job_result(job_id):
+    described = download_jobs.job_status(job_id)
+    if described is None:
+        return jsonify({"code": 404, "message": "任务不存在或已过期"})
+    job, filepath = described
+    if job["status"] == download_jobs.STATUS_FAILED and job["reason"]:
+        return jsonify({"code": REASON_CODES[job["reason"]], "reason": job["reason"], "message": job["error"], "job": job})
+    if job["status"] == download_jobs.STATUS_FAILED and job["transient"]:
+        return jsonify({**danmaku_service.transient_payload(job["error"]), "job": job})
+    if job["status"] == download_jobs.STATUS_FAILED:
+        return jsonify({"code": 500, "message": f"下载弹幕失败: {job['error']}", "job": job})
+    if job["status"] != download_jobs.STATUS_DONE:
+        return jsonify({"code": 202, "message": "任务尚未完成", "job": job})
+    try:
+        status, headers, body = danmaku_service.build_download_response(filepath, job["source"], job["danmakuId"], request.headers)
+    except Exception as e:
+        print(f"读取弹幕数据失败: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({"code": 500, "message": f"读取弹幕数据失败: {str(e)}"})
+    return Response(body, status=status, headers=headers)
+
+if PROFILE_STARTUP:
+    _heavy = [m for m in ("pandas", "bs4", "google.protobuf", "aiohttp", "brotli", "tqdm") if m in sys.modules]
+    print(f"[startup] app 模块加载耗时 {(time.perf_counter() - _STARTUP_BEGIN) * 1000:.1f} ms，已加载重量级依赖: {_heavy or '无'}")
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5005, debug=False) 
\ No newline at end of file
+    # DANMU_SERVER=async 时使用基于 aiohttp 的异步服务模式，否则使用 Flask 内置服务器
+    if os.environ.get("DANMU_SERVER", "flask") == "async":
+        from async_app import run_async_server
+        run_async_server(app, host="0.0.0.0", port=5005)
+    else:
+        app.run(host="0.0.0.0", port=5005, debug=False, threaded=True)
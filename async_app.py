@@ -0,0 +1,172 @@
+"""
+基于 aiohttp 的异步服务模式。
+
+搜索 / 集数 / 下载接口在同一个事件循环上以协程运行：优酷爬虫直接 await，
+阻塞型爬虫放到线程池执行。其余路由（DPlayer、清空缓存、静态文件）通过 WSGI 桥接交给 Flask 应用处理。
+
+启动方式：DANMU_SERVER=async python app.py
+"""
+import asyncio
+import io
+import sys
+import time
+from urllib.parse import unquote_to_bytes
+
+from aiohttp import web
+
+import danmaku_service
+import danmu_metrics
+import danmu_tracing
+import download_jobs
+from async_runtime import run_bridged, set_loop
+
+# 逐跳首部不应在 WSGI 响应与 aiohttp 响应之间透传
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade',
+}
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """原生协程路由的 CORS 处理，与 Flask-CORS 的默认行为保持一致（允许所有域）"""
+    response = await handler(request)
+    if 'Origin' in request.headers and 'Access-Control-Allow-Origin' not in response.headers:
+        response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+WSGI_ROUTE = '/{tail:.*}'
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """记录原生协程路由的请求耗时与追踪；桥接给 Flask 的路由由 Flask 自己记录"""
+    route = request.match_info.route.resource
+    endpoint = route.canonical if route is not None else "unmatched"
+    if endpoint == WSGI_ROUTE:
+        return await handler(request)
+
+    started = time.perf_counter()
+    status = 500
+    sampled = danmu_tracing.should_sample(request.headers.get(danmu_tracing.TRACE_HEADER))
+    try:
+        with danmu_tracing.trace(f"{request.method} {endpoint}", sampled,
+                                 source=request.query.get('source', ''), path=request.path) as root:
+            response = await handler(request)
+            status = response.status
+            if root.sampled:
+                root.set_attributes(status=status, bytes=len(response.body) if isinstance(response.body, bytes) else 0)
+                response.headers['X-Danmu-Trace-Id'] = root.trace_id
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        source = danmu_metrics.source_label(request.query.get('source', ''))
+        danmu_metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint, source)
+        danmu_metrics.HTTP_REQUESTS.inc(endpoint, source, str(status))
+
+
+async def search_handler(request):
+    query = request.query
+    payload = await danmaku_service.search(query.get('source', '企鹅'), query.get('keyword', ''))
+    return web.json_response(payload)
+
+
+async def episodes_handler(request):
+    query = request.query
+    source, keyword = query.get('source', '企鹅'), query.get('keyword', '')
+    payload = await danmaku_service.episodes(source, query.get('videoId', ''), keyword)
+    if query.get('prefetch') == '1' and payload.get("code") == 200:
+        await download_jobs.get_manager().prefetch(source, [e["id"] for e in payload["episodes"]], keyword)
+    return web.json_response(payload)
+
+
+async def download_handler(request):
+    query = request.query
+    status, headers, body = await danmaku_service.download(
+        query.get('source', '企鹅'), query.get('danmakuId', ''), query.get('keyword', ''), request.headers,
+        query.get('refresh') == '1'
+    )
+    return web.Response(status=status, headers=headers, body=body)
+
+
+def _call_wsgi(wsgi_app, environ):
+    """同步调用 WSGI 应用，返回 (status, headers, body)"""
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured['status'] = int(status.split(' ', 1)[0])
+        captured['headers'] = headers
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return captured['status'], captured['headers'], body
+
+
+def make_wsgi_handler(wsgi_app):
+    """把其余请求桥接给 Flask 应用（在桥接专用线程池中执行）"""
+
+    async def wsgi_handler(request):
+        body = await request.read()
+        host, _, port = (request.host or 'localhost').partition(':')
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            # WSGI 要求路径与查询串为原始字节按 latin-1 解码的字符串（werkzeug 会 encode("latin1") 后再按 UTF-8 解析），
+            # aiohttp 的 path / query_string 已解码，含中文时会编码失败
+            'PATH_INFO': unquote_to_bytes(request.rel_url.raw_path).decode('latin-1'),
+            'QUERY_STRING': request.rel_url.raw_query_string,
+            'SERVER_NAME': host,
+            'SERVER_PORT': port or ('443' if request.secure else '80'),
+            'SERVER_PROTOCOL': f"HTTP/{request.version.major}.{request.version.minor}",
+            'REMOTE_ADDR': request.remote or '',
+            'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request.scheme,
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                continue
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        status, headers, response_body = await run_bridged(_call_wsgi, wsgi_app, environ)
+        response = web.Response(status=status, body=response_body)
+        for name, value in headers:
+            if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != 'content-length':
+                response.headers.add(name, value)
+        return response
+
+    return wsgi_handler
+
+
+def create_async_app(flask_app):
+    """创建 aiohttp 应用，flask_app 负责处理未原生实现的路由"""
+    application = web.Application(middlewares=[metrics_middleware, cors_middleware])
+    application.router.add_get('/api/danmaku/search', search_handler)
+    application.router.add_get('/api/danmaku/episodes', episodes_handler)
+    application.router.add_get('/api/danmaku/download', download_handler)
+    application.router.add_route('*', WSGI_ROUTE, make_wsgi_handler(flask_app.wsgi_app))
+
+    async def on_startup(_):
+        # 共享事件循环即服务器自身的事件循环，后台任务与 Flask 桥接路由都提交到这里
+        set_loop(asyncio.get_running_loop())
+
+    application.on_startup.append(on_startup)
+    return application
+
+
+def run_async_server(flask_app, host="0.0.0.0", port=5005):
+    web.run_app(create_async_app(flask_app), host=host, port=port)
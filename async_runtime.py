@@ -0,0 +1,82 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 阻塞型爬虫（requests 实现）在该线程池中执行，避免阻塞事件循环
+EXECUTOR_WORKERS = int(os.environ.get("DANMU_EXECUTOR_WORKERS", "32"))
+
+# 异步服务模式下 WSGI 桥接的 Flask 视图在独立线程池中执行：视图内的 run_coro 还要等待提交到 _executor 的任务，
+# 共用一个线程池时并发桥接请求占满工作线程后会互相等待（死锁）
+BRIDGE_WORKERS = int(os.environ.get("DANMU_BRIDGE_WORKERS", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="danmu-worker")
+_bridge_executor = ThreadPoolExecutor(max_workers=BRIDGE_WORKERS, thread_name_prefix="danmu-bridge")
+_loop = None
+_loop_thread_id = None
+_lock = threading.Lock()
+
+
+def _run_loop_forever(loop, ready):
+    asyncio.set_event_loop(loop)
+    ready.set()
+    loop.run_forever()
+
+
+def set_loop(loop):
+    """指定共享事件循环（异步服务模式下使用服务器自身的事件循环），需在该循环所在线程调用"""
+    global _loop, _loop_thread_id
+    with _lock:
+        loop.set_default_executor(_executor)
+        _loop = loop
+        _loop_thread_id = threading.get_ident()
+
+
+def get_loop():
+    """返回进程内共享的事件循环；尚未设置时在后台线程中启动一个"""
+    global _loop, _loop_thread_id
+    if _loop is not None:
+        return _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(_executor)
+            ready = threading.Event()
+            thread = threading.Thread(target=_run_loop_forever, args=(loop, ready), name="danmu-event-loop", daemon=True)
+            thread.start()
+            ready.wait()
+            _loop = loop
+            _loop_thread_id = thread.ident
+    return _loop
+
+
+def run_coro(coro, timeout=None):
+    """在同步代码（如 Flask 视图）中把协程提交到共享事件循环并等待结果"""
+    loop = get_loop()
+    if threading.get_ident() == _loop_thread_id:
+        coro.close()
+        raise RuntimeError("run_coro 不能在共享事件循环线程中调用，请直接 await")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+
+async def _run_in(executor, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, fn, *args, **kwargs))
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """在线程池中执行阻塞函数并等待结果（复制当前上下文，追踪 span 等 ContextVar 在线程中可见）"""
+    return await _run_in(_executor, fn, *args, **kwargs)
+
+
+async def run_bridged(fn, *args, **kwargs):
+    """在 WSGI 桥接专用线程池中执行阻塞函数（其中可以调用 run_coro 等待 run_blocking 的任务）"""
+    return await _run_in(_bridge_executor, fn, *args, **kwargs)
+
+
+def submit_blocking(fn, *args, **kwargs):
+    """把阻塞函数提交到线程池后台执行，不等待结果"""
+    return _executor.submit(fn, *args, **kwargs)
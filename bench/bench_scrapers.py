@@ -0,0 +1,197 @@
+"""
+爬虫性能基准：在本地模拟上游上运行各平台爬虫，报告吞吐、延迟分位数与峰值内存。
+
+不需要访问外网，可在无网络的 Linux 机器上运行（需在仓库根目录执行）：
+
+    python -m bench.bench_scrapers --episodes 4 --concurrency 2 --latency-ms 30 --json bench_result.json
+
+每个爬虫在独立的子进程中运行（工作目录为临时目录，输出文件不会写入仓库），
+峰值内存（ru_maxrss）因此只反映该爬虫本身。
+"""
+import argparse
+import asyncio
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.mock_upstreams import MockConfig, MockUpstreams
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRAPERS = ("tencent", "iqiyi", "mgtv", "youku", "bilibili")
+
+
+def percentile(values, pct):
+    """最近秩法分位数，values 为空时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def count_csv_rows(filepath):
+    if not filepath or not os.path.exists(filepath):
+        return 0
+    with open(filepath, 'r', encoding='utf-8-sig', errors='ignore', newline='') as f:
+        return max(sum(1 for _ in csv.reader(f)) - 1, 0)
+
+
+def _episode_runner(name, duration_s):
+    """返回 run(index) -> 弹幕条数，每次调用抓取一集"""
+    if name == "tencent":
+        from get_tencent_danmu import TencentVideoScraper
+        return lambda i: count_csv_rows(TencentVideoScraper().fetch_danmu(f"bench{i}"))
+    if name == "iqiyi":
+        from get_aiqiyi_danmu import AiqiyiVideoScraper
+        return lambda i: count_csv_rows(AiqiyiVideoScraper().fetch_danmu(f"bench{i:04d}", duration_s * 1000))
+    if name == "mgtv":
+        from get_mgtv_danmu import MgtvVideoScraper
+        return lambda i: count_csv_rows(
+            MgtvVideoScraper().fetch_danmu(f"https://www.mgtv.com/b/123/bench{i}.html", f"bench{i}")
+        )
+    if name == "youku":
+        from get_youkudanmuku import download_danmu
+        return lambda i: count_csv_rows(asyncio.run(download_danmu(f"bench{i}", f"bench{i}")))
+    if name == "bilibili":
+        from get_bilibili_danmu import BilibiliVideoScraper
+        return lambda i: count_csv_rows(
+            BilibiliVideoScraper().fetch_danmu(f"https://www.bilibili.com/video/BV1bench{i}", f"bench{i}")
+        )
+    raise ValueError(f"未知爬虫: {name}")
+
+
+def _run_scraper(name, base_url, episodes, concurrency, duration_s, results):
+    """子进程入口：抓取 episodes 集并把统计结果放入 results 队列"""
+    sys.path.insert(0, REPO_ROOT)
+    from bench import redirect
+
+    redirect.install(base_url)
+
+    episode_latencies, comments, failures = [], 0, 0
+
+    def timed(index):
+        started = time.perf_counter()
+        try:
+            count = run(index)
+        except Exception:
+            # 重试后仍失败或熔断时爬虫抛出异常，计为失败的一集
+            count = 0
+        return time.perf_counter() - started, count
+
+    with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as workdir, \
+            open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        os.chdir(workdir)
+        # 断点与时长缓存使用临时目录下的绝对路径（需在导入爬虫模块前设置）
+        os.environ["DANMU_CHECKPOINT_DIR"] = os.path.join(workdir, "checkpoints")
+        os.environ["DANMU_DURATION_CACHE_PATH"] = os.path.join(workdir, "durations.json")
+        run = _episode_runner(name, duration_s)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for elapsed, count in pool.map(timed, range(episodes)):
+                episode_latencies.append(elapsed)
+                comments += count
+                failures += count == 0
+        wall = time.perf_counter() - started
+        # 等待仍在进行的分段请求（如对冲请求）结束，再离开临时目录
+        import segment_fetcher
+        segment_fetcher._pool.shutdown(wait=True)
+        os.chdir(REPO_ROOT)
+
+    requests_ms = [latency * 1000 for latency in redirect.REQUEST_LATENCIES]
+    results.put({
+        "scraper": name,
+        "episodes": episodes,
+        "failed_episodes": failures,
+        "comments": comments,
+        "wall_s": round(wall, 3),
+        "comments_per_s": round(comments / wall, 1) if wall else None,
+        "episode_p50_s": round(percentile(episode_latencies, 50), 3),
+        "episode_p95_s": round(percentile(episode_latencies, 95), 3),
+        "requests": len(requests_ms),
+        "request_errors": redirect.REQUEST_FAILURES,
+        "request_p50_ms": round(percentile(requests_ms, 50) or 0, 1),
+        "request_p95_ms": round(percentile(requests_ms, 95) or 0, 1),
+        "request_p99_ms": round(percentile(requests_ms, 99) or 0, 1),
+        # Linux 上 ru_maxrss 单位为 KB
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+
+
+def run_benchmark(scrapers, episodes, concurrency, config):
+    """依次运行各爬虫，返回每个爬虫的统计结果列表"""
+    context = multiprocessing.get_context("spawn")
+    reports = []
+    with MockUpstreams(config) as upstreams:
+        for name in scrapers:
+            results = context.Queue()
+            process = context.Process(
+                target=_run_scraper,
+                args=(name, upstreams.base_url, episodes, concurrency, config.duration_s, results)
+            )
+            process.start()
+            process.join()
+            if process.exitcode != 0 or results.empty():
+                reports.append({"scraper": name, "error": f"子进程退出码 {process.exitcode}"})
+                continue
+            reports.append(results.get())
+    return reports
+
+
+def print_table(reports):
+    columns = [
+        ("scraper", "爬虫"), ("episodes", "集数"), ("failed_episodes", "失败"), ("comments", "弹幕数"),
+        ("comments_per_s", "条/秒"), ("episode_p50_s", "单集p50(s)"), ("episode_p95_s", "单集p95(s)"),
+        ("requests", "请求数"), ("request_errors", "请求失败"), ("request_p50_ms", "p50(ms)"),
+        ("request_p95_ms", "p95(ms)"), ("request_p99_ms", "p99(ms)"), ("peak_rss_mb", "峰值RSS(MB)"),
+    ]
+    print(" | ".join(title for _, title in columns))
+    for report in reports:
+        if "error" in report:
+            print(f"{report['scraper']} | {report['error']}")
+            continue
+        print(" | ".join(str(report.get(key, "")) for key, _ in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="在本地模拟上游上对各平台爬虫做性能基准")
+    parser.add_argument("--scrapers", default=",".join(SCRAPERS), help="逗号分隔的爬虫列表")
+    parser.add_argument("--episodes", type=int, default=4, help="每个爬虫抓取的集数")
+    parser.add_argument("--concurrency", type=int, default=1, help="同时抓取的集数")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="模拟上游的基础延迟")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="延迟抖动（±）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游返回 503 的概率")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="模拟上游长尾请求的概率")
+    parser.add_argument("--tail-ms", type=float, default=1000.0, help="长尾请求额外增加的延迟")
+    parser.add_argument("--comments-per-minute", type=int, default=200, help="每分钟视频的弹幕条数")
+    parser.add_argument("--duration", type=int, default=600, help="视频时长（秒）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    scrapers = [name.strip() for name in args.scrapers.split(",") if name.strip()]
+    unknown = [name for name in scrapers if name not in SCRAPERS]
+    if unknown:
+        parser.error(f"未知爬虫: {', '.join(unknown)}（可选 {', '.join(SCRAPERS)}）")
+
+    config = MockConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        tail_rate=args.tail_rate, tail_ms=args.tail_ms, comments_per_minute=args.comments_per_minute, duration_s=args.duration, seed=args.seed
+    )
+    reports = run_benchmark(scrapers, args.episodes, args.concurrency, config)
+    print_table(reports)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"config": vars(config), "results": reports}, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
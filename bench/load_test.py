@@ -0,0 +1,271 @@
+"""
+HTTP 接口端到端压测：按配置的并发与请求比例压测搜索 / 集数 / 下载 / DPlayer 读写接口，
+输出每个接口的 p50/p95/p99 延迟、错误率与吞吐，报告为 JSON，可在版本之间直接比较。
+
+默认在子进程中启动一个本地服务（工作目录为临时目录），其上游请求改写到本地模拟上游，
+无需外网（需在仓库根目录执行）：
+
+    python -m bench.load_test --concurrency 16 --duration 30 --json load_report.json
+    python -m bench.load_test --server async --compare load_report.json
+
+也可以用 --target 压测已经在运行的服务（此时上游由该服务自行访问）。
+模拟上游只提供企鹅的搜索与剧集页，因此压测固定使用弹幕源“企鹅”。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from bench.bench_scrapers import REPO_ROOT, percentile
+from bench.mock_upstreams import MockConfig, MockUpstreams
+
+SOURCE = "企鹅"
+# 默认请求比例：读多写少，DPlayer 读取最频繁
+DEFAULT_MIX = "search=1,episodes=1,download=4,dplayer_get=6,dplayer_post=2"
+OPERATIONS = ("search", "episodes", "download", "dplayer_get", "dplayer_post")
+KEYWORDS = ["北上", "繁花", "庆余年", "狂飙", "漫长的季节"]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"未知接口: {name}（可选 {', '.join(OPERATIONS)}）")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise ValueError("请求比例不能全为 0")
+    return mix
+
+
+# ---- 本地服务 ----
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _serve_app(upstream_url, port, workdir, server):
+    """子进程入口：在临时目录中启动服务，上游请求改写到模拟上游"""
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(workdir)
+    from bench import redirect
+
+    redirect.install(upstream_url)
+    # 服务日志全部丢弃（包括后台线程的 print）
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    import app
+    if server == "async":
+        from async_app import run_async_server
+        run_async_server(app.app, host="127.0.0.1", port=port)
+    else:
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        make_server("127.0.0.1", port, app.app, threaded=True).serve_forever()
+
+
+def _wait_until_listening(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+# ---- 压测 ----
+
+class LoadGenerator:
+    """固定并发的闭环压测：每个 worker 按比例随机选择接口，收到响应后立即发出下一个请求"""
+
+    def __init__(self, target, mix, concurrency, duration, episode_pool, seed=42):
+        self.target = target.rstrip("/")
+        self.mix = mix
+        self.concurrency = concurrency
+        self.duration = duration
+        self.episode_pool = episode_pool
+        self.seed = seed
+        # 接口 -> [(延迟秒, 是否成功)]
+        self.samples = {name: [] for name in mix}
+
+    def _pick(self, rng):
+        names = list(self.mix)
+        return rng.choices(names, weights=[self.mix[name] for name in names])[0]
+
+    async def _call(self, session, name, rng):
+        keyword = rng.choice(KEYWORDS)
+        if name == "search":
+            return await self._get_json(session, "/api/danmaku/search", {"source": SOURCE, "keyword": keyword}, 200)
+        if name == "episodes":
+            video_id = f"cover{rng.randrange(self.episode_pool)}"
+            return await self._get_json(session, "/api/danmaku/episodes",
+                                        {"source": SOURCE, "videoId": video_id, "keyword": keyword}, 200)
+        if name == "download":
+            danmaku_id = f"load{rng.randrange(self.episode_pool)}"
+            return await self._get_json(session, "/api/danmaku/download",
+                                        {"source": SOURCE, "danmakuId": danmaku_id, "keyword": keyword}, 200)
+        dplayer_id = f"load-{rng.randrange(self.episode_pool)}"
+        if name == "dplayer_get":
+            return await self._get_json(session, "/api/dplayer/v3/", {"id": dplayer_id, "max": 1000}, 0)
+        payload = {"id": dplayer_id, "author": "load", "text": f"压测弹幕{rng.randrange(10000)}",
+                   "time": round(rng.uniform(0, 1800), 1)}
+        async with session.post(f"{self.target}/api/dplayer/v3/", json=payload) as response:
+            return response.status == 200 and (await response.json(content_type=None)).get("code") == 0
+
+    async def _get_json(self, session, path, params, ok_code):
+        async with session.get(f"{self.target}{path}", params=params) as response:
+            if response.status == 304:
+                return True
+            if response.status != 200:
+                return False
+            return (await response.json(content_type=None)).get("code") == ok_code
+
+    async def _worker(self, session, index, deadline):
+        rng = random.Random(f"{self.seed}|{index}")
+        while time.monotonic() < deadline:
+            name = self._pick(rng)
+            started = time.perf_counter()
+            try:
+                ok = await self._call(session, name, rng)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                ok = False
+            self.samples[name].append((time.perf_counter() - started, ok))
+
+    async def run(self):
+        timeout = aiohttp.ClientTimeout(total=120)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            started = time.monotonic()
+            deadline = started + self.duration
+            await asyncio.gather(*(self._worker(session, i, deadline) for i in range(self.concurrency)))
+            return time.monotonic() - started
+
+
+def summarize(samples, wall):
+    """把 [(延迟秒, 是否成功)] 汇总为报告字段"""
+    latencies = [latency * 1000 for latency, _ in samples]
+    errors = sum(1 for _, ok in samples if not ok)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "throughput_rps": round(len(samples) / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 50) or 0, 2),
+        "p95_ms": round(percentile(latencies, 95) or 0, 2),
+        "p99_ms": round(percentile(latencies, 99) or 0, 2),
+    }
+
+
+def build_report(generator, wall, settings):
+    endpoints = {name: summarize(samples, wall) for name, samples in generator.samples.items()}
+    everything = [sample for samples in generator.samples.values() for sample in samples]
+    return {
+        "settings": settings,
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "wall_s": round(wall, 3),
+        "total": summarize(everything, wall),
+        "endpoints": endpoints,
+    }
+
+
+def print_report(report, baseline=None):
+    columns = ("requests", "errors", "error_rate", "throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+    print("接口 | " + " | ".join(columns))
+    rows = dict(report["endpoints"], total=report["total"])
+    for name, stats in rows.items():
+        cells = []
+        for column in columns:
+            cell = str(stats[column])
+            if baseline:
+                previous = (baseline.get("endpoints", {}).get(name) if name != "total" else baseline.get("total")) or {}
+                if previous.get(column):
+                    cell += f" ({(stats[column] - previous[column]) / previous[column]:+.0%})"
+            cells.append(cell)
+        print(f"{name} | " + " | ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP 接口端到端压测")
+    parser.add_argument("--target", help="压测已在运行的服务（如 http://127.0.0.1:5005），不指定时启动本地服务")
+    parser.add_argument("--server", choices=("flask", "async"), default="flask", help="本地服务模式")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发连接数")
+    parser.add_argument("--duration", type=float, default=30, help="压测时长（秒）")
+    parser.add_argument("--warmup", type=float, default=0, help="正式压测前的预热时长（秒），不计入报告")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"接口请求比例，默认 {DEFAULT_MIX}")
+    parser.add_argument("--episode-pool", type=int, default=20, help="随机选择的视频 / 弹幕 ID 个数（越小缓存命中越多）")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="模拟上游的基础延迟")
+    parser.add_argument("--jitter-ms", type=float, default=10.0, help="模拟上游的延迟抖动（±）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游返回 503 的概率")
+    parser.add_argument("--comments-per-minute", type=int, default=200, help="每分钟视频的弹幕条数")
+    parser.add_argument("--video-duration", type=int, default=1800, help="模拟视频时长（秒）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="把报告写入 JSON 文件")
+    parser.add_argument("--compare", help="与之前的 JSON 报告比较，在表格中显示变化百分比")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    settings = {
+        "target": args.target or f"local-{args.server}", "concurrency": args.concurrency, "duration_s": args.duration,
+        "mix": mix, "episode_pool": args.episode_pool, "seed": args.seed,
+    }
+    config = MockConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        comments_per_minute=args.comments_per_minute, duration_s=args.video_duration, seed=args.seed
+    )
+
+    def run(target):
+        if args.warmup:
+            asyncio.run(LoadGenerator(target, mix, args.concurrency, args.warmup, args.episode_pool, args.seed + 1).run())
+        generator = LoadGenerator(target, mix, args.concurrency, args.duration, args.episode_pool, args.seed)
+        return build_report(generator, asyncio.run(generator.run()), settings)
+
+    if args.target:
+        report = run(args.target)
+    else:
+        settings["upstream"] = vars(config)
+        context = multiprocessing.get_context("spawn")
+        port = _free_port()
+        with MockUpstreams(config) as upstreams, tempfile.TemporaryDirectory(prefix="bench-load-") as workdir:
+            server = context.Process(target=_serve_app, args=(upstreams.base_url, port, workdir, args.server), daemon=True)
+            server.start()
+            try:
+                if not _wait_until_listening(port):
+                    sys.exit("本地服务启动失败")
+                report = run(f"http://127.0.0.1:{port}")
+            finally:
+                server.terminate()
+                server.join()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入 {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+本地模拟上游（各平台弹幕接口的替身），用于在无网络环境下压测爬虫。
+
+所有平台共用一个 aiohttp 服务，路径的第一段为被替换的原始域名，例如
+https://dm.video.qq.com/barrage/segment/... 被改写为 http://127.0.0.1:<port>/dm.video.qq.com/barrage/segment/...
+（改写见 bench/redirect.py）。
+
+可配置项（MockConfig）：每次请求的延迟与抖动、失败率、每分钟视频的弹幕条数、视频时长、每部剧的集数。
+除弹幕接口外，企鹅的搜索与剧集页也有替身，供端到端压测（bench/load_test.py）使用。
+弹幕内容由固定种子生成，同一配置下每次运行的数据一致。
+"""
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+
+from aiohttp import web
+
+VOCABULARY = ['名场面', '哈哈哈哈', '前方高能', 'awsl', '太好看了', '这是什么', '泪目', '笑死我了', '主角光环', 'BGM好听']
+
+
+@dataclass
+class MockConfig:
+    latency_ms: float = 20.0  # 每次请求的基础延迟
+    jitter_ms: float = 10.0  # 延迟的随机抖动（±）
+    error_rate: float = 0.0  # 返回 503 的概率
+    tail_rate: float = 0.0  # 长尾请求的概率（延迟额外增加 tail_ms）
+    tail_ms: float = 1000.0
+    comments_per_minute: int = 200  # 每分钟视频的弹幕条数
+    duration_s: int = 1800  # 视频时长（秒）
+    episodes: int = 12  # 每部剧的集数（企鹅剧集页）
+    seed: int = 42
+
+
+class MockUpstreams:
+    """在后台线程的事件循环中运行的模拟上游服务"""
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockConfig()
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._random = random.Random(self.config.seed)
+        self._iqiyi_message = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    # ---- 生命周期 ----
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(ready,), name="mock-upstreams", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def _serve(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._runner = web.AppRunner(self.create_app())
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        ready.set()
+        self._loop.run_forever()
+
+    # ---- 应用与通用中间件 ----
+
+    def create_app(self):
+        app = web.Application(middlewares=[self._latency_middleware])
+        add = app.router.add_route
+        add('POST', '/pbaccess.video.qq.com/trpc.videosearch.mobile_search.MultiTerminalSearch/MbSearch', self.tencent_search)
+        add('GET', '/v.qq.com/x/cover/{cid}.html', self.tencent_cover)
+        add('GET', '/dm.video.qq.com/barrage/segment/{vid}/t/v1/{start}/{end}', self.tencent_segment)
+        add('GET', '/cmts.iqiyi.com/bullet/{a}/{b}/{name}', self.iqiyi_segment)
+        add('GET', '/pcweb.api.mgtv.com/video/info', self.mgtv_video_info)
+        add('GET', '/galaxy.bz.mgtv.com/rdbarrage', self.mgtv_barrage)
+        add('GET', '/log.mmstat.com/eg.js', self.youku_eg)
+        add('GET', '/acs.youku.com/h5/mtop.com.youku.aplatform.weakget/1.0/', self.youku_token)
+        add('GET', '/openapi.youku.com/v2/videos/show.json', self.youku_duration)
+        add('POST', '/acs.youku.com/h5/mopen.youku.danmu.list/1.0/', self.youku_danmu)
+        add('GET', '/api.bilibili.com/x/web-interface/view', self.bilibili_view)
+        add('GET', '/comment.bilibili.com/{cid}.xml', self.bilibili_xml)
+        return app
+
+    @web.middleware
+    async def _latency_middleware(self, request, handler):
+        self.requests += 1
+        config = self.config
+        delay = config.latency_ms + self._random.uniform(-config.jitter_ms, config.jitter_ms)
+        if config.tail_rate and self._random.random() < config.tail_rate:
+            delay += config.tail_ms
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if config.error_rate and self._random.random() < config.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text="mock upstream error")
+        return await handler(request)
+
+    def _comments(self, key, start_ms, end_ms):
+        """生成 [start_ms, end_ms) 区间内的弹幕 (id, 时间毫秒, 文本)，按时间排序"""
+        end_ms = min(end_ms, self.config.duration_s * 1000)
+        if end_ms <= start_ms:
+            return []
+        count = int(self.config.comments_per_minute * (end_ms - start_ms) / 60000)
+        rng = random.Random(f"{self.config.seed}|{key}|{start_ms}")
+        items = []
+        for i in range(count):
+            text = f"{rng.choice(VOCABULARY)}{rng.choice(VOCABULARY)}{rng.randint(0, 999)}"
+            items.append((f"{key}-{start_ms}-{i}", rng.randrange(start_ms, end_ms), text))
+        items.sort(key=lambda item: item[1])
+        return items
+
+    # ---- 企鹅 ----
+
+    async def tencent_search(self, request):
+        query = (await request.json()).get('query', '')
+        item_list = [
+            {"doc": {"id": f"cover{zlib.crc32(query.encode()) % 1000}x{i}"}, "videoInfo": {"title": f"{query} 第{i + 1}季"}}
+            for i in range(3)
+        ]
+        return web.json_response({"data": {"normalList": {"itemList": item_list}}})
+
+    async def tencent_cover(self, request):
+        cid = request.match_info['cid']
+        # 剧集页内嵌的 JSON 片段，爬虫用正则提取 vid / playTitle（倒序出现）
+        items = ",".join(
+            f'{{"vid":"{cid}e{i}","playTitle":"第{i}集"}}' for i in range(self.config.episodes, 0, -1)
+        )
+        return web.Response(text=f'<script>window.__DATA__={{"cid":"{cid}","list":[{items}]}}</script>', content_type='text/html')
+
+    async def tencent_segment(self, request):
+        start, end = int(request.match_info['start']), int(request.match_info['end'])
+        barrage_list = [
+            {"id": cid, "time_offset": str(t), "create_time": str(int(time.time())), "content": text}
+            for cid, t, text in self._comments(request.match_info['vid'], start, end)
+        ]
+        return web.json_response({"barrage_list": barrage_list})
+
+    # ---- 奇异（brotli 压缩的 protobuf）----
+
+    async def iqiyi_segment(self, request):
+        import brotli
+        from get_aiqiyi_danmu import AiqiyiVideoScraper
+
+        match = re.match(r'(.+)_60_(\d+)_\w+\.br$', request.match_info['name'])
+        if not match:
+            return web.Response(status=404)
+        vid, seq = match.group(1), int(match.group(2))
+        if (seq - 1) * 60 >= self.config.duration_s:
+            return web.Response(status=404)  # 与真实上游一致：超出视频时长的分段不存在
+        if self._iqiyi_message is None:
+            self._iqiyi_message = AiqiyiVideoScraper._danmu_message_class or AiqiyiVideoScraper()._init_protobuf()
+        danmu = self._iqiyi_message(code="A00000")
+        entry = danmu.entry.add()
+        for cid, t, text in self._comments(vid, (seq - 1) * 60000, seq * 60000):
+            bullet = entry.bulletInfo.add()
+            bullet.content = text
+            bullet.showTime = str(t // 1000)
+            bullet.userInfo.uid = cid
+        return web.Response(body=brotli.compress(danmu.SerializeToString()))
+
+    # ---- 阿芒 ----
+
+    async def mgtv_video_info(self, request):
+        seconds = self.config.duration_s
+        duration = f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+        return web.json_response({"data": {"info": {"time": duration}}})
+
+    async def mgtv_barrage(self, request):
+        start = int(request.query.get('time', 0))
+        items = [
+            {"id": cid, "time": t, "color": 16777215, "content": text}
+            for cid, t, text in self._comments(request.query.get('vid', ''), start, start + 60000)
+        ]
+        return web.json_response({"data": {"items": items}})
+
+    # ---- 阿酷 ----
+
+    async def youku_eg(self, request):
+        response = web.Response(text="")
+        response.set_cookie('cna', 'mockcna')
+        return response
+
+    async def youku_token(self, request):
+        response = web.json_response({"ret": ["SUCCESS::调用成功"]})
+        response.set_cookie('_m_h5_tk', 'mocktoken0123456789abcdef01234567_1')
+        response.set_cookie('_m_h5_tk_enc', 'mockenc')
+        return response
+
+    async def youku_duration(self, request):
+        return web.json_response({"duration": str(self.config.duration_s)})
+
+    async def youku_danmu(self, request):
+        form = await request.post()
+        msg = json.loads(form.get('data', '{}'))
+        mat = int(msg.get('mat', 0))
+        result = [
+            {"id": cid, "playat": t, "propertis": json.dumps({"color": 16777215}), "content": text}
+            for cid, t, text in self._comments(msg.get('vid', ''), mat * 60000, (mat + 1) * 60000)
+        ]
+        payload = json.dumps({"code": "0", "data": {"result": result}}, ensure_ascii=False)
+        return web.json_response({"data": {"result": payload}})
+
+    # ---- 阿B（XML 弹幕）----
+
+    async def bilibili_view(self, request):
+        key = request.query.get('bvid') or request.query.get('aid') or ''
+        return web.json_response({"code": 0, "data": {"cid": zlib.crc32(key.encode()) % 10 ** 8}})
+
+    async def bilibili_xml(self, request):
+        cid = request.match_info['cid']
+        lines = ['<?xml version="1.0" encoding="UTF-8"?><i><chatserver>chat.bilibili.com</chatserver>']
+        for row_id, (_, t, text) in enumerate(self._comments(cid, 0, self.config.duration_s * 1000)):
+            lines.append(f'<d p="{t / 1000:.3f},1,25,16777215,{int(time.time())},0,mockhash,{cid}{row_id}">{text}</d>')
+        lines.append('</i>')
+        return web.Response(text="".join(lines), content_type='text/xml')
@@ -0,0 +1,72 @@
+"""
+把爬虫发往真实平台的请求改写到本地模拟上游，并记录每次请求的耗时。
+
+爬虫代码本身不做任何修改：requests（含 Session）与 aiohttp.ClientSession 的请求入口被包装，
+https://<原始域名>/<路径> 改写为 <模拟上游地址>/<原始域名>/<路径>。
+"""
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+
+# 每次请求的耗时（秒）与失败次数，由压测脚本读取
+REQUEST_LATENCIES = []
+REQUEST_FAILURES = 0
+
+_installed = False
+
+
+def _rewrite(url, base_url):
+    parts = urlsplit(str(url))
+    rewritten = f"{base_url}/{parts.hostname}{parts.path}"
+    return f"{rewritten}?{parts.query}" if parts.query else rewritten
+
+
+def _record(started, ok):
+    global REQUEST_FAILURES
+    REQUEST_LATENCIES.append(time.perf_counter() - started)
+    if not ok:
+        REQUEST_FAILURES += 1
+
+
+def install(base_url):
+    """安装改写钩子（进程内只需调用一次）"""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    original_request = requests.sessions.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        started = time.perf_counter()
+        ok = False
+        try:
+            response = original_request(self, method, _rewrite(url, base_url), *args, **kwargs)
+            ok = response.status_code < 400
+            return response
+        finally:
+            _record(started, ok)
+
+    requests.sessions.Session.request = request
+
+    original_aiohttp_request = aiohttp.ClientSession._request
+
+    async def aiohttp_request(self, method, str_or_url, *args, **kwargs):
+        started = time.perf_counter()
+        ok = False
+        try:
+            response = await original_aiohttp_request(self, method, _rewrite(str_or_url, base_url), *args, **kwargs)
+            ok = response.status < 400
+            return response
+        finally:
+            _record(started, ok)
+
+    aiohttp.ClientSession._request = aiohttp_request
+
+
+def reset():
+    global REQUEST_FAILURES
+    REQUEST_LATENCIES.clear()
+    REQUEST_FAILURES = 0
@@ -0,0 +1,227 @@
+"""
+上游请求的熔断与重试预算。
+
+- 每个平台（tencent / iqiyi / mgtv / youku / bilibili）一个熔断器：连续 DANMU_BREAKER_FAILURES 次
+  瞬时失败（429 / 5xx / 超时 / 连接失败）后打开，DANMU_BREAKER_RESET_S 秒内该平台的请求直接抛出
+  CircuitOpenError，不再占用线程与上游；冷却后放行一个探测请求（半开），成功则关闭，失败则重新打开。
+- 全进程共享一个重试预算（令牌桶）：每个首次请求存入 DANMU_RETRY_BUDGET_RATIO 个令牌，另按
+  DANMU_RETRY_BUDGET_MIN_PER_S 每秒补充，每次重试消耗 1 个。上游整体故障时重试量被限制在正常请求量的一定比例内，
+  不会把故障放大成重试风暴。
+- retry_call / retry_call_async 只重试瞬时失败，最多 DANMU_RETRY_ATTEMPTS 次（含首次），退避为带随机抖动的指数退避。
+"""
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+
+from danmu_metrics import CIRCUIT_STATE, UPSTREAM_RETRIES
+
+FAILURE_THRESHOLD = int(os.environ.get("DANMU_BREAKER_FAILURES", "5"))
+RESET_TIMEOUT = float(os.environ.get("DANMU_BREAKER_RESET_S", "30"))
+MAX_ATTEMPTS = int(os.environ.get("DANMU_RETRY_ATTEMPTS", "3"))
+BUDGET_RATIO = float(os.environ.get("DANMU_RETRY_BUDGET_RATIO", "0.2"))
+BUDGET_MIN_PER_S = float(os.environ.get("DANMU_RETRY_BUDGET_MIN_PER_S", "1"))
+BUDGET_CAP = 100.0
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 2.0
+
+OVERLOAD_STATUSES = {429}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(RuntimeError):
+    """平台熔断器处于打开状态，请求未发出"""
+
+
+def is_overload(exc):
+    """是否为上游过载 / 瞬时失败：429 / 5xx / 超时 / 连接失败"""
+    status = getattr(exc, "status", None)  # aiohttp.ClientResponseError
+    if status is None and getattr(exc, "response", None) is not None:
+        status = getattr(exc.response, "status_code", None)  # requests.HTTPError
+    if isinstance(status, int):
+        return status in OVERLOAD_STATUSES or status >= 500
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    requests = sys.modules.get("requests")
+    if requests is not None and isinstance(exc, (requests.Timeout, requests.ConnectionError)):
+        return True
+    aiohttp = sys.modules.get("aiohttp")
+    return aiohttp is not None and isinstance(exc, aiohttp.ClientConnectionError)
+
+
+def is_transient(exc):
+    """熔断打开，或重试（预算）用尽后仍为过载 / 瞬时失败：稍后重试可能成功，接口返回 503 而不是“未找到”"""
+    return isinstance(exc, CircuitOpenError) or is_overload(exc)
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set(name, value=0)
+
+    def before_call(self):
+        """请求前调用：熔断打开时抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+        UPSTREAM_RETRIES.inc(self.name, "circuit_open")
+        raise CircuitOpenError(f"{self.name} 上游熔断中，{self.reset_timeout:g} 秒内不再请求")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != CLOSED:
+                print(f"{self.name} 上游恢复，熔断关闭")
+                self._set_state(CLOSED)
+
+    def cancel_probe(self):
+        """请求被取消（结果未知）时让出半开状态的探测名额"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self, exc):
+        """记录一次失败；只有瞬时失败计入熔断"""
+        with self._lock:
+            self._probing = False
+            if not is_overload(exc):
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    print(f"{self.name} 上游连续失败 {self.failures} 次，熔断 {self.reset_timeout:g} 秒: {exc}")
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def _set_state(self, state):
+        self.state = state
+        CIRCUIT_STATE.set(self.name, value=_STATE_VALUES[state])
+
+    def snapshot(self):
+        with self._lock:
+            return {"platform": self.name, "state": self.state, "failures": self.failures}
+
+
+class RetryBudget:
+    """全局重试令牌桶"""
+
+    def __init__(self, ratio=BUDGET_RATIO, min_per_second=BUDGET_MIN_PER_S, cap=BUDGET_CAP):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.cap = cap
+        self.tokens = cap
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self._updated) * self.min_per_second, self.cap)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill_locked()
+            self.tokens = min(self.tokens + self.ratio, self.cap)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill_locked()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+RETRY_BUDGET = RetryBudget()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(platform):
+    """返回平台对应的共享熔断器"""
+    breaker = _breakers.get(platform)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(platform)
+            if breaker is None:
+                breaker = _breakers[platform] = CircuitBreaker(platform)
+    return breaker
+
+
+def _backoff(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def _should_retry(platform, exc, attempt):
+    if attempt + 1 >= MAX_ATTEMPTS or not is_overload(exc):
+        return False
+    if not RETRY_BUDGET.withdraw():
+        UPSTREAM_RETRIES.inc(platform, "budget_exhausted")
+        return False
+    UPSTREAM_RETRIES.inc(platform, "retried")
+    return True
+
+
+def retry_call(platform, fn, *args):
+    """
+    经平台熔断器调用 fn(*args)，瞬时失败时在重试预算内重试。
+
+    :raises CircuitOpenError: 熔断打开
+    :raises: 最后一次失败的异常
+    """
+    breaker = breaker_for(platform)
+    RETRY_BUDGET.deposit()
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            breaker.record_failure(e)
+            if not _should_retry(platform, e, attempt):
+                raise
+            attempt += 1
+            time.sleep(_backoff(attempt))
+            continue
+        breaker.record_success()
+        return result
+
+
+async def retry_call_async(platform, coro_fn, *args):
+    """retry_call 的协程版本，await coro_fn(*args)"""
+    breaker = breaker_for(platform)
+    RETRY_BUDGET.deposit()
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            result = await coro_fn(*args)
+        except asyncio.CancelledError:
+            breaker.cancel_probe()
+            raise
+        except Exception as e:
+            breaker.record_failure(e)
+            if not _should_retry(platform, e, attempt):
+                raise
+            attempt += 1
+            await asyncio.sleep(_backoff(attempt))
+            continue
+        breaker.record_success()
+        return result
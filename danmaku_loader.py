@@ -1,28 +1,89 @@
 import csv
 import os
 import asyncio
+import importlib
+import threading
+import time
 from pathlib import Path
-from get_tencent_danmu import TencentVideoScraper
-from get_aiqiyi_danmu import AiqiyiVideoScraper
-from get_youkudanmuku import search_videos, get_video_episodes, download_danmu  # 导入优酷相关函数
-from get_mgtv_danmu import MgtvVideoScraper  # 导入阿芒相关类
-from get_bilibili_danmu import BilibiliVideoScraper
+
+from danmu_metrics import instrument_requests
+
+# 启动性能分析开关：DANMU_PROFILE_STARTUP=1 时打印各平台模块导入与爬虫构造耗时
+PROFILE_STARTUP = os.environ.get("DANMU_PROFILE_STARTUP", "") == "1"
+
+# 平台 -> (模块名, 爬虫类名)；模块及其重量级依赖（pandas/bs4/protobuf/aiohttp 等）在首次使用时才导入
+SCRAPER_SPECS = {
+    "tencent": ("get_tencent_danmu", "TencentVideoScraper"),
+    "iqiyi": ("get_aiqiyi_danmu", "AiqiyiVideoScraper"),
+    "bilibili": ("get_bilibili_danmu", "BilibiliVideoScraper"),
+    "mgtv": ("get_mgtv_danmu", "MgtvVideoScraper"),
+}
+YOUKU_MODULE = "get_youkudanmuku"
+
+_scrapers = {}
+_scraper_lock = threading.Lock()
+
+
+def _import_module(module_name):
+    """导入平台模块（同时为 requests 装上上游指标埋点），开启启动分析时记录耗时"""
+    start = time.perf_counter()
+    instrument_requests()
+    module = importlib.import_module(module_name)
+    if PROFILE_STARTUP:
+        print(f"[startup] 导入 {module_name} 耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+    return module
+
+
+def get_scraper(platform, base_dir="danmu_data"):
+    """按需导入并构造指定平台的爬虫，同一进程内复用同一实例"""
+    scraper = _scrapers.get(platform)
+    if scraper is not None:
+        return scraper
+    with _scraper_lock:
+        scraper = _scrapers.get(platform)
+        if scraper is None:
+            module_name, class_name = SCRAPER_SPECS[platform]
+            scraper_class = getattr(_import_module(module_name), class_name)
+            start = time.perf_counter()
+            scraper = scraper_class(base_dir=base_dir)
+            if PROFILE_STARTUP:
+                print(f"[startup] 构造 {class_name} 耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+            _scrapers[platform] = scraper
+    return scraper
+
+
+def get_youku():
+    """按需导入优酷模块（提供 search_videos / get_video_episodes / download_danmu / download_episode）"""
+    return _import_module(YOUKU_MODULE)
+
 
 class DanmakuLoader:
     def __init__(self):
         os.makedirs("danmu_data", exist_ok=True)
         
-        # 初始化不同平台的爬虫
-        self.tencent_scraper = TencentVideoScraper(base_dir="danmu_data")
-        self.aiqiyi_scraper = AiqiyiVideoScraper(base_dir="danmu_data")
-        self.bilibili_scraper = BilibiliVideoScraper(base_dir="danmu_data")  # 添加B站爬虫
-        self.mgtv_scraper = MgtvVideoScraper(base_dir="danmu_data")
-        
         self.current_source = "企鹅"  # 默认源
         self.current_video_data = None
+        self.current_video_index = None  # 爱奇艺搜索结果索引
         self.current_youku_search_result = None
         self.current_mgtv_search_result = None  # 存储阿芒搜索结果
 
+    # 不同平台的爬虫在首次访问时才初始化
+    @property
+    def tencent_scraper(self):
+        return get_scraper("tencent")
+
+    @property
+    def aiqiyi_scraper(self):
+        return get_scraper("iqiyi")
+
+    @property
+    def bilibili_scraper(self):
+        return get_scraper("bilibili")
+
+    @property
+    def mgtv_scraper(self):
+        return get_scraper("mgtv")
+
     def setSource(self, source):
         """设置当前视频源"""
         self.current_source = source
@@ -38,6 +99,7 @@ class DanmakuLoader:
             elif self.current_source == "奇异":
                 video_list, data = self.aiqiyi_scraper.get_video_list(query)
                 self.current_video_data = data
+                self.current_video_index = self.aiqiyi_scraper.build_index(data)
                 return video_list, None
             elif self.current_source == "阿B":  # 添加B站支持
                 video_list, data = self.bilibili_scraper.get_video_list(query)
@@ -47,7 +109,7 @@ class DanmakuLoader:
                 # 为异步函数创建事件循环并运行
                 loop = asyncio.new_event_loop()
                 asyncio.set_event_loop(loop)
-                videos, search_result = loop.run_until_complete(search_videos(query))
+                videos, search_result = loop.run_until_complete(get_youku().search_videos(query))
                 loop.close()
                 self.current_youku_search_result = search_result
                 video_list = [{
@@ -72,7 +134,7 @@ class DanmakuLoader:
                 return episode_list
             elif self.current_source == "奇异":
                 # 爱奇艺API更新，支持获取集数列表
-                result = self.aiqiyi_scraper.get_video_info(self.current_video_data, video_id)
+                result = self.aiqiyi_scraper.get_video_info(self.current_video_index, video_id)
                 
                 # 结果可能是单集信息或集数列表
                 if isinstance(result, list):
@@ -97,38 +159,13 @@ class DanmakuLoader:
                     }]
                     return formatted_episodes
                 else:
-                    # 尝试深度搜索集数
-                    formatted_episodes = []
-                    if self.current_video_data and 'data' in self.current_video_data:
-                        for template in self.current_video_data.get('data', {}).get('templates', []):
-                            if 'albumInfo' in template and str(template['albumInfo'].get('qipuId', '')) == str(video_id):
-                                # 获取videos数组
-                                videos = template['albumInfo'].get('videos', [])
-                                for video in videos:
-                                    # 提取每集信息
-                                    play_url = ""
-                                    if video.get('playUrl'):
-                                        parts = video.get('playUrl').split(';')
-                                        if parts and '=' in parts[0]:
-                                            play_url = parts[0].split('=')[1]
-                                    
-                                    formatted_episodes.append({
-                                        'title': video.get('title', '未命名'),
-                                        'playUrl': play_url,
-                                        'duration': video.get('duration', 0),
-                                        'qipuId': video.get('qipuId', '')
-                                    })
-                    
-                    if formatted_episodes:
-                        return formatted_episodes
-                    else:
-                        # 如果还是没找到集数，至少返回当前视频
-                        print(f"没有找到集数列表，使用当前视频作为单集")
-                        return [{
-                            'title': '第1集',
-                            'playUrl': video_id,  # 使用video_id作为播放URL
-                            'duration': 0
-                        }]
+                    # 如果没找到集数，至少返回当前视频
+                    print(f"没有找到集数列表，使用当前视频作为单集")
+                    return [{
+                        'title': '第1集',
+                        'playUrl': video_id,  # 使用video_id作为播放URL
+                        'duration': 0
+                    }]
             elif self.current_source == "阿B":
                 episode_list = self.bilibili_scraper.get_video_info(self.current_video_data, video_id)
                 formatted_episodes = [{
@@ -141,7 +178,7 @@ class DanmakuLoader:
                 # 为异步函数创建事件循环并运行
                 loop = asyncio.new_event_loop()
                 asyncio.set_event_loop(loop)
-                episodes = loop.run_until_complete(get_video_episodes(self.current_youku_search_result, video_id))
+                episodes = loop.run_until_complete(get_youku().get_video_episodes(self.current_youku_search_result, video_id))
                 loop.close()
                 formatted_episodes = [{
                     'title': episode['Title'],
@@ -174,39 +211,11 @@ class DanmakuLoader:
                 # 爱奇艺弹幕获取，需要视频id和时长
                 duration = None
                 
-                # 尝试查找对应的视频信息，从视频列表中找到匹配的视频
-                if self.current_video_data:
-                    for template in self.current_video_data.get('data', {}).get('templates', []):
-                        if 'albumInfo' in template:
-                            album_info = template['albumInfo']
-                            # 检查videos列表中的每个视频
-                            for video in album_info.get('videos', []):
-                                # 检查playUrl中是否包含当前vid
-                                play_url = video.get('playUrl', '')
-                                if play_url and vid in play_url:
-                                    duration = video.get('duration', 0)
-                                    print(f"找到匹配的视频，duration = {duration}")
-                                    break
-                                    
-                                # 或者直接比较qipuId
-                                video_id = video.get('qipuId', '')
-                                if str(video_id) == str(vid):
-                                    duration = video.get('duration', 0)
-                                    print(f"通过qipuId找到视频，duration = {duration}")
-                                    break
-                                
-                                # 从playUrl提取tvid参数
-                                if play_url:
-                                    try:
-                                        for part in play_url.split(';'):
-                                            if part.startswith('tvid='):
-                                                tvid = part.split('=')[1]
-                                                if str(tvid) == str(vid):
-                                                    duration = video.get('duration', 0)
-                                                    print(f"从tvid参数找到视频，duration = {duration}")
-                                                    break
-                                    except Exception as e:
-                                        print(f"解析playUrl失败: {e}")
+                # 通过搜索结果索引按 qipuId / playUrl / tvid 直接查找时长
+                if self.current_video_index:
+                    duration = self.current_video_index.get_duration(vid)
+                    if duration:
+                        print(f"找到匹配的视频，duration = {duration}")
                 
                 if not duration:
                     # 默认时长，确保能获取完整弹幕
@@ -223,16 +232,8 @@ class DanmakuLoader:
                 # 为异步函数创建事件循环并运行
                 loop = asyncio.new_event_loop()
                 asyncio.set_event_loop(loop)
-                danmus = loop.run_until_complete(download_danmu(vid, title or "阿酷"))
+                filepath = loop.run_until_complete(get_youku().download_danmu(vid, title or "阿酷"))
                 loop.close()
-                
-                if danmus:
-                    # 查找最新的弹幕文件
-                    base_dir = "danmu_data/youku"
-                    files = [f for f in os.listdir(base_dir) if f.endswith('.csv')]
-                    if files:
-                        latest_file = max(files, key=lambda x: os.path.getmtime(os.path.join(base_dir, x)))
-                        filepath = os.path.join(base_dir, latest_file)
             elif self.current_source == "阿芒":
                 # 获取当前视频标题
                 title = title or "阿芒视频"
@@ -0,0 +1,704 @@
+"""
+弹幕搜索 / 集数 / 下载的业务逻辑。
+
+所有入口均为协程：阻塞型爬虫通过 run_blocking 放到线程池执行，优酷等 aiohttp 实现直接 await。
+Flask 路由经 async_runtime.run_coro 调用，异步服务模式（async_app.py）中直接 await。
+"""
+import asyncio
+import io
+import os
+import traceback
+
+from async_runtime import run_blocking, submit_blocking
+from circuit_breaker import is_transient
+from danmaku_loader import get_scraper, get_youku
+from danmu_duration import DURATIONS
+from danmu_negative import NEGATIVE_CACHE, EpisodeUnavailableError, capture
+from danmu_records import read_danmu_csv
+from danmu_store import DANMU_STORE
+from danmu_metrics import CACHE_REQUESTS, DOWNLOAD_SEGMENTS, EPISODE_COMMENTS, SCRAPES_IN_FLIGHT, source_label
+from danmu_tracing import current_span, span
+import danmu_heatmap
+import danmu_search_index
+from response_utils import BodyCache, build_json_response, build_cached_json_response, file_version
+
+# 预序列化（及压缩）的弹幕响应体缓存，键为 (格式, ...剧集标识)，数据版本变化时自动失效
+RESPONSE_BODY_CACHE = BodyCache(max_bytes=int(os.environ.get("DANMU_BODY_CACHE_MB", "64")) * 1024 * 1024)
+
+
+def _schedule_search_index(source, danmaku_id, entry):
+    """弹幕写入本地存储后在后台建立检索索引"""
+    def build():
+        try:
+            danmu_search_index.build_index(source, danmaku_id, entry["path"])
+        except Exception as e:
+            print(f"建立弹幕检索索引失败: {source} {danmaku_id}: {e}")
+    submit_blocking(build)
+
+
+DANMU_STORE.add_listener(_schedule_search_index)
+
+# 正在抓取的剧集：(弹幕源, 弹幕ID) -> (Future, 进度回调列表)，同一集的并发请求共用一次抓取
+_inflight = {}
+
+
+class UnsupportedSourceError(ValueError):
+    """不支持的弹幕源"""
+
+
+async def scraper(platform):
+    """获取平台爬虫（首次使用时的模块导入与构造放到线程池执行）"""
+    return await run_blocking(get_scraper, platform)
+
+
+async def call_scraper(platform, method, *args):
+    """在线程池中调用平台爬虫的阻塞方法"""
+    with span(f"{platform}.{method}"):
+        return await run_blocking(getattr(await scraper(platform), method), *args)
+
+
+async def youku():
+    """获取优酷模块（首次使用时的模块导入放到线程池执行）"""
+    return await run_blocking(get_youku)
+
+
+async def search(source, keyword):
+    """搜索视频，返回响应数据"""
+    if not keyword:
+        return {"code": 400, "message": "请提供搜索关键词"}
+
+    try:
+        if source == "企鹅":
+            video_list = await call_scraper("tencent", "get_video_list", keyword)
+            return {
+                "code": 200,
+                "videos": [{"id": v["id"], "title": v["title"]} for v in video_list]
+            }
+        elif source == "奇异":
+            video_list, _ = await call_scraper("iqiyi", "get_video_list", keyword)
+            return {
+                "code": 200,
+                "videos": [{"id": v["qipuId"], "title": v["title"]} for v in video_list]
+            }
+        elif source == "阿B":
+            video_list, _ = await call_scraper("bilibili", "get_video_list", keyword)
+            return {
+                "code": 200,
+                "videos": [{"id": v["id"], "title": v["title"]} for v in video_list]
+            }
+        elif source == "阿酷":
+            videos, _ = await (await youku()).search_videos(keyword)
+            return {
+                "code": 200,
+                "videos": [{"id": v["vid"], "title": v["title"]} for v in videos]
+            }
+        elif source == "阿芒":
+            videos, _ = await call_scraper("mgtv", "get_video_list", keyword)
+            return {
+                "code": 200,
+                "videos": [{"id": v["vid"], "title": v["title"]} for v in videos]
+            }
+        else:
+            return {"code": 400, "message": f"不支持的弹幕源: {source}"}
+    except Exception as e:
+        print(f"搜索弹幕失败: {str(e)}")
+        print(traceback.format_exc())
+        return {"code": 500, "message": f"搜索弹幕失败: {str(e)}"}
+
+
+async def episodes(source, video_id, keyword):
+    """获取集数列表，返回响应数据"""
+    if not video_id:
+        return {"code": 400, "message": "请提供视频ID"}
+
+    try:
+        if source == "企鹅":
+            episode_list = await call_scraper("tencent", "get_video_info", video_id)
+            return {
+                "code": 200,
+                "episodes": [{"id": episode["vid"], "title": episode["playTitle"]} for episode in episode_list]
+            }
+        elif source == "奇异":
+            return await _aiqiyi_episodes(video_id, keyword)
+        elif source == "阿B":
+            return await _bilibili_episodes(video_id, keyword)
+        elif source == "阿酷":
+            return await _youku_episodes(video_id, keyword)
+        elif source == "阿芒":
+            return await _mgtv_episodes(video_id, keyword)
+        else:
+            return {"code": 400, "message": f"不支持的弹幕源: {source}"}
+    except Exception as e:
+        print(f"获取集数失败: {str(e)}")
+        print(traceback.format_exc())
+        return {"code": 500, "message": f"获取集数失败: {str(e)}"}
+
+
+async def _aiqiyi_episodes(video_id, keyword):
+    # 对于爱奇艺，需要调用另一个API方法
+    try:
+        # 先使用传入的keyword或video_id进行搜索
+        search_term = keyword if keyword else video_id
+        print(f"爱奇艺弹幕搜索关键词: {search_term}")
+
+        aiqiyi_scraper = await scraper("iqiyi")
+        video_list, data = await run_blocking(aiqiyi_scraper.get_video_list, search_term)
+        if not video_list:
+            return {"code": 404, "message": "未找到视频信息"}
+
+        # 一次性建立搜索结果索引，后续按ID查找均为O(1)
+        index = aiqiyi_scraper.build_index(data)
+
+        # 尝试匹配视频ID
+        matched_id = str(video_id)
+        if matched_id not in index.albums and matched_id not in index.videos:
+            print(f"未找到匹配的爱奇艺视频ID: {video_id}")
+            # 如果找不到匹配的视频，使用第一个
+            matched_id = str(video_list[0]["qipuId"])
+            print(f"使用第一个视频: {video_list[0]['title']} (ID: {matched_id})")
+
+        # 获取视频集数信息
+        video_info = aiqiyi_scraper.get_video_info(index, matched_id)
+
+        # 检查返回结果类型
+        if isinstance(video_info, list):
+            # 如果返回的是集数列表，提取每集信息
+            episode_list = []
+            for episode in video_info:
+                if 'playUrl' in episode and episode['playUrl']:
+                    episode_list.append({
+                        "id": episode["playUrl"],
+                        "title": episode["title"],
+                        "qipuId": episode.get("qipuId", "")
+                    })
+
+            if not episode_list:
+                return {"code": 404, "message": "未找到集数信息"}
+
+            print(f"找到 {len(episode_list)} 个集数")
+            return {"code": 200, "episodes": episode_list}
+
+        elif video_info:  # 单个视频情况
+            return {
+                "code": 200,
+                "episodes": [{
+                    "id": video_info["playUrl"],
+                    "title": video_info["title"]
+                }]
+            }
+        else:
+            return {"code": 404, "message": "未找到集数信息"}
+    except Exception as e:
+        print(f"获取爱奇艺集数失败: {str(e)}")
+        print(traceback.format_exc())
+        return {"code": 500, "message": f"获取集数失败: {str(e)}"}
+
+
+async def _bilibili_episodes(video_id, keyword):
+    # 对于B站，需要先获取视频数据
+    try:
+        # 使用关键词或视频ID进行搜索
+        search_keyword = keyword if keyword else video_id
+        print(f"使用关键词搜索B站视频: {search_keyword}")
+
+        # 先用关键词搜索获取视频列表和数据
+        bilibili_scraper = await scraper("bilibili")
+        videos, data = await run_blocking(bilibili_scraper.get_video_list, search_keyword)
+
+        if not videos:
+            print(f"未找到与关键词匹配的视频: {search_keyword}")
+            return {"code": 404, "message": "未找到视频信息"}
+
+        # 然后使用视频ID获取集数信息
+        print(f"使用视频ID获取集数列表: {video_id}")
+        episode_list = bilibili_scraper.get_video_info(data, video_id)
+
+        if not episode_list:
+            print(f"找到视频但未找到集数信息，ID: {video_id}")
+            return {"code": 200, "episodes": []}
+
+        # 返回集数列表
+        return {
+            "code": 200,
+            "episodes": [{"id": episode["playUrl"], "title": episode["title"]} for episode in episode_list]
+        }
+    except Exception as e:
+        print(f"获取B站集数失败: {str(e)}")
+        print(traceback.format_exc())
+        return {"code": 500, "message": f"获取集数失败: {str(e)}"}
+
+
+async def _youku_episodes(video_id, keyword):
+    try:
+        # 使用关键词进行搜索
+        search_term = keyword if keyword else video_id
+        print(f"使用关键词搜索优酷视频: {search_term}")
+
+        youku_module = await youku()
+
+        # 先进行搜索获取search_result
+        videos, search_result = await youku_module.search_videos(search_term)
+
+        if not videos:
+            print(f"未找到与关键词匹配的优酷视频: {search_term}")
+            return {"code": 404, "message": "未找到视频信息"}
+
+        # 查找匹配视频ID的视频标题
+        video_title = None
+        for video in videos:
+            # 尝试完全匹配视频ID
+            if video["vid"] == video_id:
+                video_title = video["title"]
+                print(f"找到精确匹配的优酷视频: {video_title}")
+                break
+
+        # 如果找不到精确匹配，默认使用第一个视频的标题
+        if not video_title:
+            video_title = videos[0]["title"]
+            print(f"未找到精确匹配，使用第一个视频: {video_title}")
+
+        # 使用标题来获取集数
+        print(f"使用标题 '{video_title}' 获取集数")
+        episode_list = await youku_module.get_video_episodes(search_result, video_title)
+
+        if not episode_list:
+            print(f"未找到 '{video_title}' 的集数信息")
+            return {"code": 404, "message": "未找到集数信息"}
+
+        print(f"找到 {len(episode_list)} 个集数")
+        return {
+            "code": 200,
+            "episodes": [{"id": episode["vid"], "title": episode["Title"]} for episode in episode_list]
+        }
+    except Exception as e:
+        print(f"获取优酷集数失败: {str(e)}")
+        print(traceback.format_exc())
+        return {"code": 500, "message": f"获取集数失败: {str(e)}"}
+
+
+async def _mgtv_episodes(video_id, keyword):
+    # 对于芒果TV，需要先获取视频信息
+    try:
+        # 使用关键词或视频ID进行搜索
+        search_term = keyword if keyword else video_id
+        print(f"使用关键词搜索芒果TV视频: {search_term}")
+
+        mgtv_scraper = await scraper("mgtv")
+        videos, search_result = await run_blocking(mgtv_scraper.get_video_list, search_term)
+
+        if not videos:
+            print(f"未找到芒果TV视频: {search_term}")
+            return {"code": 404, "message": "未找到视频信息"}
+
+        # 查找匹配的视频ID
+        matched_video = None
+        for v in videos:
+            if v["vid"] == video_id:
+                matched_video = v
+                break
+
+        if not matched_video:
+            # 如果找不到匹配的视频，使用第一个
+            matched_video = videos[0]
+
+        # 可能需要请求更多分页，放到线程池执行
+        episode_list = await run_blocking(mgtv_scraper.get_video_info, search_result, matched_video["vid"])
+
+        if not episode_list:
+            print(f"找到视频但未找到集数信息，ID: {matched_video['vid']}")
+            return {"code": 200, "episodes": []}
+
+        return {
+            "code": 200,
+            "episodes": [{"id": episode["url"], "title": episode["title"]} for episode in episode_list]
+        }
+    except Exception as e:
+        print(f"获取芒果TV集数失败: {str(e)}")
+        print(traceback.format_exc())
+        return {"code": 500, "message": f"获取集数失败: {str(e)}"}
+
+
+async def fetch_danmaku_episode(source, danmaku_id, keyword, progress=None):
+    """
+    从上游抓取一集弹幕到内存。
+
+    :param progress: 可选的分段进度回调 progress(done, total)，在爬虫线程中调用
+    :return: EpisodeDanmu（见 danmu_records，尚未写入 CSV），未获取到弹幕时返回 None
+    :raises UnsupportedSourceError: 不支持的弹幕源
+    """
+    # 使用关键词或ID作为标题基础
+    title_base = keyword if keyword else danmaku_id
+
+    if source == "企鹅":
+        return await run_blocking((await scraper("tencent")).fetch_episode, danmaku_id, progress=progress)
+    elif source == "奇异":
+        # 爱奇艺弹幕获取，需要视频id和时长
+        aiqiyi_scraper = await scraper("iqiyi")
+        duration = DURATIONS.get("iqiyi", danmaku_id)
+
+        # 没有缓存的时长时先尝试通过API搜索获取；仍取不到时由爬虫按分段探测
+        if duration is None and keyword:
+            try:
+                print(f"搜索爱奇艺视频: {keyword}")
+                with span("iqiyi.get_video_list", keyword=keyword):
+                    _, data = await run_blocking(aiqiyi_scraper.get_video_list, keyword)
+
+                # 通过索引按 qipuId / playUrl / tvid 直接查找时长
+                with span("iqiyi.duration_lookup") as lookup_span:
+                    duration = aiqiyi_scraper.build_index(data).get_duration(danmaku_id)
+                    lookup_span.set_attribute("duration_ms", duration or 0)
+                print(f"爱奇艺视频时长: {duration}")
+            except Exception as e:
+                print(f"搜索爱奇艺视频信息失败: {e}")
+
+        print(f"获取爱奇艺弹幕: ID={danmaku_id}, 时长={duration}")
+        with span("iqiyi.fetch_episode", duration_ms=duration or 0):
+            return await run_blocking(aiqiyi_scraper.fetch_episode, danmaku_id, duration, progress)
+    elif source == "阿B":
+        return await call_scraper("bilibili", "fetch_episode", danmaku_id, title_base, progress)
+    elif source == "阿酷":
+        return await (await youku()).download_episode(danmaku_id, title_base, progress)
+    elif source == "阿芒":
+        return await call_scraper("mgtv", "fetch_episode", danmaku_id, title_base, progress)
+    raise UnsupportedSourceError(f"不支持的弹幕源: {source}")
+
+
+class FetchedDanmaku:
+    """
+    get_danmaku 的结果：本地存储中的 CSV（filepath），或刚从上游抓取、仍在后台写入 CSV 的内存弹幕（episode）。
+    两者都为 None 表示未获取到弹幕。
+    """
+
+    def __init__(self, filepath=None, episode=None, saving=None):
+        self.filepath = filepath
+        self.episode = episode
+        self._saving = saving
+
+    async def file(self):
+        """CSV 路径（刚抓取时等待后台写入完成），没有弹幕或写入失败时返回 None"""
+        if self._saving is not None:
+            return await asyncio.shield(self._saving)
+        return self.filepath
+
+
+def transient_payload(e):
+    """熔断或重试用尽后的瞬时失败（见 circuit_breaker.is_transient）的响应数据，稍后重试可能成功"""
+    return {"code": 503, "message": f"上游暂时不可用，请稍后重试: {e}"}
+
+
+async def get_danmaku(source, danmaku_id, keyword, progress=None, refresh=False):
+    """
+    获取一集弹幕：优先使用本地存储中仍在有效期内的文件，否则从上游抓取。
+
+    抓取得到的弹幕直接以内存结果返回，CSV 写入与本地存储记录在后台线程中进行，不占用响应时间；
+    写入完成前同一集的其他请求共用这份内存结果。
+    同一集正在抓取时（如后台预取任务）直接等待该次抓取完成，不会重复请求上游。
+    爬虫确定该集没有弹幕或ID无法解析时记录到负缓存（见 danmu_negative），有效期内直接抛出，不再请求上游。
+
+    :param refresh: 为 True 时忽略本地存储与负缓存，强制重新抓取
+    :return: FetchedDanmaku
+    :raises EpisodeUnavailableError: 该集没有弹幕或ID无法解析
+    :raises: 熔断或重试用尽后的瞬时失败（见 circuit_breaker.is_transient）
+    """
+    key = (source, danmaku_id)
+    if not refresh:
+        filepath = DANMU_STORE.lookup(source, danmaku_id)
+        if filepath:
+            CACHE_REQUESTS.inc("store", "hit")
+            current_span().set_attribute("store", "hit")
+            if progress:
+                progress(1, 1)
+            return FetchedDanmaku(filepath=filepath)
+        negative = NEGATIVE_CACHE.get(source, danmaku_id)
+        if negative is not None:
+            CACHE_REQUESTS.inc("negative", "hit")
+            current_span().set_attribute("store", "negative")
+            raise negative
+
+    inflight = _inflight.get(key)
+    if inflight is not None:
+        CACHE_REQUESTS.inc("store", "shared")
+        current_span().set_attribute("store", "shared")
+        future, listeners = inflight
+        if progress:
+            if future.done():
+                progress(1, 1)
+            else:
+                listeners.append(progress)
+        return await asyncio.shield(future)
+
+    CACHE_REQUESTS.inc("store", "miss")
+    current_span().set_attribute("store", "miss")
+    future = asyncio.get_running_loop().create_future()
+    listeners = [progress] if progress else []
+    _inflight[key] = (future, listeners)
+    segments = 0
+    saving = None
+
+    def report(done, total):
+        nonlocal segments
+        segments += 1
+        for listener in list(listeners):
+            listener(done, total)
+
+    label = source_label(source)
+    SCRAPES_IN_FLIGHT.inc(label)
+    try:
+        with span("danmaku.fetch", source=source, danmaku_id=danmaku_id) as fetch_span, capture() as outcome:
+            episode = await fetch_danmaku_episode(source, danmaku_id, keyword, progress=report)
+            fetch_span.set_attribute("segments", segments)
+        if episode is None and outcome.reason is not None:
+            fetch_span.set_attribute("negative", outcome.reason)
+            raise NEGATIVE_CACHE.put(source, danmaku_id, outcome.reason, outcome.message)
+        if episode is not None:
+            # CSV 写入完成（并记录到本地存储）前同一集的请求继续共用这份内存结果
+            saving = asyncio.ensure_future(run_blocking(_persist, source, danmaku_id, episode, segments))
+            saving.add_done_callback(lambda _: _inflight.pop(key, None))
+        fetched = FetchedDanmaku(episode=episode, saving=saving)
+        future.set_result(fetched)
+        return fetched
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # 没有其他等待者时避免 "exception was never retrieved" 警告
+        future.exception()
+        raise
+    finally:
+        SCRAPES_IN_FLIGHT.dec(label)
+        if saving is None:
+            del _inflight[key]
+
+
+async def get_danmaku_file(source, danmaku_id, keyword, progress=None, refresh=False):
+    """
+    与 get_danmaku 相同，但返回本地 CSV 路径（刚抓取时等待后台写入完成），供热度图、检索、任务与增量刷新使用。
+
+    :return: CSV 文件路径，未获取到弹幕时返回 None
+    :raises EpisodeUnavailableError: 该集没有弹幕或ID无法解析
+    """
+    fetched = await get_danmaku(source, danmaku_id, keyword, progress, refresh)
+    return await fetched.file()
+
+
+def _persist(source, danmaku_id, episode, segments):
+    """后台写入刚抓取的弹幕 CSV 并记录到本地存储，返回文件路径（失败时返回 None）"""
+    try:
+        with span("csv.write_episode", comments=episode.count):
+            filepath = episode.save()
+        if filepath:
+            _record_fetch(source, danmaku_id, filepath, segments, episode.count, episode.version)
+            NEGATIVE_CACHE.discard(source, danmaku_id)
+        return filepath
+    except Exception as e:
+        print(f"保存弹幕文件失败: {source} {danmaku_id}: {e}")
+        print(traceback.format_exc())
+        return None
+
+
+def _record_fetch(source, danmaku_id, filepath, segments, comments, version):
+    """把一次成功抓取（及其数据版本）记录到本地存储，并记录分段数与弹幕条数指标"""
+    with span("store.record") as record_span:
+        DANMU_STORE.record(source, danmaku_id, filepath, version=version)
+        record_span.set_attribute("comments", comments)
+    label = source_label(source)
+    DOWNLOAD_SEGMENTS.observe(segments, label)
+    EPISODE_COMMENTS.observe(comments, label)
+
+
+async def download(source, danmaku_id, keyword, request_headers, refresh=False):
+    """
+    下载一集弹幕并构造标准化 JSON 响应（支持压缩、ETag/304 与预序列化缓存）。
+
+    :param refresh: 为 True 时忽略本地存储，强制重新抓取
+    :return: (status, headers, body)
+    """
+    if not danmaku_id:
+        return build_json_response({"code": 400, "message": "请提供弹幕ID"}, request_headers)
+
+    try:
+        try:
+            fetched = await get_danmaku(source, danmaku_id, keyword, refresh=refresh)
+        except UnsupportedSourceError as e:
+            return build_json_response({"code": 400, "message": str(e)}, request_headers)
+        except EpisodeUnavailableError as e:
+            return build_json_response(e.to_payload(), request_headers)
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            return build_json_response(transient_payload(e), request_headers)
+
+        # 刚抓取的弹幕直接由内存中的记录构造响应，不等待 CSV 写入
+        if fetched.episode is not None:
+            return await run_blocking(build_episode_response, fetched.episode, source, danmaku_id, request_headers)
+
+        filepath = fetched.filepath
+        if not filepath or not os.path.exists(filepath):
+            return build_json_response({"code": 404, "message": "未找到弹幕数据"}, request_headers)
+
+        # 读取弹幕数据
+        try:
+            return await run_blocking(build_download_response, filepath, source, danmaku_id, request_headers)
+        except Exception as e:
+            print(f"读取弹幕数据失败: {str(e)}")
+            print(traceback.format_exc())
+            return build_json_response({"code": 500, "message": f"读取弹幕数据失败: {str(e)}"}, request_headers)
+    except Exception as e:
+        print(f"下载弹幕失败: {str(e)}")
+        print(traceback.format_exc())
+        return build_json_response({"code": 500, "message": f"下载弹幕失败: {str(e)}"}, request_headers)
+
+
+async def heatmap(source, danmaku_id, keyword, resolution, request_headers):
+    """
+    返回一集弹幕每个时间桶的条数（热度图），本地没有该集时先抓取。
+
+    :param resolution: 时间桶长度（秒）
+    :return: (status, headers, body)
+    """
+    if not danmaku_id:
+        return build_json_response({"code": 400, "message": "请提供弹幕ID"}, request_headers)
+    if not danmu_heatmap.MIN_RESOLUTION <= resolution <= danmu_heatmap.MAX_RESOLUTION:
+        return build_json_response({"code": 400, "message": f"resolution 需在 {danmu_heatmap.MIN_RESOLUTION}-{danmu_heatmap.MAX_RESOLUTION} 秒之间"}, request_headers)
+
+    try:
+        try:
+            filepath = await get_danmaku_file(source, danmaku_id, keyword)
+        except UnsupportedSourceError as e:
+            return build_json_response({"code": 400, "message": str(e)}, request_headers)
+        except EpisodeUnavailableError as e:
+            return build_json_response(e.to_payload(), request_headers)
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            return build_json_response(transient_payload(e), request_headers)
+        if not filepath or not os.path.exists(filepath):
+            return build_json_response({"code": 404, "message": "未找到弹幕数据"}, request_headers)
+        return await run_blocking(_build_heatmap_response, filepath, source, danmaku_id, resolution, request_headers)
+    except Exception as e:
+        print(f"生成弹幕热度图失败: {str(e)}")
+        print(traceback.format_exc())
+        return build_json_response({"code": 500, "message": f"生成弹幕热度图失败: {str(e)}"}, request_headers)
+
+
+def _build_heatmap_response(filepath, source, danmaku_id, resolution, request_headers):
+    version, times = danmu_heatmap.load_times(filepath)
+
+    def build_payload():
+        counts = danmu_heatmap.build_heatmap(times, resolution)
+        return {
+            "code": 200,
+            "resolution": resolution,
+            "counts": counts,
+            "max": max(counts, default=0),
+            "total": int(len(times)),
+        }
+
+    return build_cached_json_response(
+        RESPONSE_BODY_CACHE, ("heatmap", source, danmaku_id, resolution), (filepath, version, resolution), build_payload, request_headers
+    )
+
+
+async def search_in_episode(source, danmaku_id, keyword, query, request_headers):
+    """
+    在一集弹幕中检索关键词，返回命中弹幕的时间；本地没有该集或索引已过期时先抓取 / 建立索引。
+
+    :return: (status, headers, body)
+    """
+    if not danmaku_id:
+        return build_json_response({"code": 400, "message": "请提供弹幕ID"}, request_headers)
+    if not query:
+        return build_json_response({"code": 400, "message": "请提供检索关键词"}, request_headers)
+
+    try:
+        try:
+            filepath = await get_danmaku_file(source, danmaku_id, keyword)
+        except UnsupportedSourceError as e:
+            return build_json_response({"code": 400, "message": str(e)}, request_headers)
+        except EpisodeUnavailableError as e:
+            return build_json_response(e.to_payload(), request_headers)
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            return build_json_response(transient_payload(e), request_headers)
+        if not filepath or not os.path.exists(filepath):
+            return build_json_response({"code": 404, "message": "未找到弹幕数据"}, request_headers)
+
+        if not danmu_search_index.is_current(source, danmaku_id, filepath):
+            await run_blocking(danmu_search_index.build_index, source, danmaku_id, filepath)
+        matches, truncated = await run_blocking(danmu_search_index.search, source, danmaku_id, query)
+        return build_json_response({
+            "code": 200,
+            "query": query,
+            "matches": matches,
+            "count": len(matches),
+            "truncated": truncated
+        }, request_headers)
+    except Exception as e:
+        print(f"检索弹幕失败: {str(e)}")
+        print(traceback.format_exc())
+        return build_json_response({"code": 500, "message": f"检索弹幕失败: {str(e)}"}, request_headers)
+
+
+def data_version(source, danmaku_id, filepath):
+    """
+    本地弹幕的数据版本：抓取写入的文件沿用抓取时的版本（EpisodeDanmu.version，记录在本地存储中），
+    与刚抓取时由内存记录响应的版本相同；其他情况（如增量刷新后）以文件状态为准。
+    """
+    entry = DANMU_STORE.get(source, danmaku_id)
+    if entry is not None and entry["path"] == filepath and "version" in entry:
+        return entry["version"]
+    return file_version(filepath)
+
+
+def build_download_response(filepath, source, danmaku_id, request_headers):
+    """由已保存的弹幕 CSV 构造下载接口的 JSON 响应，返回 (status, headers, body)"""
+    # 304 与预序列化响应体命中时都不读取文件内容
+    version = (source, danmaku_id, data_version(source, danmaku_id, filepath))
+
+    def build_payload():
+        # 读取并清理文件内容
+        with span("csv.read") as read_span, open(filepath, 'rb') as f:
+            content = f.read()
+            # 移除 NUL 字符
+            content = content.replace(b'\x00', b'')
+            read_span.set_attribute("bytes", len(content))
+        with span("csv.parse") as parse_span:
+            danmakus = parse_downloaded_danmakus(content)
+            parse_span.set_attribute("comments", len(danmakus))
+        print(f"成功加载 {len(danmakus)} 条弹幕")
+        return {
+            "code": 200,
+            "danmakus": danmakus,
+            "count": len(danmakus)
+        }
+
+    return build_cached_json_response(RESPONSE_BODY_CACHE, ("download", source, danmaku_id), version, build_payload, request_headers)
+
+
+def build_episode_response(episode, source, danmaku_id, request_headers):
+    """由刚抓取的内存弹幕（EpisodeDanmu）构造下载接口的 JSON 响应，返回 (status, headers, body)"""
+    # 与写入文件后的版本一致（见 data_version），同一份弹幕无论从哪条路径响应 ETag 都相同
+    version = (source, danmaku_id, episode.version)
+
+    def build_payload():
+        with span("records.normalize") as normalize_span:
+            danmakus = episode.danmakus()
+            normalize_span.set_attribute("comments", len(danmakus))
+        print(f"成功获取 {len(danmakus)} 条弹幕")
+        return {
+            "code": 200,
+            "danmakus": danmakus,
+            "count": len(danmakus)
+        }
+
+    return build_cached_json_response(RESPONSE_BODY_CACHE, ("download", source, danmaku_id), version, build_payload, request_headers)
+
+
+def parse_downloaded_danmakus(content):
+    """将已清理 NUL 字符的弹幕 CSV 内容解析为按时间排序的 [{time, text}] 列表（时间单位毫秒，列选择见 danmu_records）"""
+    lines = io.StringIO(content.decode('utf-8', errors='ignore'), newline='')
+    danmakus = [{"time": time_ms, "text": text} for time_ms, text in read_danmu_csv(lines)]
+    danmakus.sort(key=lambda x: x["time"])
+    return danmakus
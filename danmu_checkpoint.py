@@ -0,0 +1,87 @@
+"""
+分段抓取的断点续传。
+
+一集弹幕由几十到上百个分段组成，抓取中途失败（进程重启、上游故障、熔断）时已取得的分段不应作废。
+每个分段成功返回后立即以一行 JSON 追加到 <DANMU_CHECKPOINT_DIR>/<平台>/<视频ID>.jsonl（默认 danmu_data/checkpoints），
+同一集再次抓取时先读出这些分段作为已知结果（见 segment_fetcher 的 known），只请求缺失的分段；
+整集写入 CSV 后删除断点文件。
+
+- 断点文件只追加、每行一个分段，进程在写入中途退出时最后一行不完整，读取时跳过即可；
+- 超过 DANMU_CHECKPOINT_TTL 秒（默认 21600）未更新的断点视为过期并删除，避免用很久以前的分段拼出一集
+  （0 表示永不过期）。
+"""
+import json
+import os
+import re
+import threading
+import time
+
+# 断点目录（DANMU_CHECKPOINT_DIR，默认相对工作目录的 danmu_data/checkpoints）
+CHECKPOINT_DIR = os.environ.get("DANMU_CHECKPOINT_DIR", os.path.join("danmu_data", "checkpoints"))
+CHECKPOINT_TTL = int(os.environ.get("DANMU_CHECKPOINT_TTL", "21600"))
+
+_UNSAFE = re.compile(r'[^0-9A-Za-z_.-]')
+
+
+class SegmentCheckpoint:
+    """一集弹幕的分段断点：{分段序号: 分段结果}，结果需可 JSON 序列化（元组读回后为列表）"""
+
+    def __init__(self, platform, video_id, directory=CHECKPOINT_DIR, ttl=CHECKPOINT_TTL):
+        self.platform = platform
+        self.video_id = str(video_id)
+        self.ttl = ttl
+        self.path = os.path.join(directory, platform, _UNSAFE.sub("_", self.video_id) + ".jsonl")
+        self._lock = threading.Lock()
+        self._discarded = False
+
+    def load(self):
+        """返回已保存的 {分段序号: 结果}；没有断点或断点已过期时返回空字典"""
+        with self._lock:
+            try:
+                if self.ttl and time.time() - os.path.getmtime(self.path) > self.ttl:
+                    os.remove(self.path)
+                    return {}
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    lines = f.readlines()
+            except OSError:
+                return {}
+        segments = {}
+        for line in lines:
+            try:
+                index, result = json.loads(line)
+            except ValueError:
+                continue  # 写入中途退出留下的不完整行
+            segments[index] = result
+        if segments:
+            print(f"{self.platform} 视频 {self.video_id} 从断点恢复 {len(segments)} 个分段")
+        return segments
+
+    def record(self, index, result):
+        """追加一个分段的结果"""
+        self.record_many({index: result})
+
+    def record_many(self, segments):
+        if not segments:
+            return
+        data = "".join(json.dumps([index, result], ensure_ascii=False) + "\n" for index, result in segments.items())
+        with self._lock:
+            if self._discarded:
+                return  # 整集已保存，仍在进行的对冲请求等返回的分段不再重新生成断点
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(data)
+
+    def recording(self, fetch):
+        """包装 fetch(index)：成功返回的分段结果先写入断点再返回"""
+        def fetch_and_record(index):
+            result = fetch(index)
+            self.record(index, result)
+            return result
+        return fetch_and_record
+
+    def discard(self):
+        """整集保存完成后删除断点（之后的 record 不再写入）"""
+        with self._lock:
+            self._discarded = True
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,91 @@
+"""
+弹幕密度控制（按时间桶降采样）。
+
+DPlayer 接口的 max 参数原先直接截取前 N 条，按时间排序的数据只会返回片头部分。
+这里把时间轴划分为固定长度的桶，按桶分配配额：配额由总上限 max 平均分到各桶，
+弹幕稀疏的桶用不完的配额顺延给后面的桶；可另外指定每桶上限。
+
+桶内优先选择内容不同的弹幕（按归一化文本去重），同一批候选按文本哈希排序取样，
+结果对相同输入是确定的（同一请求多次返回相同弹幕，响应可被缓存）。
+整体只需对按时间排序的数据扫描一遍。
+"""
+import os
+import zlib
+
+from danmu_merge import normalize_text
+
+# 默认时间桶长度（秒）
+DENSITY_BUCKET_SECONDS = float(os.environ.get("DANMU_DENSITY_BUCKET", "10"))
+
+
+def _sample_bucket(bucket, quota, text_of):
+    """从一个桶中确定性地选出 quota 条弹幕：先每种文本各一条，不足时再补重复文本；保持时间顺序"""
+    if len(bucket) <= quota:
+        return bucket
+
+    distinct, duplicates, seen = [], [], set()
+    for index, item in enumerate(bucket):
+        key = normalize_text(text_of(item)) or str(text_of(item))
+        rank = (zlib.crc32(f"{key}|{index}".encode("utf-8")), index)
+        if key in seen:
+            duplicates.append(rank)
+        else:
+            seen.add(key)
+            distinct.append(rank)
+
+    distinct.sort()
+    chosen = distinct[:quota]
+    if len(chosen) < quota:
+        duplicates.sort()
+        chosen += duplicates[:quota - len(chosen)]
+    return [bucket[index] for index in sorted(index for _, index in chosen)]
+
+
+def limit_density(items, max_count, bucket_seconds=DENSITY_BUCKET_SECONDS, per_bucket=None,
+                  time_of=lambda item: item[0], text_of=lambda item: item[4]):
+    """
+    对按时间排序的弹幕做密度控制。
+
+    :param items: 弹幕列表，默认为 DPlayer 格式 [time, type, color, author, text]（时间单位秒）
+    :param max_count: 返回的总条数上限
+    :param bucket_seconds: 时间桶长度（秒）
+    :param per_bucket: 每个桶的条数上限，None 表示只受总上限约束
+    :return: 时间有序、均匀分布的弹幕子列表
+    """
+    if not items or max_count <= 0:
+        return []
+    if len(items) <= max_count and not per_bucket:
+        return list(items)
+
+    duration = max(float(time_of(items[-1])), 0.0)
+    bucket_count = int(duration // bucket_seconds) + 1
+    base_quota = max_count / bucket_count
+
+    result = []
+    credit = 0.0  # 前面稀疏桶未用完的配额
+    bucket, current = [], None
+
+    def flush(bucket_index_gap):
+        nonlocal credit
+        # 中间没有弹幕的空桶同样贡献配额
+        credit += base_quota * bucket_index_gap
+        quota = int(credit)
+        if per_bucket:
+            quota = min(quota, per_bucket)
+        quota = min(quota, max_count - len(result))
+        selected = _sample_bucket(bucket, quota, text_of) if quota > 0 else []
+        result.extend(selected)
+        credit -= len(selected)
+
+    previous_index = -1
+    for item in items:
+        index = int(float(time_of(item)) // bucket_seconds)
+        if index != current and bucket:
+            flush(current - previous_index)
+            previous_index = current
+            bucket = []
+        current = index
+        bucket.append(item)
+    if bucket:
+        flush(current - previous_index)
+    return result
@@ -0,0 +1,172 @@
+"""
+视频时长解析与持久化缓存。
+
+弹幕按固定时长分段请求（企鹅 30 秒，奇异 / 阿芒 / 阿酷 60 秒），知道时长才能生成准确的分段计划。
+各平台取时长的方式不同：奇异从搜索结果的模板中查、阿芒请求 video/info、阿酷请求 show.json，
+企鹅没有现成的时长来源。这里统一为：
+
+1. 先查本地缓存（DANMU_DURATION_CACHE_PATH，默认 danmu_data/durations.json，按 平台 + 视频ID 记录）；
+2. 没有时用平台的元数据接口（由调用方提供）；
+3. 元数据也取不到时按分段探测：先按 1、3、7、15… 指数扩大找到第一个没有数据的分段，再在区间内二分，
+   约 2·log2(分段数) 次请求即可确定分段数；探测到的分段结果交还给调用方复用，不会重复请求。
+
+元数据得到的时长长期有效；探测得到的时长（实际是“有弹幕的分段数”）在 DANMU_DURATION_PROBE_TTL 秒后
+（默认一天）重新探测，以免新剧末尾的弹幕尚未出现时被永久截断；探测结果为 0（没有任何分段）时不缓存，
+由负缓存（见 danmu_negative）按较短的有效期处理。
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+# 缓存文件（DANMU_DURATION_CACHE_PATH，默认相对工作目录的 danmu_data/durations.json）
+DURATION_CACHE_PATH = os.environ.get("DANMU_DURATION_CACHE_PATH", os.path.join("danmu_data", "durations.json"))
+PROBE_TTL = int(os.environ.get("DANMU_DURATION_PROBE_TTL", "86400"))
+
+METADATA = "metadata"
+PROBE = "probe"
+
+
+class DurationCache:
+    """(平台, 视频ID) -> {"duration_ms": 时长毫秒, "method": metadata / probe, "resolved_at": 时间} 的持久化缓存"""
+
+    def __init__(self, path=DURATION_CACHE_PATH, probe_ttl=PROBE_TTL):
+        self.path = path
+        self.probe_ttl = probe_ttl
+        self._lock = threading.Lock()
+        self._entries = None
+
+    @staticmethod
+    def _key(platform, video_id):
+        return f"{platform}|{video_id}"
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".json.part")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get(self, platform, video_id):
+        """返回缓存的时长（毫秒），没有或探测结果已过期时返回 None"""
+        with self._lock:
+            entry = self._load().get(self._key(platform, video_id))
+        if entry is None:
+            return None
+        if entry["method"] == PROBE and self.probe_ttl and time.time() - entry["resolved_at"] > self.probe_ttl:
+            return None
+        return entry["duration_ms"]
+
+    def put(self, platform, video_id, duration_ms, method=METADATA):
+        with self._lock:
+            self._load()[self._key(platform, video_id)] = {
+                "duration_ms": int(duration_ms), "method": method, "resolved_at": time.time()
+            }
+            self._save()
+
+    def resolve(self, platform, video_id, metadata=None, probe=None):
+        """
+        依次用缓存、metadata()、probe() 取得时长（毫秒）并缓存，都取不到时返回 None。
+
+        :param metadata: 可选，返回时长毫秒（取不到时返回 None 或抛出异常）
+        :param probe: 可选，按分段探测并返回时长毫秒
+        """
+        duration = self.get(platform, video_id)
+        if duration is not None:
+            return duration
+        if metadata is not None:
+            try:
+                duration = metadata()
+            except Exception as e:
+                print(f"获取 {platform} 视频 {video_id} 的时长失败: {e}")
+                duration = None
+            if duration:
+                self.put(platform, video_id, duration, METADATA)
+                return int(duration)
+        if probe is not None:
+            duration = probe()
+            # 探测不到分段（没有弹幕或请求失败）时不缓存，否则负缓存过期后仍按 0 个分段处理，取不到后来出现的弹幕
+            if duration:
+                self.put(platform, video_id, duration, PROBE)
+            return duration
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+DURATIONS = DurationCache()
+
+
+def _probe_steps(first):
+    """
+    探测顺序生成器：产出待探测的分段序号，调用方 send 回该分段是否有数据；
+    结束时（StopIteration.value）返回从 first 开始连续有数据的分段数。
+    """
+    if not (yield first):
+        return 0
+    low, offset = first, 1
+    while True:
+        high = first + offset
+        if not (yield high):
+            break
+        low, offset = high, offset * 2 + 1
+    while high - low > 1:
+        middle = (low + high) // 2
+        if (yield middle):
+            low = middle
+        else:
+            high = middle
+    return low - first + 1
+
+
+def probe_segments(fetch, has_data, first=0):
+    """
+    指数 + 二分探测分段数。
+
+    :param fetch: fetch(index) -> 分段结果，失败时抛出异常
+    :param has_data: has_data(结果) -> 该分段是否在视频范围内
+    :param first: 第一个分段的序号（奇异从 1 开始）
+    :return: (分段数, {序号: 结果})，结果可直接用于后续的全量抓取
+    """
+    results = {}
+    steps = _probe_steps(first)
+    try:
+        index = next(steps)
+        while True:
+            results[index] = fetch(index)
+            index = steps.send(has_data(results[index]))
+    except StopIteration as done:
+        return done.value, results
+
+
+async def probe_segments_async(fetch, has_data, first=0):
+    """probe_segments 的协程版本，fetch 为协程函数"""
+    results = {}
+    steps = _probe_steps(first)
+    try:
+        index = next(steps)
+        while True:
+            results[index] = await fetch(index)
+            index = steps.send(has_data(results[index]))
+    except StopIteration as done:
+        return done.value, results
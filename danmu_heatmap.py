@@ -0,0 +1,70 @@
+"""
+弹幕热度图（每个时间桶的弹幕条数）。
+
+播放器的“高能时刻”进度条只需要各时间段的弹幕数量。这里只读取 CSV 的时间列，
+转换为排好序的毫秒数组后用 numpy.bincount 向量化分桶；时间数组按文件版本缓存，
+不同分辨率的请求共用同一份数组，响应体由调用方放入预序列化缓存。
+"""
+import threading
+from collections import OrderedDict
+
+from danmu_records import danmu_columns, parse_millis
+from response_utils import file_version
+
+# 允许的分辨率范围（秒）
+MIN_RESOLUTION = 1
+MAX_RESOLUTION = 600
+# 缓存的时间数组个数
+TIMES_CACHE_SIZE = 64
+
+_times_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def _read_times(filepath):
+    import numpy as np
+    import pandas as pd
+
+    # 与下载接口相同的列选择规则（见 danmu_records.danmu_columns）
+    columns = pd.read_csv(filepath, nrows=0, encoding='utf-8-sig').columns
+    time_col = columns[danmu_columns(columns)[0]]
+
+    raw = pd.read_csv(filepath, usecols=[time_col], encoding='utf-8-sig', encoding_errors='ignore')[time_col]
+    times = pd.to_numeric(raw, errors='coerce')
+    if times.isna().any():
+        # 少数平台的时间为 时:分:秒 字符串，逐个转换
+        mask = times.isna() & raw.notna()
+        times[mask] = np.array([parse_millis(v) for v in raw[mask]], dtype=float)
+    return np.sort(times.dropna().to_numpy(dtype=np.int64))
+
+
+def load_times(filepath):
+    """返回 (数据版本, 排好序的弹幕时间数组（毫秒）)，按文件版本缓存"""
+    version = file_version(filepath)
+    key = (filepath, version)
+    with _lock:
+        times = _times_cache.get(key)
+        if times is not None:
+            _times_cache.move_to_end(key)
+            return version, times
+
+    times = _read_times(filepath)
+    with _lock:
+        _times_cache[key] = times
+        while len(_times_cache) > TIMES_CACHE_SIZE:
+            _times_cache.popitem(last=False)
+    return version, times
+
+
+def build_heatmap(times, resolution):
+    """
+    :param times: 排好序的弹幕时间数组（毫秒）
+    :param resolution: 时间桶长度（秒）
+    :return: 每个桶的弹幕条数列表，第 i 个桶覆盖 [i*resolution, (i+1)*resolution) 秒
+    """
+    import numpy as np
+
+    if len(times) == 0:
+        return []
+    buckets = np.clip(times, 0, None) // int(resolution * 1000)
+    return np.bincount(buckets).tolist()
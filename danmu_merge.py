@@ -0,0 +1,113 @@
+"""
+多平台弹幕合并。
+
+同一部剧在企鹅、奇异、阿B 等平台的弹幕直接拼接会出现大量重复，且各平台片头/广告长度不同导致时间轴错位。
+合并分三步：
+1. 时间轴对齐：以弹幕最多的来源为基准，对每个来源的每秒弹幕数直方图做互相关，取相关性最高的偏移量；
+2. 多路归并：各来源已按时间排序，用 heapq.merge 线性归并；
+3. 近似重复抑制：文本归一化（全半角、大小写、标点空白、重复字符）后取哈希，
+   同一哈希在滑动时间窗口内只保留第一条。
+
+除直方图互相关（与弹幕条数无关，只取决于视频时长与最大偏移）外，整体为线性时间，可处理 10 万条以上的弹幕。
+"""
+import functools
+import heapq
+import os
+import re
+import unicodedata
+from collections import deque
+
+# 近似重复判定的时间窗口（秒）
+DEDUP_WINDOW = float(os.environ.get("DANMU_MERGE_WINDOW", "5"))
+# 时间轴对齐允许的最大偏移（秒）
+MAX_ALIGN_OFFSET = int(os.environ.get("DANMU_MERGE_MAX_OFFSET", "90"))
+# 弹幕太少时直方图不可靠，不做对齐
+MIN_ALIGN_COUNT = 50
+
+_IGNORED_CHARS = re.compile(r"[\s\W_]+", re.UNICODE)
+_REPEATED_CHARS = re.compile(r"(.)\1{2,}")
+
+
+@functools.lru_cache(maxsize=65536)
+def normalize_text(text):
+    """归一化弹幕文本：全角转半角、小写、去标点空白，连续重复 3 次以上的字符折叠为 2 个（如 哈哈哈哈 -> 哈哈）"""
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    text = _IGNORED_CHARS.sub("", text)
+    return _REPEATED_CHARS.sub(r"\1\1", text)
+
+
+def _histogram(times, length):
+    counts = [0] * length
+    for t in times:
+        index = int(t)
+        if 0 <= index < length:
+            counts[index] += 1
+    return counts
+
+
+def estimate_offset(reference_times, times, max_offset=MAX_ALIGN_OFFSET):
+    """
+    估计 times 相对 reference_times 的时间偏移（秒）：times 中的弹幕减去该偏移后与基准最吻合。
+
+    两组时间均以秒为单位；弹幕过少时返回 0。
+    """
+    if len(reference_times) < MIN_ALIGN_COUNT or len(times) < MIN_ALIGN_COUNT:
+        return 0
+    import numpy as np
+
+    length = int(max(max(reference_times), max(times))) + 1
+    reference = np.asarray(_histogram(reference_times, length), dtype=float)
+    counts = np.asarray(_histogram(times, length), dtype=float)
+    reference -= reference.mean()
+    counts -= counts.mean()
+
+    best_offset, best_score = 0, None
+    for offset in range(-max_offset, max_offset + 1):
+        # counts[i + offset] 对应 reference[i]
+        if offset >= 0:
+            score = float(np.dot(reference[:length - offset], counts[offset:]))
+        else:
+            score = float(np.dot(reference[-offset:], counts[:length + offset]))
+        if best_score is None or score > best_score:
+            best_offset, best_score = offset, score
+    return best_offset if best_score and best_score > 0 else 0
+
+
+def merge_danmaku(streams, window=DEDUP_WINDOW, align=True):
+    """
+    合并多个来源的弹幕。
+
+    :param streams: {来源名: [(时间秒, 文本), ...]}，每个来源需已按时间升序排列
+    :param window: 近似重复判定窗口（秒），0 表示不去重
+    :param align: 是否按弹幕密度对齐各来源的时间轴
+    :return: (merged, offsets)；merged 为按时间排序的 [(时间秒, 文本, 来源名), ...]，offsets 为各来源采用的偏移
+    """
+    streams = {name: items for name, items in streams.items() if items}
+    offsets = {name: 0 for name in streams}
+    if align and len(streams) > 1:
+        reference_name = max(streams, key=lambda name: len(streams[name]))
+        reference_times = [t for t, _ in streams[reference_name]]
+        for name, items in streams.items():
+            if name != reference_name:
+                offsets[name] = estimate_offset(reference_times, [t for t, _ in items])
+
+    def shifted(name, items):
+        offset = offsets[name]
+        for t, text in items:
+            yield max(0.0, t - offset), text, name
+
+    merged = []
+    recent = deque()  # 窗口内的 (时间, 文本哈希)
+    seen = set()  # 窗口内已保留的文本哈希
+    for t, text, name in heapq.merge(*(shifted(name, items) for name, items in streams.items()), key=lambda item: item[0]):
+        if window > 0:
+            while recent and t - recent[0][0] > window:
+                seen.discard(recent.popleft()[1])
+            # 纯标点/表情的弹幕归一化后为空，按原文判重
+            key = hash(normalize_text(text) or str(text).strip())
+            if key in seen:
+                continue
+            recent.append((t, key))
+            seen.add(key)
+        merged.append((t, text, name))
+    return merged, offsets
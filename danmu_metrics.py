@@ -0,0 +1,235 @@
+"""
+进程内指标，以 Prometheus 文本格式在 /metrics 暴露。
+
+只实现这里用到的三种类型（计数器、仪表、直方图），不依赖 prometheus_client。
+每次记录只是在锁内更新一个字典项，直方图按固定分桶做二分查找，压测时可常开。
+标签值需来自有限集合（接口路由、弹幕源、上游域名），避免时间序列数量无限增长。
+"""
+import bisect
+import threading
+import time
+from urllib.parse import urlsplit
+
+KNOWN_SOURCES = ("企鹅", "奇异", "阿B", "阿酷", "阿芒")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # [各分桶的计数（最后一个为 +Inf）, 总和, 次数]
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_samples(self, items):
+        lines = []
+        bounds = self.buckets + (float("inf"),)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                le = (("le", _format_value(bound)),)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+def render():
+    """返回全部指标的 Prometheus 文本格式"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def source_label(source):
+    """弹幕源标签，未知的取值统一为 other"""
+    return source if source in KNOWN_SOURCES else "other"
+
+
+# ---- 指标定义 ----
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "danmu_http_request_duration_seconds", "HTTP 请求处理耗时", ("endpoint", "source"))
+HTTP_REQUESTS = Counter(
+    "danmu_http_requests_total", "HTTP 请求数", ("endpoint", "source", "status"))
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "danmu_upstream_request_duration_seconds", "上游请求耗时（到收到响应头，requests 为读完响应体）", ("host",))
+UPSTREAM_REQUESTS = Counter(
+    "danmu_upstream_requests_total", "上游请求数，status 为 HTTP 状态码或 error（连接失败等）", ("host", "status"))
+UPSTREAM_BYTES = Counter(
+    "danmu_upstream_response_bytes_total", "上游响应体字节数", ("host",))
+DOWNLOAD_SEGMENTS = Histogram(
+    "danmu_download_segments", "每次抓取一集弹幕请求的分段数", ("source",),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+EPISODE_COMMENTS = Histogram(
+    "danmu_episode_comments", "每次抓取一集得到的弹幕条数", ("source",),
+    buckets=(100, 500, 1000, 5000, 10000, 50000, 100000, 500000))
+CACHE_REQUESTS = Counter(
+    "danmu_cache_requests_total", "缓存查询次数，result 为 hit / miss（store 缓存另有 shared：等待进行中的同集抓取；negative 缓存只记录 hit）",
+    ("cache", "result"))
+SCRAPES_IN_FLIGHT = Gauge(
+    "danmu_scrapes_in_flight", "正在从上游抓取的剧集数", ("source",))
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "danmu_upstream_concurrency_limit", "上游域名当前的自适应并发上限（AIMD）", ("host",))
+UPSTREAM_IN_FLIGHT = Gauge(
+    "danmu_upstream_in_flight", "上游域名正在进行的分段请求数", ("host",))
+CIRCUIT_STATE = Gauge(
+    "danmu_circuit_state", "平台熔断器状态：0 关闭，1 半开，2 打开", ("platform",))
+HEDGED_REQUESTS = Counter(
+    "danmu_hedged_requests_total", "分段对冲请求统计，result 为 fired（已发出）/ won（对冲请求先返回）/ no_budget / no_slot（未发出）",
+    ("host", "result"))
+UPSTREAM_RETRIES = Counter(
+    "danmu_upstream_retries_total", "上游请求重试统计，result 为 retried / budget_exhausted（重试预算用尽）/ circuit_open（熔断拒绝）",
+    ("platform", "result"))
+
+
+# ---- 上游 HTTP 客户端埋点 ----
+
+def record_upstream(url, status, seconds, size=None):
+    host = urlsplit(str(url)).hostname or "unknown"
+    UPSTREAM_REQUESTS.inc(host, str(status))
+    UPSTREAM_REQUEST_SECONDS.observe(seconds, host)
+    if size:
+        UPSTREAM_BYTES.inc(host, amount=size)
+
+
+_requests_instrumented = False
+_instrument_lock = threading.Lock()
+
+
+def instrument_requests():
+    """
+    为 requests 的全部请求（requests.get / Session）记录上游指标。
+
+    requests 没有进程级的钩子，这里包装 Session.send（模块级函数同样经由它发送）；可重复调用。
+    """
+    global _requests_instrumented
+    with _instrument_lock:
+        if _requests_instrumented:
+            return
+        _requests_instrumented = True
+
+    import requests
+
+    original_send = requests.Session.send
+
+    def send(self, request, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = original_send(self, request, **kwargs)
+        except Exception:
+            record_upstream(request.url, "error", time.perf_counter() - started)
+            raise
+        # 非流式请求在 send 中已读完响应体
+        size = len(response.content) if not kwargs.get("stream") else int(response.headers.get("Content-Length") or 0)
+        record_upstream(request.url, response.status_code, time.perf_counter() - started, size)
+        return response
+
+    requests.Session.send = send
+
+
+_trace_configs = None
+
+
+def aiohttp_trace_configs():
+    """返回记录上游指标的 aiohttp TraceConfig 列表，创建 ClientSession 时传入 trace_configs"""
+    global _trace_configs
+    if _trace_configs is None:
+        import aiohttp
+
+        async def on_request_start(session, context, params):
+            context.started = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            record_upstream(params.url, params.response.status, time.perf_counter() - context.started)
+
+        async def on_request_exception(session, context, params):
+            record_upstream(params.url, "error", time.perf_counter() - context.started)
+
+        async def on_chunk(session, context, params):
+            UPSTREAM_BYTES.inc(params.url.host or "unknown", amount=len(params.chunk))
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_response_chunk_received.append(on_chunk)
+        trace_config.freeze()
+        _trace_configs = [trace_config]
+    return _trace_configs
@@ -0,0 +1,111 @@
+"""
+无弹幕 / 无法解析的剧集的负缓存。
+
+有的剧集确实没有弹幕，有的弹幕ID（链接）无法解析为视频；这类请求每次都会把上游的时长探测、分段请求重新走一遍，
+客户端反复重试时会放大上游负载。爬虫在确定是这两种结果时调用 report() 说明原因（网络错误、熔断等
+瞬时失败不报告，也不缓存），下载接口据此在 TTL 内直接返回，不再请求上游：
+
+- no_danmaku：完整抓取后没有弹幕，缓存 DANMU_NEGATIVE_TTL_EMPTY 秒（默认 600），返回 code 404；
+- unresolved：不支持的链接格式、上游确认视频不存在等，缓存 DANMU_NEGATIVE_TTL_UNRESOLVED 秒（默认 3600），返回 code 422。
+
+原因经 ContextVar 中的可变对象传回调用方，与 danmu_tracing 的 span 一样随 run_blocking / 分段线程池的上下文复制可见，
+爬虫的返回值约定不变。缓存只在进程内，重启后失效。
+"""
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+EMPTY = "no_danmaku"
+UNRESOLVED = "unresolved"
+
+REASON_TTLS = {
+    EMPTY: int(os.environ.get("DANMU_NEGATIVE_TTL_EMPTY", "600")),
+    UNRESOLVED: int(os.environ.get("DANMU_NEGATIVE_TTL_UNRESOLVED", "3600")),
+}
+REASON_CODES = {EMPTY: 404, UNRESOLVED: 422}
+
+
+class EpisodeUnavailableError(LookupError):
+    """剧集没有弹幕或无法解析（确定的结果，非瞬时失败）"""
+
+    def __init__(self, reason, message, expires_at):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+        self.expires_at = expires_at
+
+    def to_payload(self):
+        """下载 / 热度图 / 检索接口的响应数据"""
+        return {
+            "code": REASON_CODES[self.reason],
+            "reason": self.reason,
+            "message": self.message,
+            "retryAfter": max(int(self.expires_at - time.time()), 0),
+        }
+
+
+class _Outcome:
+    reason = None
+    message = None
+
+
+_outcome = contextvars.ContextVar("danmu_negative_outcome", default=None)
+
+
+@contextmanager
+def capture():
+    """收集其中的抓取通过 report() 报告的负面结果原因（outcome.reason 为 None 表示没有报告）"""
+    outcome = _Outcome()
+    token = _outcome.set(outcome)
+    try:
+        yield outcome
+    finally:
+        _outcome.reset(token)
+
+
+def report(reason, message):
+    """爬虫报告确定的负面结果；不在 capture() 中时（如命令行直接运行爬虫）只打印"""
+    print(message)
+    outcome = _outcome.get()
+    if outcome is not None:
+        outcome.reason = reason
+        outcome.message = message
+
+
+class NegativeCache:
+    """(弹幕源, 弹幕ID) -> (原因, 说明, 过期时间) 的进程内缓存"""
+
+    def __init__(self, ttls=REASON_TTLS):
+        self.ttls = ttls
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, source, danmaku_id):
+        """返回未过期条目对应的 EpisodeUnavailableError，没有时返回 None"""
+        key = (source, danmaku_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            reason, message, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+        return EpisodeUnavailableError(reason, message, expires_at)
+
+    def put(self, source, danmaku_id, reason, message):
+        """记录负面结果并返回对应的 EpisodeUnavailableError；TTL 为 0 的原因不缓存"""
+        expires_at = time.time() + self.ttls.get(reason, 0)
+        if self.ttls.get(reason, 0) > 0:
+            with self._lock:
+                self._entries[(source, danmaku_id)] = (reason, message, expires_at)
+        return EpisodeUnavailableError(reason, message, expires_at)
+
+    def discard(self, source, danmaku_id):
+        with self._lock:
+            self._entries.pop((source, danmaku_id), None)
+
+
+NEGATIVE_CACHE = NegativeCache()
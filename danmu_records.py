@@ -0,0 +1,129 @@
+"""
+一集弹幕的内存结果。
+
+爬虫抓取得到的行（各平台原有的 CSV 列）保存在 EpisodeDanmu 中，调用方可以：
+- danmakus()：直接得到下载接口使用的标准化记录 [{time, text}]（毫秒，按时间排序），不经过 CSV 写入、回读与解析；
+- save()：按原来的 CSV 格式原子写入磁盘（本地存储、热度图、检索索引、增量刷新仍读取 CSV）。
+下载接口先用内存中的记录响应，再在后台线程中 save()（见 danmaku_service.get_danmaku）。
+
+读取已保存的 CSV 时，时间解析（to_millis）与时间 / 内容列的选择（danmu_columns、read_danmu_csv）也在这里，
+下载接口、热度图、检索索引与 DPlayer 导入共用同一套规则。
+"""
+import csv
+import os
+import time
+from operator import itemgetter
+
+from danmu_writer import DanmuCsvWriter
+
+
+def to_millis(value):
+    """弹幕时间转换为整数毫秒，支持数值与 “HH:MM:SS” / “MM:SS” 格式"""
+    if isinstance(value, str) and ':' in value:
+        parts = value.split(':')
+        if len(parts) == 3:
+            value = (int(parts[0]) * 3600 + int(parts[1]) * 60 + float(parts[2])) * 1000
+        elif len(parts) == 2:
+            value = (int(parts[0]) * 60 + float(parts[1])) * 1000
+    return int(float(value))
+
+
+def parse_millis(value):
+    """与 to_millis 相同，无法解析时返回 None"""
+    try:
+        return to_millis(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def danmu_columns(columns):
+    """
+    弹幕 CSV 的 (时间列下标, 内容列下标)。
+
+    时间列优先 time_offset（企鹅 / 奇异），否则取第一个包含 time 的列（阿B timepoint、阿酷 show_time、阿芒 time），
+    都没有时取第一列；内容列取第一个包含 content 或 text 的列，都没有时取最后一列。
+    """
+    lowered = [str(col).lower() for col in columns]
+    if 'time_offset' in lowered:
+        time_index = lowered.index('time_offset')
+    else:
+        time_index = next((i for i, col in enumerate(lowered) if 'time' in col), 0)
+    text_index = next((i for i, col in enumerate(lowered) if 'content' in col or 'text' in col), len(lowered) - 1)
+    return time_index, text_index
+
+
+def read_danmu_csv(lines):
+    """
+    逐行解析弹幕 CSV（首行为列名，列选择见 danmu_columns），产出 (时间毫秒, 内容)。
+
+    :param lines: 文本行的可迭代对象（如以 newline='' 打开的文件），NUL 字符在解析前移除
+    列数不足或时间无法解析的行跳过；内容为空的行照常产出，由调用方决定是否保留。
+    """
+    reader = csv.reader(line.replace('\x00', '') for line in lines)
+    columns = next(reader, None)
+    if not columns:
+        return
+    time_index, text_index = danmu_columns(columns)
+    for row in reader:
+        if len(row) <= max(time_index, text_index):
+            continue
+        time_ms = parse_millis(row[time_index])
+        if time_ms is not None:
+            yield time_ms, row[text_index]
+
+
+class EpisodeDanmu:
+    """
+    一集弹幕的行与保存方式。
+
+    :param fieldnames: CSV 列名，rows 中每行的字段顺序与之一致
+    :param rows: 行列表（元组 / 列表）
+    :param path: save() 写入的 CSV 路径
+    :param time_field: 弹幕时间（毫秒）所在的列
+    :param text_field: 弹幕内容所在的列
+    :param checkpoint: 可选的分段断点（见 danmu_checkpoint），保存完成后删除
+    其余参数（encoding、errors 及 csv.writer 的格式参数）原样交给 DanmuCsvWriter。
+    """
+
+    def __init__(self, fieldnames, rows, path, time_field, text_field="content", checkpoint=None, **writer_kwargs):
+        self.fieldnames = list(fieldnames)
+        self.rows = rows
+        self.path = path
+        self.time_field = time_field
+        self.text_field = text_field
+        self.checkpoint = checkpoint
+        self.writer_kwargs = writer_kwargs
+        # 本次抓取的数据版本，用于响应体缓存与 ETag；写入文件后记录在本地存储中沿用（见 danmaku_service.data_version）
+        self.version = time.time_ns()
+
+    @classmethod
+    def from_dicts(cls, fieldnames, items, path, time_field, text_field="content", **kwargs):
+        """由字典列表（如阿酷 / 阿B 的弹幕）构造，缺失的列为空字符串"""
+        rows = [tuple(item.get(field, '') for field in fieldnames) for item in items]
+        return cls(fieldnames, rows, path, time_field, text_field, **kwargs)
+
+    @property
+    def count(self):
+        return len(self.rows)
+
+    def danmakus(self):
+        """标准化记录 [{time, text}]，按时间排序（与从 CSV 解析的结果一致，无法解析时间的行跳过）"""
+        time_index = self.fieldnames.index(self.time_field)
+        text_index = self.fieldnames.index(self.text_field)
+        danmakus = []
+        for row in self.rows:
+            try:
+                danmakus.append({"time": to_millis(row[time_index]), "text": str(row[text_index]).replace('\x00', '')})
+            except (ValueError, TypeError) as e:
+                print(f"处理弹幕行时出错: {e}, 原行: {row}")
+        danmakus.sort(key=itemgetter("time"))
+        return danmakus
+
+    def save(self):
+        """写入 CSV 并删除分段断点，返回文件路径；没有弹幕时返回 None"""
+        with DanmuCsvWriter(os.path.dirname(self.path) or ".", self.fieldnames, **self.writer_kwargs) as writer:
+            writer.write_rows(self.rows)
+            output_path = writer.commit(self.path)
+        if self.checkpoint is not None:
+            self.checkpoint.discard()
+        return output_path
@@ -0,0 +1,235 @@
+"""
+已下载弹幕的增量刷新（适用于仍在更新的剧集）。
+
+企鹅按 30 秒、阿酷按 1 分钟分段请求弹幕，阿B 整集为一个 XML。刷新时只重新请求“到期”的分段，
+新弹幕按弹幕ID（企鹅 id / 阿酷弹幕 id / 阿B rowId）去重后合并进本地存储中的 CSV。
+
+每集在存储索引中记录刷新状态：上次刷新时间（watermark）、刷新轮次以及每个分段的空闲计数。
+某个分段连续没有新弹幕时按 2、4、8… 轮指数退避（上限 DANMU_REFRESH_MAX_SKIP），
+因此上游请求量与新增弹幕的活跃程度成正比，而不是每次都全量重抓。
+
+不支持增量的弹幕源（奇异、阿芒）退化为全量重新抓取。
+"""
+import asyncio
+import csv
+import os
+import time
+import weakref
+
+import danmaku_service
+from async_runtime import run_blocking
+from danmu_records import parse_millis
+from danmu_store import DANMU_STORE
+from danmu_writer import DanmuCsvWriter
+from segment_fetcher import fetch_segments, fetch_segments_async
+
+# 分段连续无新弹幕时最多跳过的刷新轮数
+REFRESH_MAX_SKIP = int(os.environ.get("DANMU_REFRESH_MAX_SKIP", "16"))
+
+# 弹幕源 -> (CSV 字段, 时间字段, 文件编码)
+INCREMENTAL_SOURCES = {
+    "企鹅": (['time_offset', 'create_time', 'content', 'id'], 'time_offset', 'utf-8'),
+    "阿酷": (['show_time', 'color', 'content', 'id'], 'show_time', 'utf-8'),
+    "阿B": (['timepoint', 'ct', 'content', 'id'], 'timepoint', 'utf-8-sig'),
+}
+
+# 同一集的刷新串行执行；没有刷新在进行时锁随之释放，不会随剧集数增长
+_locks = weakref.WeakValueDictionary()
+
+
+def _time_of(row, time_field):
+    return parse_millis(row.get(time_field)) or 0
+
+
+def _read_rows(path):
+    with open(path, 'r', encoding='utf-8-sig', errors='ignore', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def _write_rows(path, fieldnames, rows, time_field, encoding):
+    """按时间排序后原子地覆盖写回同一文件"""
+    rows.sort(key=lambda row: _time_of(row, time_field))
+    with DanmuCsvWriter(os.path.dirname(path) or ".", fieldnames, encoding=encoding, errors='ignore') as writer:
+        writer.write_rows([row.get(field, '') for field in fieldnames] for row in rows)
+        writer.commit(path)
+
+
+class _DedupIndex:
+    """已有弹幕的去重索引：有弹幕ID时按ID，旧文件没有ID列时按 (时间, 内容)"""
+
+    def __init__(self, rows, time_field):
+        self.time_field = time_field
+        self.ids = set()
+        self.pairs = set()
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        if row.get('id'):
+            self.ids.add(str(row['id']))
+        self.pairs.add((_time_of(row, self.time_field), row.get('content', '')))
+
+    def is_new(self, row):
+        # 有弹幕ID时只按ID判断：同一时间的相同短文本（如“666”）可能是不同用户的不同弹幕
+        if row.get('id'):
+            return str(row['id']) not in self.ids
+        return (_time_of(row, self.time_field), row.get('content', '')) not in self.pairs
+
+
+# 各弹幕源的分段计划：返回 (fetch_many, 全部分段)，fetch_many(到期分段列表) -> {分段: 弹幕行列表或异常}。
+# 分段经 segment_fetcher 并行抓取，与全量下载共用上游域名的并发上限、对冲请求、熔断器与重试预算。
+
+async def _tencent_segments(danmaku_id, rows):
+    """企鹅：已知分段加上末尾的下一个分段（全量抓取遇到空分段即停止，其后可能出现新弹幕）"""
+    scraper = await danmaku_service.scraper("tencent")
+    step = scraper.SEGMENT_STEP
+    known = max((_time_of(row, 'time_offset') for row in rows), default=0) // step + 1
+
+    def fetch(segment):
+        return [dict(zip(scraper.CSV_FIELDS, row))
+                for row in scraper._fetch_segment(danmaku_id, segment * step, (segment + 1) * step)]
+
+    async def fetch_many(due):
+        return await run_blocking(lambda: dict(fetch_segments("tencent", scraper.SEGMENT_HOST, fetch, due)))
+
+    return fetch_many, range(known + 1)
+
+
+async def _youku_segments(danmaku_id, rows):
+    youku_module = await danmaku_service.youku()
+    prepared = await youku_module.prepare_danmu_getter(danmaku_id)
+    if not prepared:
+        raise RuntimeError("获取优酷认证信息或视频时长失败")
+    getter, video_id, duration = prepared
+
+    async def fetch(segment):
+        return await getter.get_segment(video_id, segment)
+
+    async def fetch_many(due):
+        results = await fetch_segments_async("youku", getter.SEGMENT_HOST, fetch, due)
+        return dict(zip(due, results))
+
+    return fetch_many, range(getter.segment_count(duration))
+
+
+async def _bilibili_segments(danmaku_id, rows):
+    scraper = await danmaku_service.scraper("bilibili")
+
+    async def fetch_many(due):
+        # 整集只有一个 XML，没有分段可并行
+        try:
+            result = await run_blocking(scraper.fetch_danmu_list, danmaku_id)
+        except Exception as e:
+            result = e
+        return {0: result if result is not None else RuntimeError("获取B站弹幕失败")}
+
+    return fetch_many, range(1)
+
+
+SEGMENT_PLANNERS = {
+    "企鹅": _tencent_segments,
+    "阿酷": _youku_segments,
+    "阿B": _bilibili_segments,
+}
+
+
+def _kept_version(source, danmaku_id, path):
+    """文件内容未变时沿用本地存储中记录的数据版本（ETag 保持不变），返回 record 的额外参数"""
+    entry = DANMU_STORE.get(source, danmaku_id)
+    if entry and entry["path"] == path and "version" in entry:
+        return {"version": entry["version"]}
+    return {}
+
+
+async def refresh_episode(source, danmaku_id, keyword=""):
+    """
+    增量刷新一集弹幕；本地没有该集时先全量抓取。
+
+    :return: 刷新统计 {mode, added, total, segmentsFetched, segmentsSkipped, watermark, previousWatermark}
+    """
+    key = (source, danmaku_id)
+    # 局部变量持有锁，刷新期间弱引用字典中的条目不会被回收
+    lock = _locks.get(key)
+    if lock is None:
+        lock = _locks[key] = asyncio.Lock()
+    async with lock:
+        entry = DANMU_STORE.get(source, danmaku_id)
+        if entry is None or source not in INCREMENTAL_SOURCES:
+            previous_watermark = (entry.get("refresh") or {}).get("watermark") if entry else None
+            filepath = await danmaku_service.get_danmaku_file(source, danmaku_id, keyword, refresh=True)
+            watermark = None
+            if filepath:
+                watermark = time.time()
+                await run_blocking(DANMU_STORE.record, source, danmaku_id, filepath,
+                                   refresh={"round": 0, "watermark": watermark, "segments": {}},
+                                   **_kept_version(source, danmaku_id, filepath))
+            return {
+                "mode": "full",
+                "added": None,
+                "total": None,
+                "segmentsFetched": None,
+                "segmentsSkipped": 0,
+                "watermark": watermark,
+                "previousWatermark": previous_watermark,
+            }
+
+        return await _refresh_incremental(source, danmaku_id, entry)
+
+
+async def _refresh_incremental(source, danmaku_id, entry):
+    fieldnames, time_field, encoding = INCREMENTAL_SOURCES[source]
+    path = entry["path"]
+    state = entry.get("refresh") or {"round": 0, "watermark": entry["fetched_at"], "segments": {}}
+    previous_watermark = state["watermark"]
+    current_round = state["round"] + 1
+    segment_states = state["segments"]
+
+    rows = await run_blocking(_read_rows, path)
+    dedup = _DedupIndex(rows, time_field)
+    fetch_many, segments = await SEGMENT_PLANNERS[source](danmaku_id, rows)
+
+    due = [segment for segment in segments
+           if segment_states.get(str(segment), {"due": 0})["due"] <= current_round]
+    skipped = len(segments) - len(due)
+    results = await fetch_many(due) if due else {}
+
+    added = []
+    fetched = 0
+    for segment in due:
+        seg_state = segment_states.get(str(segment), {"idle": 0, "due": 0})
+        segment_rows = results[segment]
+        if isinstance(segment_rows, Exception):
+            # 失败的分段保持原状态，下一轮继续尝试
+            print(f"增量刷新分段 {segment} 失败: {source} {danmaku_id}: {segment_rows}")
+            continue
+        fetched += 1
+
+        fresh = [row for row in segment_rows if dedup.is_new(row)]
+        for row in fresh:
+            dedup.add(row)
+        added.extend(fresh)
+        if fresh:
+            seg_state = {"idle": 0, "due": current_round + 1}
+        else:
+            idle = seg_state["idle"] + 1
+            seg_state = {"idle": idle, "due": current_round + min(2 ** idle, REFRESH_MAX_SKIP)}
+        segment_states[str(segment)] = seg_state
+
+    state = {"round": current_round, "watermark": time.time(), "segments": segment_states}
+    if added:
+        # 文件内容变化，数据版本改为按文件状态计算（见 danmaku_service.data_version）
+        await run_blocking(_write_rows, path, fieldnames, rows + added, time_field, encoding)
+        await run_blocking(DANMU_STORE.record, source, danmaku_id, path, refresh=state)
+    else:
+        await run_blocking(DANMU_STORE.record, source, danmaku_id, path, refresh=state,
+                           **_kept_version(source, danmaku_id, path))
+    print(f"增量刷新 {source} {danmaku_id}: 请求 {fetched} 个分段，跳过 {skipped} 个，新增 {len(added)} 条弹幕")
+    return {
+        "mode": "incremental",
+        "added": len(added),
+        "total": len(rows) + len(added),
+        "segmentsFetched": fetched,
+        "segmentsSkipped": skipped,
+        "watermark": state["watermark"],
+        "previousWatermark": previous_watermark,
+    }
@@ -0,0 +1,211 @@
+"""
+单集弹幕的全文检索索引。
+
+每集弹幕写入本地存储后，在后台为其建立一个 SQLite 倒排索引（danmu_data/search_index/ 下），
+词项为归一化文本的相邻双字（bigram），适用于不以空格分词的中文。查询时只遍历查询串中最罕见
+bigram 的倒排表，再在候选行的归一化文本中确认整串出现，返回命中弹幕的时间。
+
+索引在磁盘上按 (词项, 行号) 聚簇存储，查询只读取相关的倒排表与候选行，不需要把整集弹幕加载到内存。
+单字查询没有 bigram 可用，退化为对归一化文本的扫描。
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from danmu_merge import normalize_text
+from danmu_records import read_danmu_csv
+from response_utils import file_version
+
+SEARCH_INDEX_DIR = os.path.join("danmu_data", "search_index")
+# 单次查询返回的最大命中条数
+MAX_SEARCH_RESULTS = 500
+
+# 同时保持打开的只读连接数上限（最近使用的索引），超出时关闭最久未用的连接
+MAX_READERS = int(os.environ.get("DANMU_SEARCH_READERS", "32"))
+
+_build_lock = threading.Lock()
+# 索引路径 -> _Reader，按最近使用排序
+_readers = OrderedDict()
+_readers_lock = threading.Lock()
+
+
+class _Reader:
+    """一个索引文件的只读连接；关闭后（被淘汰或索引被替换）查询方需重新获取"""
+
+    def __init__(self, path, key):
+        self.key = key
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.connection.close()
+
+
+def index_path(source, danmaku_id):
+    digest = hashlib.sha1(f"{source}|{danmaku_id}".encode("utf-8")).hexdigest()
+    return os.path.join(SEARCH_INDEX_DIR, f"{digest}.sqlite")
+
+
+def bigrams(text):
+    """归一化文本的相邻双字集合"""
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _read_rows(filepath):
+    """逐行读取弹幕 CSV，产出 (时间毫秒, 文本)；列选择与时间解析与下载接口一致（见 danmu_records）"""
+    with open(filepath, 'r', encoding='utf-8-sig', errors='ignore', newline='') as f:
+        for time_ms, text in read_danmu_csv(f):
+            if text:
+                yield time_ms, text
+
+
+def build_index(source, danmaku_id, filepath):
+    """为一集弹幕（重新）建立索引；索引已对应当前文件版本时直接返回"""
+    version = file_version(filepath)
+    path = index_path(source, danmaku_id)
+    with _build_lock:
+        if _indexed_version(path) == version:
+            return path
+
+        os.makedirs(SEARCH_INDEX_DIR, exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.part"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.executescript("""
+                PRAGMA journal_mode = OFF;
+                PRAGMA synchronous = OFF;
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE danmaku (id INTEGER PRIMARY KEY, time INTEGER, text TEXT, norm TEXT);
+                CREATE TABLE grams (gram TEXT PRIMARY KEY, df INTEGER) WITHOUT ROWID;
+                CREATE TABLE postings (gram TEXT, doc INTEGER, PRIMARY KEY (gram, doc)) WITHOUT ROWID;
+            """)
+            # 行号按时间顺序分配，倒排表按行号有序即按时间有序，查询可在取够条数后提前结束
+            danmaku_rows = sorted(_read_rows(filepath), key=lambda row: row[0])
+            posting_rows, document_frequency = [], {}
+            for row_id, (time_ms, text) in enumerate(danmaku_rows):
+                norm = normalize_text(text)
+                danmaku_rows[row_id] = (row_id, time_ms, text, norm)
+                for gram in bigrams(norm):
+                    posting_rows.append((gram, row_id))
+                    document_frequency[gram] = document_frequency.get(gram, 0) + 1
+            connection.executemany("INSERT INTO danmaku VALUES (?, ?, ?, ?)", danmaku_rows)
+            connection.executemany("INSERT INTO grams VALUES (?, ?)", sorted(document_frequency.items()))
+            # 按 (词项, 行号) 排序后插入，B 树顺序写入
+            posting_rows.sort()
+            connection.executemany("INSERT INTO postings VALUES (?, ?)", posting_rows)
+            connection.execute("INSERT INTO meta VALUES ('version', ?)", (version,))
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temp_path, path)
+        # 旧索引文件已被替换，释放仍指向它的缓存连接
+        _release(path)
+        print(f"已建立弹幕检索索引: {source} {danmaku_id}，{len(danmaku_rows)} 条弹幕")
+        return path
+
+
+def _indexed_version(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        finally:
+            connection.close()
+        return row[0] if row else None
+    except sqlite3.Error:
+        return None
+
+
+def is_current(source, danmaku_id, filepath):
+    return _indexed_version(index_path(source, danmaku_id)) == file_version(filepath)
+
+
+def _reader(path):
+    """返回缓存的只读连接（索引文件被替换后自动重新打开），缓存超过 MAX_READERS 时关闭最久未用的连接"""
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_mtime_ns)
+    with _readers_lock:
+        cached = _readers.get(path)
+        if cached is not None and cached.key == key and not cached.closed:
+            _readers.move_to_end(path)
+            return cached
+        if cached is not None:
+            cached.close()
+        reader = _readers[path] = _Reader(path, key)
+        while len(_readers) > MAX_READERS:
+            _, evicted = _readers.popitem(last=False)
+            evicted.close()
+        return reader
+
+
+def _release(path):
+    with _readers_lock:
+        reader = _readers.pop(path, None)
+    if reader is not None:
+        reader.close()
+
+
+def search(source, danmaku_id, query, limit=MAX_SEARCH_RESULTS):
+    """
+    在一集弹幕中检索包含 query 的弹幕（需已建立索引）。
+
+    只遍历查询串中文档频率最低的 bigram 的倒排表，其余条件在候选行的归一化文本上确认。
+
+    :return: (按时间排序的 [{"time": 毫秒, "text": 文本}]，是否因达到 limit 而截断)
+    """
+    norm = normalize_text(query) or str(query).strip()
+    if not norm:
+        return [], False
+    path = index_path(source, danmaku_id)
+    reader = _reader(path)
+    with reader.lock:
+        if reader.closed:
+            # 刚被淘汰或替换，重新获取连接
+            return search(source, danmaku_id, query, limit)
+        connection = reader.connection
+        grams = sorted(bigrams(norm))
+        if grams:
+            placeholders = ",".join("?" * len(grams))
+            frequencies = connection.execute(f"SELECT gram, df FROM grams WHERE gram IN ({placeholders})", grams).fetchall()
+            if len(frequencies) < len(grams):
+                # 有 bigram 从未出现过，不可能命中
+                return [], False
+            rarest = min(frequencies, key=lambda item: item[1])[0]
+            rows = connection.execute(
+                "SELECT d.time, d.text FROM postings p JOIN danmaku d ON d.id = p.doc "
+                "WHERE p.gram = ? AND instr(d.norm, ?) > 0 ORDER BY p.doc LIMIT ?",
+                (rarest, norm, limit + 1)
+            ).fetchall()
+        else:
+            rows = connection.execute(
+                "SELECT time, text FROM danmaku WHERE instr(norm, ?) > 0 ORDER BY id LIMIT ?", (norm, limit + 1)
+            ).fetchall()
+    return [{"time": time_ms, "text": text} for time_ms, text in rows[:limit]], len(rows) > limit
+
+
+def remove_all():
+    """删除全部检索索引（清空缓存时调用），返回删除的文件数"""
+    removed = 0
+    with _readers_lock:
+        readers = list(_readers.values())
+        _readers.clear()
+    for reader in readers:
+        reader.close()
+    if os.path.isdir(SEARCH_INDEX_DIR):
+        for name in os.listdir(SEARCH_INDEX_DIR):
+            try:
+                os.remove(os.path.join(SEARCH_INDEX_DIR, name))
+                removed += 1
+            except OSError as e:
+                print(f"删除检索索引 {name} 失败: {e}")
+    return removed
@@ -0,0 +1,102 @@
+"""
+本地弹幕存储索引。
+
+记录每一集（弹幕源 + 弹幕ID）最近一次抓取得到的 CSV 文件，下载接口和后台任务据此直接复用本地数据，
+无需再次请求上游。索引持久化在 danmu_data/store_index.json，文件本身仍由各平台爬虫写入各自目录。
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+STORE_INDEX_PATH = os.path.join("danmu_data", "store_index.json")
+# 本地弹幕的有效期（秒），过期后下载接口重新抓取；0 表示永不过期
+STORE_TTL = int(os.environ.get("DANMU_STORE_TTL", "43200"))
+
+
+class DanmuStore:
+    """(弹幕源, 弹幕ID) -> {"path": CSV 路径, "fetched_at": 抓取时间} 的持久化索引"""
+
+    def __init__(self, index_path=STORE_INDEX_PATH, ttl=STORE_TTL):
+        self.index_path = index_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = None
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """注册存储更新回调 listener(source, danmaku_id, entry)，在 record 之后调用"""
+        self._listeners.append(listener)
+
+    @staticmethod
+    def _key(source, danmaku_id):
+        return f"{source}|{danmaku_id}"
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        directory = os.path.dirname(self.index_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".json.part")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get(self, source, danmaku_id):
+        """返回索引条目（文件已被删除时返回 None），不检查有效期"""
+        with self._lock:
+            entry = self._load().get(self._key(source, danmaku_id))
+        if entry is None or not os.path.exists(entry["path"]):
+            return None
+        return entry
+
+    def lookup(self, source, danmaku_id):
+        """返回仍在有效期内的本地 CSV 路径，没有时返回 None"""
+        entry = self.get(source, danmaku_id)
+        if entry is None:
+            return None
+        if self.ttl and time.time() - entry["fetched_at"] > self.ttl:
+            return None
+        return entry["path"]
+
+    def record(self, source, danmaku_id, path, **extra):
+        """记录一次成功抓取；替换掉的旧文件会被删除"""
+        entry = dict(extra, path=path, fetched_at=time.time())
+        with self._lock:
+            entries = self._load()
+            old = entries.get(self._key(source, danmaku_id))
+            entries[self._key(source, danmaku_id)] = entry
+            self._save()
+        if old and old["path"] != path and os.path.exists(old["path"]):
+            try:
+                os.remove(old["path"])
+            except OSError as e:
+                print(f"删除旧弹幕文件 {old['path']} 失败: {e}")
+        for listener in self._listeners:
+            try:
+                listener(source, danmaku_id, entry)
+            except Exception as e:
+                print(f"弹幕存储回调失败: {e}")
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+
+
+DANMU_STORE = DanmuStore()
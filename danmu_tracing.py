@@ -0,0 +1,287 @@
+"""
+请求级分段追踪（span）。
+
+一个 HTTP 请求对应一条 trace，请求处理、搜索 / 时长查询、各分段的抓取与解码、CSV 读写、JSON 编码
+分别记录为 span，带耗时与属性（分段序号、字节数、弹幕条数等），用来定位一次慢下载的时间花在哪里。
+
+- 采样：DANMU_TRACE_SAMPLE_RATE（0~1，默认 0 即关闭）按请求采样；请求头 X-Danmu-Trace: 0 可强制关闭，
+  X-Danmu-Trace: 1 强制开启只在运维设置 DANMU_TRACE_ALLOW_HEADER=1 时生效（否则任意客户端都能绕过采样率写入追踪数据）。
+  未采样的请求中 span() 返回空操作对象，开销只有一次 ContextVar 读取。
+- 导出：trace 结束（根 span 结束）后交给后台线程导出。设置 DANMU_TRACE_OTLP_ENDPOINT
+  （如 http://127.0.0.1:4318/v1/traces）时以 OTLP/HTTP JSON 发送给 OpenTelemetry Collector，
+  否则按行追加写入 JSON 文件 DANMU_TRACE_FILE（默认 danmu_data/traces.jsonl，每行一条 trace）；
+  文件超过 DANMU_TRACE_FILE_MAX_BYTES（默认 64 MB）时轮转为 <文件>.1（只保留一份），磁盘占用有上限。
+
+当前 span 保存在 ContextVar 中，随协程传递；线程池任务经 async_runtime.run_blocking 复制上下文后同样可见。
+"""
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+SAMPLE_RATE = float(os.environ.get("DANMU_TRACE_SAMPLE_RATE", "0"))
+ALLOW_HEADER = os.environ.get("DANMU_TRACE_ALLOW_HEADER", "") == "1"
+TRACE_FILE = os.environ.get("DANMU_TRACE_FILE", os.path.join("danmu_data", "traces.jsonl"))
+TRACE_FILE_MAX_BYTES = int(os.environ.get("DANMU_TRACE_FILE_MAX_BYTES", str(64 * 1024 * 1024)))
+OTLP_ENDPOINT = os.environ.get("DANMU_TRACE_OTLP_ENDPOINT", "")
+SERVICE_NAME = "danmuapi"
+TRACE_HEADER = "X-Danmu-Trace"
+# 单条 trace 最多记录的 span 数，超出的 span 计入根 span 的 dropped_spans 属性
+MAX_SPANS_PER_TRACE = 5000
+
+_current_span = contextvars.ContextVar("danmu_current_span", default=None)
+
+
+class _NoopSpan:
+    """未采样时使用的空 span"""
+    sampled = False
+    trace_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Trace:
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.spans = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            if len(self.spans) < MAX_SPANS_PER_TRACE:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+
+class Span:
+    sampled = True
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.trace_id = trace.trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "durationMs": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": {"code": "ERROR", "message": self.error} if self.error else {"code": "OK"},
+        }
+
+
+class _SpanScope:
+    """span 的上下文管理器：进入时设为当前 span，退出时记录结束时间与异常"""
+
+    def __init__(self, span):
+        self.span = span
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        finish(self.span, exc)
+        _current_span.reset(self._token)
+        return False
+
+
+class _NoopScope:
+    def __enter__(self):
+        return NOOP_SPAN
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SCOPE = _NoopScope()
+
+
+def should_sample(header_value=None):
+    """按请求头（强制开关，强制开启需 ALLOW_HEADER）或采样率决定是否追踪本次请求"""
+    if header_value in ("1", "true") and ALLOW_HEADER:
+        return True
+    if header_value in ("0", "false"):
+        return False
+    return SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE
+
+
+def start_trace(name, sampled, **attributes):
+    """
+    开始一条 trace 并返回根 span（未采样时返回 NOOP_SPAN），需配合 activate / finish 使用；
+    协程或 with 语句中可直接使用 trace()。
+    """
+    if not sampled:
+        return NOOP_SPAN
+    return Span(_Trace(f"{random.getrandbits(128):032x}"), name, None, attributes)
+
+
+def activate(span):
+    """把 span 设为当前 span，返回用于 deactivate 的令牌"""
+    return _current_span.set(span if span.sampled else None)
+
+
+def deactivate(token):
+    _current_span.reset(token)
+
+
+def trace(name, sampled, **attributes):
+    """with trace(...) as root: 开始一条 trace，退出时结束并导出"""
+    root = start_trace(name, sampled, **attributes)
+    return _SpanScope(root) if root.sampled else _NOOP_SCOPE
+
+
+def span(name, **attributes):
+    """with span(...) as s: 在当前 trace 中记录一个子 span；不在已采样的 trace 中时为空操作"""
+    parent = _current_span.get()
+    if parent is None:
+        return _NOOP_SCOPE
+    return _SpanScope(Span(parent.trace, name, parent.span_id, attributes))
+
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN
+
+
+def finish(span, exc=None):
+    """结束 span；根 span 结束时导出整条 trace"""
+    if not span.sampled or span.end_ns is not None:
+        return
+    span.end_ns = time.time_ns()
+    if exc is not None:
+        span.error = f"{type(exc).__name__}: {exc}"
+    span.trace.add(span)
+    if span.parent_id is None:
+        if span.trace.dropped:
+            span.attributes["dropped_spans"] = span.trace.dropped
+        _exporter().submit(span.trace)
+
+
+# ---- 导出 ----
+
+class _Exporter:
+    """后台线程导出已结束的 trace，请求线程只做入队"""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1000)
+        threading.Thread(target=self._run, name="danmu-trace-exporter", daemon=True).start()
+
+    def submit(self, trace_data):
+        try:
+            self._queue.put_nowait(trace_data)
+        except queue.Full:
+            print("追踪导出队列已满，丢弃一条 trace")
+
+    def _run(self):
+        while True:
+            trace_data = self._queue.get()
+            try:
+                with trace_data.lock:
+                    spans = sorted(trace_data.spans, key=lambda s: s.start_ns)
+                if OTLP_ENDPOINT:
+                    _export_otlp(spans)
+                else:
+                    _export_file(spans)
+            except Exception as e:
+                print(f"导出追踪数据失败: {e}")
+
+
+_exporter_instance = None
+_exporter_lock = threading.Lock()
+
+
+def _exporter():
+    global _exporter_instance
+    if _exporter_instance is None:
+        with _exporter_lock:
+            if _exporter_instance is None:
+                _exporter_instance = _Exporter()
+    return _exporter_instance
+
+
+def _export_file(spans):
+    directory = os.path.dirname(TRACE_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    line = json.dumps({"traceId": spans[0].trace_id, "spans": [s.to_dict() for s in spans]}, ensure_ascii=False) + "\n"
+    try:
+        size = os.path.getsize(TRACE_FILE)
+    except OSError:
+        size = 0
+    if size and size + len(line.encode('utf-8')) > TRACE_FILE_MAX_BYTES:
+        # 只在导出线程中写入，轮转无需加锁
+        os.replace(TRACE_FILE, TRACE_FILE + ".1")
+    with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+        f.write(line)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _export_otlp(spans):
+    """按 OTLP/HTTP JSON 格式发送（与 OpenTelemetry Collector 的 /v1/traces 兼容）"""
+    import urllib.request
+
+    otlp_spans = []
+    for s in spans:
+        item = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 2 if s.parent_id is None else 1,  # SERVER / INTERNAL
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+        }
+        if s.parent_id:
+            item["parentSpanId"] = s.parent_id
+        otlp_spans.append(item)
+
+    payload = {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "danmu_tracing"}, "spans": otlp_spans}],
+    }]}
+    request = urllib.request.Request(
+        OTLP_ENDPOINT, data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"}, method="POST"
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
@@ -0,0 +1,73 @@
+import csv
+import os
+import tempfile
+
+from danmu_tracing import span
+
+
+class DanmuCsvWriter:
+    """
+    弹幕 CSV 写入器。
+
+    行写入同一目录下的临时文件，全部写完后调用 commit() 原子地重命名为最终文件（文件名可依赖总条数），
+    读取方不会看到写了一半的文件。写入器本身逐行写出，但爬虫抓取的整集弹幕先保存在 EpisodeDanmu 中
+    （见 danmu_records，下载接口直接用内存记录响应），save() 时才一次性交给写入器，整集数据在写入前仍在内存中。
+
+    用法：
+        with DanmuCsvWriter(base_dir, ['time_offset', 'create_time', 'content']) as writer:
+            writer.write_rows(rows)
+            path = writer.commit(os.path.join(base_dir, f"video_{vid}_{writer.count}_danmu.csv"))
+    """
+
+    def __init__(self, base_dir, fieldnames, encoding="utf-8", errors="strict", **csv_kwargs):
+        self.base_dir = base_dir
+        self.fieldnames = fieldnames
+        self.count = 0
+        os.makedirs(base_dir, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=base_dir, suffix=".csv.part")
+        self._file = os.fdopen(fd, "w", encoding=encoding, errors=errors, newline="")
+        self._writer = csv.writer(self._file, **csv_kwargs)
+        self._writer.writerow(fieldnames)
+        self._committed = False
+
+    def write_rows(self, rows):
+        """写入一批行（序列，字段顺序与 fieldnames 一致），返回本批行数"""
+        before = self.count
+        with span("csv.write") as write_span:
+            for row in rows:
+                self._writer.writerow(row)
+                self.count += 1
+            write_span.set_attribute("rows", self.count - before)
+        return self.count - before
+
+    def commit(self, output_path):
+        """关闭并重命名为 output_path；未写入任何行时删除临时文件并返回 None"""
+        self._file.close()
+        self._committed = True
+        if self.count == 0:
+            self._remove_temp()
+            return None
+        os.replace(self.temp_path, output_path)
+        return output_path
+
+    def abort(self):
+        """放弃写入，删除临时文件"""
+        if not self._file.closed:
+            self._file.close()
+        self._committed = True
+        self._remove_temp()
+
+    def _remove_temp(self):
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 未提交（异常或提前返回）时清理临时文件
+        if not self._committed:
+            self.abort()
+        return False
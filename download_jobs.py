@@ -0,0 +1,342 @@
+"""
+弹幕下载后台任务队列。
+
+/api/danmaku/download 会在整个抓取期间占用 HTTP 连接（奇异 120 个分段可能需要几十秒），
+经过代理时容易超时。任务模式下提交后立即返回任务ID，前端轮询状态接口查看分段进度，
+完成后再从结果接口取数据。
+
+任务在共享事件循环上调度：全局并发数与每个弹幕源的并发数都有上限；
+同一集（弹幕源 + 弹幕ID）在排队、运行中或结果保留期内重复提交时复用已有任务，超时重试不会重新抓取。
+
+预取任务（prefetch）以低优先级运行：只占用有限的工作槽位，并受全局上游速率预算约束，
+抓取结果写入本地弹幕存储，之后的下载请求直接命中本地数据。
+每个弹幕源的预取任务按独立的上限计数，不占用前台任务的每源槽位，因此预取排满时前台任务仍能立即开始。
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+import traceback
+import uuid
+
+import danmaku_service
+from async_runtime import run_coro
+from circuit_breaker import is_transient
+from danmu_negative import NEGATIVE_CACHE, EpisodeUnavailableError
+from danmu_store import DANMU_STORE
+
+# 同时运行的下载任务总数
+JOB_WORKERS = int(os.environ.get("DANMU_JOB_WORKERS", "8"))
+# 每个弹幕源同时运行的下载任务数（不含预取任务），避免对单个上游并发过高
+JOB_PER_SOURCE = int(os.environ.get("DANMU_JOB_PER_SOURCE", "2"))
+# 已结束任务的保留时间（秒），期间重复提交直接复用结果
+JOB_RESULT_TTL = int(os.environ.get("DANMU_JOB_RESULT_TTL", "600"))
+# 同时运行的预取任务数上限，保证前台下载始终有空闲槽位
+PREFETCH_WORKERS = int(os.environ.get("DANMU_PREFETCH_WORKERS", "2"))
+# 每个弹幕源同时运行的预取任务数上限（与 JOB_PER_SOURCE 分开计数）
+PREFETCH_PER_SOURCE = int(os.environ.get("DANMU_PREFETCH_PER_SOURCE", "1"))
+# 预取任务的全局上游速率预算（每分钟最多开始抓取的集数）
+PREFETCH_RATE = float(os.environ.get("DANMU_PREFETCH_RATE", "6"))
+# 单次预取最多调度的集数
+PREFETCH_MAX_EPISODES = int(os.environ.get("DANMU_PREFETCH_MAX_EPISODES", "50"))
+
+PRIORITY_NORMAL = 0
+PRIORITY_PREFETCH = 10
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+class DownloadJob:
+    """一集弹幕的下载任务"""
+
+    def __init__(self, source, danmaku_id, keyword, priority=PRIORITY_NORMAL):
+        self.id = uuid.uuid4().hex
+        self.source = source
+        self.danmaku_id = danmaku_id
+        self.keyword = keyword
+        self.priority = priority
+        self.status = STATUS_QUEUED
+        self.done = 0
+        self.total = None
+        self.filepath = None
+        self.error = None
+        self.reason = None  # 负面结果原因（no_danmaku / unresolved，见 danmu_negative）
+        self.transient = False  # 是否因熔断或重试用尽的瞬时失败而失败（稍后重试可能成功）
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.prefetch = False  # 是否以预取（低优先级）身份运行
+
+    @property
+    def key(self):
+        return (self.source, self.danmaku_id)
+
+    @property
+    def finished(self):
+        return self.status in (STATUS_DONE, STATUS_FAILED)
+
+    def update_progress(self, done, total):
+        """爬虫的分段进度回调（可能在线程池中调用，仅做简单赋值）"""
+        self.done = done
+        self.total = total
+
+    def to_dict(self):
+        return {
+            "jobId": self.id,
+            "source": self.source,
+            "danmakuId": self.danmaku_id,
+            "status": self.status,
+            "prefetch": self.priority > PRIORITY_NORMAL,
+            "progress": {"done": self.done, "total": self.total},
+            "error": self.error,
+            "reason": self.reason,
+            "transient": self.transient,
+            "createdAt": self.created_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+        }
+
+
+class TokenBucket:
+    """令牌桶：按固定速率补充令牌，桶满时最多积攒 burst 个"""
+
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst if burst is not None else max(1.0, rate_per_minute / 6.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """取出一个令牌，没有令牌时返回 False"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        """距离下一个令牌可用的秒数"""
+        self._refill()
+        if self.rate <= 0:
+            return None
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class JobManager:
+    """
+    后台下载任务调度器，所有状态只在共享事件循环线程中修改。
+
+    待运行任务按 (优先级, 提交顺序) 排成堆；调度时跳过所属弹幕源已满的任务，
+    因此某个源排满不会阻塞其他源的任务。低优先级（预取）任务按各自的每源上限计数，另受工作槽位与速率预算限制。
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, per_source=JOB_PER_SOURCE, result_ttl=JOB_RESULT_TTL,
+                 prefetch_workers=PREFETCH_WORKERS, prefetch_rate=PREFETCH_RATE,
+                 prefetch_per_source=PREFETCH_PER_SOURCE):
+        self.max_workers = max_workers
+        self.per_source = per_source
+        self.result_ttl = result_ttl
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_per_source = prefetch_per_source
+        self.prefetch_budget = TokenBucket(prefetch_rate)
+        self.jobs = {}  # 任务ID -> DownloadJob
+        self._by_key = {}  # (弹幕源, 弹幕ID) -> DownloadJob
+        self._pending = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._running_by_source = {}
+        self._running_prefetch = 0
+        self._prefetch_by_source = {}
+        self._retry_handle = None
+        self._tasks = set()
+
+    async def submit(self, source, danmaku_id, keyword="", priority=PRIORITY_NORMAL):
+        """提交下载任务；同一集已有可复用的任务时直接返回该任务"""
+        self._prune()
+        job = self._by_key.get((source, danmaku_id))
+        if job is not None and self._reusable(job):
+            if not job.finished and priority < job.priority:
+                # 低优先级任务被前台请求追上时提升优先级
+                job.priority = priority
+                heapq.heappush(self._pending, (priority, next(self._seq), job))
+                self._dispatch()
+            return job
+
+        job = DownloadJob(source, danmaku_id, keyword, priority)
+        self.jobs[job.id] = job
+        self._by_key[job.key] = job
+        heapq.heappush(self._pending, (priority, next(self._seq), job))
+        self._dispatch()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def stats(self):
+        return {
+            "queued": sum(1 for job in self.jobs.values() if job.status == STATUS_QUEUED),
+            "running": self._running,
+            "runningBySource": dict(self._running_by_source),
+            "runningPrefetch": self._running_prefetch,
+            "total": len(self.jobs),
+        }
+
+    def _reusable(self, job):
+        if job.status != STATUS_DONE:
+            # 失败的任务允许重新提交
+            return job.status != STATUS_FAILED
+        return bool(job.filepath) and os.path.exists(job.filepath)
+
+    def _prune(self):
+        """清理超过保留时间的已结束任务"""
+        now = time.time()
+        for job_id in [j.id for j in self.jobs.values() if j.finished and now - j.finished_at > self.result_ttl]:
+            job = self.jobs.pop(job_id)
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+
+    def _dispatch(self):
+        """在并发上限内启动可运行的任务"""
+        skipped = []
+        budget_wait = None
+        while self._pending and self._running < self.max_workers:
+            priority, seq, job = heapq.heappop(self._pending)
+            if job.status != STATUS_QUEUED or priority != job.priority:
+                # 已启动或优先级已调整（堆中保留的旧条目）
+                continue
+            prefetching = self._prefetch_by_source.get(job.source, 0)
+            if priority > PRIORITY_NORMAL:
+                if prefetching >= self.prefetch_per_source or self._running_prefetch >= self.prefetch_workers:
+                    skipped.append((priority, seq, job))
+                    continue
+                if not self.prefetch_budget.take():
+                    # 速率预算耗尽：预取任务等到下一个令牌可用时再调度
+                    budget_wait = self.prefetch_budget.wait_time()
+                    skipped.append((priority, seq, job))
+                    continue
+            elif self._running_by_source.get(job.source, 0) - prefetching >= self.per_source:
+                skipped.append((priority, seq, job))
+                continue
+            self._start(job)
+        for item in skipped:
+            heapq.heappush(self._pending, item)
+        if budget_wait is not None and self._retry_handle is None:
+            self._retry_handle = asyncio.get_running_loop().call_later(budget_wait, self._retry_dispatch)
+
+    def _retry_dispatch(self):
+        self._retry_handle = None
+        self._dispatch()
+
+    def _start(self, job):
+        job.status = STATUS_RUNNING
+        job.started_at = time.time()
+        job.prefetch = job.priority > PRIORITY_NORMAL
+        self._running += 1
+        self._running_prefetch += job.prefetch
+        self._prefetch_by_source[job.source] = self._prefetch_by_source.get(job.source, 0) + job.prefetch
+        self._running_by_source[job.source] = self._running_by_source.get(job.source, 0) + 1
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job):
+        try:
+            filepath = await danmaku_service.get_danmaku_file(
+                job.source, job.danmaku_id, job.keyword, progress=job.update_progress
+            )
+            if filepath and os.path.exists(filepath):
+                job.filepath = filepath
+                job.status = STATUS_DONE
+                if job.total is None:
+                    # 分段总数事先未知（如企鹅），完成时以实际分段数为准
+                    job.total = job.done
+            else:
+                job.error = "未找到弹幕数据"
+                job.status = STATUS_FAILED
+        except EpisodeUnavailableError as e:
+            job.error = e.message
+            job.reason = e.reason
+            job.status = STATUS_FAILED
+        except Exception as e:
+            print(f"后台下载弹幕失败: {job.source} {job.danmaku_id}: {e}")
+            print(traceback.format_exc())
+            job.error = str(e)
+            job.transient = is_transient(e)
+            job.status = STATUS_FAILED
+        finally:
+            job.finished_at = time.time()
+            self._running -= 1
+            self._running_prefetch -= job.prefetch
+            self._prefetch_by_source[job.source] -= job.prefetch
+            self._running_by_source[job.source] -= 1
+            self._dispatch()
+
+
+    async def prefetch(self, source, episode_ids, keyword="", current_id=None, limit=PREFETCH_MAX_EPISODES):
+        """
+        为当前集之后的剧集调度低优先级预取任务，已在本地存储或负缓存中的剧集会跳过。
+
+        :param episode_ids: 按播放顺序排列的剧集弹幕ID（即 /api/danmaku/episodes 返回的 id）
+        :param current_id: 正在观看的剧集；提供时只预取其后的剧集
+        :return: 已调度的任务列表
+        """
+        upcoming = list(episode_ids)
+        if current_id is not None and current_id in upcoming:
+            upcoming = upcoming[upcoming.index(current_id) + 1:]
+
+        jobs = []
+        for danmaku_id in upcoming[:limit]:
+            if DANMU_STORE.lookup(source, danmaku_id) or NEGATIVE_CACHE.get(source, danmaku_id):
+                continue
+            jobs.append(await self.submit(source, danmaku_id, keyword, PRIORITY_PREFETCH))
+        return jobs
+
+
+_manager = None
+
+
+def get_manager():
+    """返回进程内共享的任务调度器（需在共享事件循环中使用）"""
+    global _manager
+    if _manager is None:
+        _manager = JobManager()
+    return _manager
+
+
+async def _submit(source, danmaku_id, keyword, priority):
+    job = await get_manager().submit(source, danmaku_id, keyword, priority)
+    return job.to_dict()
+
+
+async def _describe(job_id):
+    job = get_manager().get(job_id)
+    return None if job is None else (job.to_dict(), job.filepath)
+
+
+def submit_job(source, danmaku_id, keyword="", priority=PRIORITY_NORMAL):
+    """同步接口（供 Flask 路由使用）：提交下载任务并返回任务状态字典"""
+    return run_coro(_submit(source, danmaku_id, keyword, priority))
+
+
+async def _prefetch(source, episode_ids, keyword, current_id):
+    jobs = await get_manager().prefetch(source, episode_ids, keyword, current_id)
+    return [job.to_dict() for job in jobs]
+
+
+def prefetch_episodes(source, episode_ids, keyword="", current_id=None):
+    """同步接口（供 Flask 路由使用）：为后续剧集调度预取任务，返回任务状态字典列表"""
+    return run_coro(_prefetch(source, episode_ids, keyword, current_id))
+
+
+def job_status(job_id):
+    """同步接口（供 Flask 路由使用）：返回 (任务状态字典, 结果文件路径)，任务不存在时返回 None"""
+    return run_coro(_describe(job_id))
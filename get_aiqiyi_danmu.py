@@ -1,25 +1,144 @@
 import os
 import requests
 import json
-import pandas as pd
 from datetime import datetime
-import brotli
 from math import ceil
 import hashlib
-from google.protobuf import descriptor_pool, message_factory, descriptor_pb2
+from danmu_records import EpisodeDanmu
+from danmu_tracing import span
+from circuit_breaker import OVERLOAD_STATUSES, CircuitOpenError, is_overload
+from danmu_checkpoint import SegmentCheckpoint
+from danmu_negative import EMPTY, report
+from danmu_duration import DURATIONS, probe_segments
+from segment_fetcher import fetch_one, fetch_segments
+
+def parse_play_url(play_url):
+    """
+    Split an Iqiyi playUrl such as "tvid=123;vid=abc" into its parameters.
+
+    Returns:
+    - tuple: (value of the first parameter, dict of all parameters)
+    """
+    params = {}
+    first_value = ''
+    if not play_url:
+        return first_value, params
+    for i, part in enumerate(play_url.split(';')):
+        if '=' not in part:
+            continue
+        key, value = part.split('=', 1)
+        params[key] = value
+        if i == 0:
+            first_value = value
+    return first_value, params
+
+
+class AiqiyiSearchIndex:
+    """
+    Indexed view over a homePageV3 search response.
+
+    The templates are walked once; afterwards albums, episodes and their durations
+    can be resolved in O(1) by qipuId, tvid or playUrl.
+    """
+
+    def __init__(self, data):
+        self.albums = {}       # 专辑 qipuId -> {'info': 主视频信息, 'episodes': 集数列表}
+        self.videos = {}       # qipuId -> 视频信息（专辑与单集）
+        self.by_tvid = {}      # playUrl 中的 tvid -> 视频信息
+        self.by_play_url = {}  # playUrl 首个参数值 / 原始 playUrl -> 视频信息
+        if data and 'data' in data and 'templates' in data['data']:
+            for template in data['data']['templates']:
+                if 'albumInfo' in template:
+                    self._add_album(template['albumInfo'])
+
+    def _make_info(self, item, default_title=''):
+        play_url, params = parse_play_url(item.get('playUrl', ''))
+        info = {
+            'title': item.get('title', default_title),
+            'playUrl': play_url,
+            'duration': item.get('duration', 0),
+            'qipuId': item.get('qipuId', ''),
+            'number': item.get('number', '')
+        }
+        return info, params
+
+    def _register(self, info, params, raw_play_url):
+        qipu_id = str(info['qipuId'])
+        if qipu_id:
+            self.videos.setdefault(qipu_id, info)
+        if params.get('tvid'):
+            self.by_tvid.setdefault(str(params['tvid']), info)
+        if info['playUrl']:
+            self.by_play_url.setdefault(info['playUrl'], info)
+        if raw_play_url:
+            self.by_play_url.setdefault(raw_play_url, info)
+
+    def _add_album(self, album_info):
+        main_info, params = self._make_info(album_info)
+        episodes = []
+        if isinstance(album_info.get('videos'), list):
+            for video in album_info['videos']:
+                episode, episode_params = self._make_info(video, '未知集数')
+                episodes.append(episode)
+                self._register(episode, episode_params, video.get('playUrl', ''))
+        album_id = str(album_info.get('qipuId', ''))
+        if album_id and album_id not in self.albums:
+            self.albums[album_id] = {'info': main_info, 'episodes': episodes}
+        self._register(main_info, params, album_info.get('playUrl', ''))
+
+    def lookup(self, key):
+        """按 qipuId、playUrl 或 tvid 查找视频信息，未找到返回 None"""
+        key = str(key)
+        return self.videos.get(key) or self.by_play_url.get(key) or self.by_tvid.get(key)
+
+    def get_duration(self, key, default=None):
+        """返回视频时长（毫秒），未找到或时长缺失时返回 default"""
+        info = self.lookup(key)
+        if info and info.get('duration'):
+            return info['duration']
+        return default
+
+    def get_video_info(self, target_qipu_id):
+        """
+        Resolve a qipuId to an episode list (albums with videos) or a single video dict.
+        """
+        key = str(target_qipu_id)
+        album = self.albums.get(key)
+        if album:
+            if album['episodes']:
+                return album['episodes']
+            return album['info']
+        return self.videos.get(key)
+
+
+def _is_fatal(result):
+    return isinstance(result, Exception) and (is_overload(result) or isinstance(result, CircuitOpenError))
+
 
 class AiqiyiVideoScraper:
     """
     A class for scraping video lists, video details, and fetching danmu (comments) from Aiqiyi Video.
     """
 
+    CSV_FIELDS = ['time_offset', 'create_time', 'content']
+    SEGMENT_HOST = "cmts.iqiyi.com"
+    _danmu_message_class = None  # 进程内共享的 protobuf 消息类，首次解析弹幕时构建
+
     def __init__(self, base_dir="."):
         self.base_dir = base_dir
         os.makedirs(base_dir, exist_ok=True)
-        self._init_protobuf()
+
+    @property
+    def DanmuMessage(self):
+        """Protobuf message class for danmu parsing, built on first use"""
+        if AiqiyiVideoScraper._danmu_message_class is None:
+            AiqiyiVideoScraper._danmu_message_class = self._init_protobuf()
+        return AiqiyiVideoScraper._danmu_message_class
 
     def _init_protobuf(self):
         """Initialize protobuf message types for danmu parsing"""
+        from google.protobuf import descriptor_pool, message_factory, descriptor_pb2
+
         pool = descriptor_pool.DescriptorPool()
         pool.Add(descriptor_pb2.FileDescriptorProto(
             name='danmu.proto',
@@ -74,7 +193,7 @@ class AiqiyiVideoScraper:
                 ),
             ]
         ))
-        self.DanmuMessage = message_factory.GetMessageClass(pool.FindMessageTypeByName('danmu.Danmu'))
+        return message_factory.GetMessageClass(pool.FindMessageTypeByName('danmu.Danmu'))
 
     def get_video_list(self, query):
         """
@@ -133,7 +252,7 @@ class AiqiyiVideoScraper:
                         album_info = template['albumInfo']
                         results.append({
                             'title': album_info.get('title', ''),
-                            'playUrl': album_info.get('playUrl', '').split(';')[0].split('=')[1] if album_info.get('playUrl') else '',
+                            'playUrl': parse_play_url(album_info.get('playUrl', ''))[0],
                             'qipuId': album_info.get('qipuId', ''),
                             'duration': album_info.get('duration', 0)
                         })
@@ -143,116 +262,45 @@ class AiqiyiVideoScraper:
             print(f"获取视频列表失败: {e}")
             return [], None
 
+    def build_index(self, data):
+        """
+        Build an indexed view over the raw search response returned by get_video_list.
+
+        Parameters:
+        - data: The full JSON response from get_video_list (or an existing index)
+
+        Returns:
+        - AiqiyiSearchIndex: Index supporting O(1) lookup by qipuId, tvid and playUrl
+        """
+        if isinstance(data, AiqiyiSearchIndex):
+            return data
+        return AiqiyiSearchIndex(data)
+
     def get_video_info(self, data, target_qipu_id):
         """
         Extract video details from the given data.
 
         Parameters:
-        - data: The full JSON response from get_video_list
+        - data: The full JSON response from get_video_list, or an index built by build_index
         - target_qipu_id: The target qipuId to extract info from
 
         Returns:
         - dict or list: Dictionary containing video details or list of episodes
         """
         try:
-            # 转为字符串，以统一比较格式
-            target_qipu_id_str = str(target_qipu_id)
-            
-            if 'data' in data and 'templates' in data['data']:
-                episodes = []
-                main_video_info = None
-                for template in data['data']['templates']:
-                    if 'albumInfo' in template:
-                        album_info = template['albumInfo']
-                        album_qipu_id_str = str(album_info.get('qipuId', ''))
-                        
-                        # 如果找到匹配的视频ID
-                        if album_qipu_id_str == target_qipu_id_str:
-                            # 提取主视频信息
-                            main_video_info = {
-                                'title': album_info.get('title', ''),
-                                'playUrl': album_info.get('playUrl', '').split(';')[0].split('=')[1] if album_info.get('playUrl') else '',
-                                'duration': album_info.get('duration', 0)
-                            }
-                            
-                            # 提取集数信息 (如果存在videos字段)
-                            if 'videos' in album_info and isinstance(album_info['videos'], list):
-                                for video in album_info['videos']:
-                                    # 提取集数信息
-                                    episode = {
-                                        'title': video.get('title', '未知集数'),
-                                        'playUrl': video.get('playUrl', '').split(';')[0].split('=')[1] if video.get('playUrl') else '',
-                                        'duration': video.get('duration', 0),
-                                        'qipuId': video.get('qipuId', ''),
-                                        'number': video.get('number', '')
-                                    }
-                                    episodes.append(episode)
-                                
-                                # 如果找到了集数，则返回集数列表
-                                if episodes:
-                                    print(f"找到 {len(episodes)} 个集数")
-                                    return episodes
-                            
-                            # 如果没有集数，则返回主视频信息
-                            return main_video_info
-                        
-                        # 尝试在视频单集中寻找匹配
-                        if 'videos' in album_info and isinstance(album_info['videos'], list):
-                            for video in album_info['videos']:
-                                video_qipu_id_str = str(video.get('qipuId', ''))
-                                if video_qipu_id_str == target_qipu_id_str:
-                                    # 返回单集信息
-                                    return {
-                                        'title': video.get('title', ''),
-                                        'playUrl': video.get('playUrl', '').split(';')[0].split('=')[1] if video.get('playUrl') else '',
-                                        'duration': video.get('duration', 0)
-                                    }
-            
-            # 如果通过正常方式未找到，尝试在整个数据中搜索
-            print(f"未在主结构中找到视频 {target_qipu_id}，尝试深度搜索...")
-            return self._deep_search_video(data, target_qipu_id_str)
-            
+            index = self.build_index(data)
+            result = index.get_video_info(target_qipu_id)
+            if result is None:
+                print(f"在数据中未找到视频 {target_qipu_id}")
+            elif isinstance(result, list):
+                print(f"找到 {len(result)} 个集数")
+            return result
+
         except Exception as e:
             print(f"提取视频信息时出错: {e}")
             import traceback
             traceback.print_exc()
             return None
-            
-    def _deep_search_video(self, data, target_qipu_id_str):
-        """深度搜索视频信息，处理复杂的嵌套结构"""
-        try:
-            # 在templates中搜索
-            if 'data' in data and 'templates' in data['data']:
-                for template in data['data']['templates']:
-                    # 处理albumInfo情况
-                    if 'albumInfo' in template:
-                        album_info = template['albumInfo']
-                        
-                        # 检查qipuId
-                        if str(album_info.get('qipuId', '')) == target_qipu_id_str:
-                            return {
-                                'title': album_info.get('title', ''),
-                                'playUrl': album_info.get('playUrl', '').split(';')[0].split('=')[1] if album_info.get('playUrl') else '',
-                                'duration': album_info.get('duration', 0)
-                            }
-                            
-                        # 检查videos数组
-                        if 'videos' in album_info:
-                            for video in album_info['videos']:
-                                if str(video.get('qipuId', '')) == target_qipu_id_str:
-                                    return {
-                                        'title': video.get('title', ''),
-                                        'playUrl': video.get('playUrl', '').split(';')[0].split('=')[1] if video.get('playUrl') else '',
-                                        'duration': video.get('duration', 0)
-                                    }
-            
-            # 如果仍未找到，返回None
-            print(f"在数据中未找到视频 {target_qipu_id_str}")
-            return None
-            
-        except Exception as e:
-            print(f"深度搜索视频时出错: {e}")
-            return None
 
     def _generate_danmu_hash(self, tvid, seq_num):
         """Generate hash for danmu request"""
@@ -265,66 +313,140 @@ class AiqiyiVideoScraper:
         
         return hash_value
 
-    def fetch_danmu(self, vid, duration):
+    def _fetch_segment(self, vid, seq_num):
+        """
+        Fetch and decode one 60s danmu segment.
+
+        Returns:
+        - list of tuple: (time_offset, create_time, content) rows, or None when the segment is unavailable.
+
+        Raises requests.HTTPError on 429/5xx so the per-host limiter sees the overload.
         """
-        Fetch danmu for a single video and save it to a CSV file.
+        import brotli
+
+        hash_value = self._generate_danmu_hash(vid, seq_num)
+        url = f"https://cmts.iqiyi.com/bullet/{vid[-4:-2]}/{vid[-2:]}/{vid}_60_{seq_num}_{hash_value}.br"
+        print(f"获取片段 {seq_num}: {url}")
+
+        with span("iqiyi.segment.http", segment=seq_num) as http_span:
+            response = requests.get(url)
+            http_span.set_attributes(status=response.status_code, bytes=len(response.content))
+        if response.status_code in OVERLOAD_STATUSES or response.status_code >= 500:
+            response.raise_for_status()
+        if response.status_code != 200:
+            return None
+
+        with span("iqiyi.segment.decode", segment=seq_num) as decode_span:
+            danmu_msg = self.DanmuMessage()
+            danmu_msg.ParseFromString(brotli.decompress(response.content))
+
+            create_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            rows = []
+            for entry in danmu_msg.entry:
+                for bullet in entry.bulletInfo:
+                    try:
+                        show_time = int(bullet.showTime)
+                    except ValueError:
+                        show_time = 0
+
+                    if bullet.content:
+                        rows.append((show_time*1000, create_time, bullet.content))
+            decode_span.set_attribute("comments", len(rows))
+        return rows
+
+    def segment_count(self, vid, duration=None):
+        """
+        Resolve the number of 60s segments.
 
         Parameters:
         - vid (str): The video ID
-        - duration (int): Video duration in milliseconds
+        - duration (int): Duration in milliseconds from metadata, if known (cached for next time)
 
         Returns:
-        - str: Path to the CSV file containing the fetched danmu
+        - tuple: (segment count, {segment index: rows} already fetched while probing). Without a cached
+          or given duration the segments are probed (see danmu_duration); segments past the end return 404.
         """
-        print(f"正在获取视频 {vid} 的弹幕")
-        i_length = ceil(duration/60000)
-        danmus = []
-        
-        vid_group1 = vid[-4:-2]
-        vid_group2 = vid[-2:]
-        
-        for i in range(1, i_length + 1):
-            hash_value = self._generate_danmu_hash(vid, i)
-            url = f"https://cmts.iqiyi.com/bullet/{vid_group1}/{vid_group2}/{vid}_60_{i}_{hash_value}.br"
-            print(f"获取片段 {i}: {url}")
-            
+        probed = {}
+
+        def fetch(i):
             try:
-                response = requests.get(url)
-                if response.status_code != 200:
-                    continue
-                    
-                dm_dc = brotli.decompress(response.content)
-                danmu_msg = self.DanmuMessage()
-                danmu_msg.ParseFromString(dm_dc)
-                
-                for entry in danmu_msg.entry:
-                    for bullet in entry.bulletInfo:
-                        try:
-                            show_time = int(bullet.showTime)
-                        except ValueError:
-                            show_time = 0
-                            
-                        if bullet.content:
-                            danmus.append({
-                                'time_offset': show_time*1000,
-                                'create_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                                'content': bullet.content
-                            })
-                            
+                return fetch_one("iqiyi", self.SEGMENT_HOST, self._fetch_segment, vid, i)
             except Exception as e:
-                print(f"处理片段 {i} 时出错: {e}")
-                continue
-
-        if danmus:
-            df = pd.DataFrame(danmus)
-            output_path = os.path.join(self.base_dir, f"video_{vid}_{len(danmus)}_danmu.csv")
-            df.to_csv(output_path, encoding="utf-8", index=False)
-            print(f"已保存 {len(danmus)} 条弹幕到 {output_path}")
-            return output_path
-            
-        print(f"未获取到视频ID为 {vid} 的弹幕数据")
+                if _is_fatal(e):
+                    raise
+                return e  # 解码失败等：分段存在，全量抓取时跳过
+
+        def probe():
+            count, results = probe_segments(fetch, lambda rows: rows is not None, first=1)
+            probed.update(results)
+            return count * 60000
+
+        duration = DURATIONS.resolve("iqiyi", vid, metadata=lambda: duration, probe=probe)
+        return ceil(duration / 60000), {i: rows for i, rows in probed.items() if rows is not None}
+
+    def fetch_episode(self, vid, duration=None, progress=None):
+        """
+        Fetch danmu for a single video into memory.
+
+        Segments are fetched in parallel under the shared per-host concurrency limit
+        (see segment_fetcher) and collected in order. Fetched segments are
+        checkpointed (see danmu_checkpoint), so a failed episode resumes from the missing segments.
+
+        Parameters:
+        - vid (str): The video ID
+        - duration (int): Video duration in milliseconds; None to use the cached duration or probe segments
+        - progress (callable): Optional callback progress(done, total) invoked after each segment
+
+        Returns:
+        - EpisodeDanmu: The rows and how to save them (see danmu_records); None when there is none
+          (reported as no_danmaku when every segment was read, see danmu_negative)
+        """
+        print(f"正在获取视频 {vid} 的弹幕")
+        i_length, probed = self.segment_count(vid, duration)
+
+        # 重试后仍为瞬时失败（或熔断）时整集失败；其他错误（如解码失败）只跳过该片段
+        checkpoint = SegmentCheckpoint("iqiyi", vid)
+        segments = fetch_segments("iqiyi", self.SEGMENT_HOST, lambda i: self._fetch_segment(vid, i),
+                                  range(1, i_length + 1), stop=_is_fatal, known=probed, checkpoint=checkpoint)
+        collected = []
+        skipped = 0
+        for i, rows in segments:
+            if _is_fatal(rows):
+                print(f"处理片段 {i} 时出错: {rows}")
+                raise rows
+            if isinstance(rows, Exception):
+                print(f"处理片段 {i} 时出错: {rows}")
+                skipped += 1
+            elif rows:
+                collected.extend(rows)
+            if progress:
+                progress(i, i_length)
+
+        if collected:
+            path = os.path.join(self.base_dir, f"video_{vid}_{len(collected)}_danmu.csv")
+            return EpisodeDanmu(self.CSV_FIELDS, collected, path, "time_offset", checkpoint=checkpoint)
+
+        checkpoint.discard()
+        if skipped:
+            print(f"未获取到视频ID为 {vid} 的弹幕数据（{skipped} 个片段出错）")
+        else:
+            report(EMPTY, f"视频 {vid} 没有弹幕")
         return None
 
+    def fetch_danmu(self, vid, duration=None, progress=None):
+        """
+        Fetch danmu for a single video and save it to a CSV file (see fetch_episode).
+
+        Returns:
+        - str: Path to the CSV file containing the fetched danmu; None when there is none
+        """
+        episode = self.fetch_episode(vid, duration, progress)
+        if episode is None:
+            return None
+        output_path = episode.save()
+        print(f"已保存 {episode.count} 条弹幕到 {output_path}")
+        return output_path
+
 if __name__ == "__main__":
     scraper = AiqiyiVideoScraper(base_dir="danmu_data")
     query = "北上"
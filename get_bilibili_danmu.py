@@ -1,16 +1,21 @@
 import requests
 import time
 import hashlib
+import functools
 import random
 import string
 import json
 import re
-import csv
 import os
 from datetime import datetime
-from tqdm import tqdm
+from circuit_breaker import CircuitOpenError, retry_call
+from danmu_negative import EMPTY, UNRESOLVED, report
+from danmu_records import EpisodeDanmu
+from danmu_tracing import span
 
 class BilibiliVideoScraper:
+    CSV_FIELDS = ['timepoint', 'ct', 'content', 'id']
+
     def __init__(self, base_dir="danmu_data"):
         self.base_dir = base_dir
         self.data_list = []
@@ -25,64 +30,49 @@ class BilibiliVideoScraper:
         os.makedirs(self.danmu_dir, exist_ok=True)
 
     def request_data(self, method, url, **kwargs):
-        """发送HTTP请求"""
+        """发送HTTP请求，瞬时失败时经熔断器重试（见 circuit_breaker），最终失败返回 None"""
         try:
-            response = requests.request(method, url, headers=self.headers, **kwargs)
-            response.raise_for_status()
-            response.encoding = 'utf-8'
-            return response
-        except requests.RequestException as e:
+            return retry_call("bilibili", functools.partial(self._request, method, url, **kwargs))
+        except (requests.RequestException, CircuitOpenError) as e:
             print(f"请求失败: {e}")
             return None
 
+    def _request(self, method, url, **kwargs):
+        response = requests.request(method, url, headers=self.headers, **kwargs)
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+        return response
+
     def parse_danmaku(self, xml_data):
         """解析XML格式的弹幕数据"""
-        self.data_list = []
+        # 使用局部列表，同一爬虫实例被多个线程并发调用时互不影响
+        parsed = []
         try:
             if isinstance(xml_data, bytes):
                 xml_data = xml_data.decode('utf-8')
             
             data_list = re.findall('<d p="(.*?)">(.*?)<\/d>', xml_data)
-            for data in tqdm(data_list, desc="解析弹幕"):
+            for data in data_list:
                 try:
                     data_time = data[0].split(",")
-                    self.data_list.append({
+                    parsed.append({
                         "timepoint": int(float(data_time[0]) * 1000),
                         "ct": data_time[1],
-                        "content": data[1].encode('utf-8').decode('utf-8')
+                        "content": data[1].encode('utf-8').decode('utf-8'),
+                        # p 属性第 8 项为弹幕行ID（rowId），增量刷新时据此去重
+                        "id": data_time[7] if len(data_time) > 7 else ""
                     })
                 except UnicodeError:
                     continue
                 
-            self.data_list.sort(key=lambda x: x['timepoint'])
-            return self.data_list
+            parsed.sort(key=lambda x: x['timepoint'])
+            self.data_list = parsed
+            return parsed
             
         except Exception as e:
             print(f"解析弹幕时出错: {e}")
             return []
 
-    def save_to_csv(self, data_list, filename):
-        """保存弹幕数据到CSV文件"""
-        if not data_list:
-            print("没有数据可保存")
-            return None
-            
-        filepath = os.path.join(self.danmu_dir, filename)
-        fieldnames = ['timepoint', 'ct', 'content']
-        
-        try:
-            with open(filepath, 'w', newline='', encoding='utf-8-sig') as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                for item in data_list:
-                    row = {k: str(v) for k, v in item.items()}
-                    writer.writerow(row)
-            print(f"弹幕已保存到: {filepath}")
-            return filepath
-        except Exception as e:
-            print(f"保存文件失败: {e}")
-            return None
-
     def get_video_list(self, keyword):
         """搜索视频列表"""
         results = []
@@ -180,103 +170,122 @@ class BilibiliVideoScraper:
             print(f"获取视频信息失败: {e}")
             return []
 
-    def fetch_danmu(self, url, title=None):
-        """获取弹幕数据"""
+    def _resolve_cid(self, url):
+        """
+        解析番剧 / 普通视频链接对应的弹幕 cid，失败时返回 None。
+
+        链接格式不支持或上游确认视频不存在时报告 unresolved（见 danmu_negative），请求失败则不报告。
+        """
+        # 判断链接类型
+        if "bangumi/play/ep" in url:
+            # 从URL中提取epid
+            epid = url.split('?')[0].split('/')[-1]
+            if not epid.startswith('ep'):
+                report(UNRESOLVED, f"无效的URL格式: {url}")
+                return None
+
+            params = {"ep_id": epid[2:]}
+            res = self.request_data("GET", self.api_epid_cid, params=params)
+            if not res:
+                return None
+
+            res_json = res.json()
+            if res_json.get("code") != 0:
+                report(UNRESOLVED, f"获取番剧信息失败: {res_json.get('message', res_json.get('code'))}")
+                return None
+
+            for episode in res_json.get("result", {}).get("episodes", []):
+                if episode.get("id", 0) == int(epid[2:]):
+                    return episode.get("cid")
+
+            report(UNRESOLVED, f"未找到对应剧集: {epid}")
+            return None
+
+        # 普通视频
+        elif "video/BV" in url or "video/av" in url:
+            if "video/BV" in url:
+                # 提取BV号
+                bvid = url.split('?')[0].split('/')[-1]
+                params = {"bvid": bvid}
+            else:
+                # 提取av号
+                aid = url.split('?')[0].split('/')[-1]
+                if aid.startswith('av'):
+                    aid = aid[2:]
+                params = {"aid": aid}
+
+            # 获取视频信息
+            res = self.request_data("GET", self.api_video_info, params=params)
+            if not res:
+                return None
+
+            res_json = res.json()
+            if res_json.get("code") != 0:
+                report(UNRESOLVED, f"获取视频信息失败: {res_json.get('message', res_json.get('code'))}")
+                return None
+
+            cid = res_json.get("data", {}).get("cid")
+            if not cid:
+                report(UNRESOLVED, "未找到视频cid")
+            return cid
+
+        report(UNRESOLVED, f"不支持的URL格式: {url}")
+        return None
+
+    def fetch_danmu_list(self, url, progress=None):
+        """获取并解析一集的全部弹幕（不保存），失败时返回 None"""
         try:
-            # 判断链接类型
-            if "bangumi/play/ep" in url:
-                # 从URL中提取epid
-                epid = url.split('?')[0].split('/')[-1]
-                if not epid.startswith('ep'):
-                    print("无效的URL格式")
-                    return None
-                    
-                params = {"ep_id": epid[2:]}
-                res = self.request_data("GET", self.api_epid_cid, params=params)
-                if not res:
-                    return None
-                    
-                res_json = res.json()
-                if res_json.get("code") != 0:
-                    print("获取番剧信息失败")
-                    return None
-                    
-                # 获取cid并下载弹幕
-                for episode in res_json.get("result", {}).get("episodes", []):
-                    if episode.get("id", 0) == int(epid[2:]):
-                        xml_res = self.request_data("GET", f'https://comment.bilibili.com/{episode.get("cid")}.xml')
-                        if not xml_res:
-                            return None
-                            
-                        danmu_list = self.parse_danmaku(xml_res.text)
-                        if not danmu_list:
-                            return None
-                            
-                        # 生成文件名
-                        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                        filename = f"{title or 'bilibili'}_{timestamp}.csv"
-                        
-                        # 保存弹幕
-                        return self.save_to_csv(danmu_list, filename)
-                        
-                print("未找到对应剧集")
+            cid = self._resolve_cid(url)
+            if not cid:
                 return None
-            
-            # 普通视频
-            elif "video/BV" in url or "video/av" in url:
-                bvid = None
-                aid = None
-                
-                if "video/BV" in url:
-                    # 提取BV号
-                    bvid = url.split('?')[0].split('/')[-1]
-                    params = {"bvid": bvid}
-                else:
-                    # 提取av号
-                    aid = url.split('?')[0].split('/')[-1]
-                    if aid.startswith('av'):
-                        aid = aid[2:]
-                    params = {"aid": aid}
-                
-                # 获取视频信息
-                res = self.request_data("GET", self.api_video_info, params=params)
-                if not res:
-                    return None
-                
-                res_json = res.json()
-                if res_json.get("code") != 0:
-                    print("获取视频信息失败")
-                    return None
-                
-                # 获取cid并下载弹幕
-                cid = res_json.get("data", {}).get("cid")
-                if not cid:
-                    print("未找到视频cid")
-                    return None
-                
+
+            with span("bilibili.xml", cid=cid) as xml_span:
                 xml_res = self.request_data("GET", f'https://comment.bilibili.com/{cid}.xml')
-                if not xml_res:
-                    return None
-                
+                xml_span.set_attribute("bytes", len(xml_res.content) if xml_res else 0)
+            if progress:
+                progress(1, 1)
+            if not xml_res:
+                return None
+
+            with span("bilibili.parse") as parse_span:
                 danmu_list = self.parse_danmaku(xml_res.text)
-                if not danmu_list:
-                    return None
-                
-                # 生成文件名
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                filename = f"{title or 'bilibili'}_{timestamp}.csv"
-                
-                # 保存弹幕
-                return self.save_to_csv(danmu_list, filename)
-            
-            else:
-                print("不支持的URL格式")
+                parse_span.set_attribute("comments", len(danmu_list))
+            if not danmu_list:
+                report(EMPTY, f"cid {cid} 没有弹幕")
                 return None
-            
+            return danmu_list
         except Exception as e:
             print(f"获取弹幕失败: {e}")
             return None
 
+    def fetch_episode(self, url, title=None, progress=None):
+        """
+        获取一集弹幕到内存，progress(done, total) 为可选的进度回调（整集弹幕为单个 XML，视为 1 段）。
+
+        返回 EpisodeDanmu（见 danmu_records，save() 写入 CSV），失败或没有弹幕时返回 None。
+        """
+        danmu_list = self.fetch_danmu_list(url, progress)
+        if not danmu_list:
+            return None
+
+        # 生成文件名
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filepath = os.path.join(self.danmu_dir, f"{title or 'bilibili'}_{timestamp}.csv")
+        return EpisodeDanmu.from_dicts(self.CSV_FIELDS, danmu_list, filepath, "timepoint", encoding='utf-8-sig')
+
+    def fetch_danmu(self, url, title=None, progress=None):
+        """获取弹幕数据并保存为 CSV（见 fetch_episode），返回文件路径，失败时返回 None"""
+        episode = self.fetch_episode(url, title, progress)
+        if episode is None:
+            return None
+        try:
+            filepath = episode.save()
+        except Exception as e:
+            print(f"保存文件失败: {e}")
+            return None
+        print(f"弹幕已保存到: {filepath}")
+        return filepath
+
     def _generate_qv_id(self):
         """生成搜索请求用的qv_id"""
         return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(32))
@@ -4,15 +4,24 @@ import uuid
 import json
 import time
 import os
+import threading
 import csv
 from datetime import datetime
 import urllib.parse
-from tqdm import tqdm
+from circuit_breaker import is_transient, retry_call
+from danmu_checkpoint import SegmentCheckpoint
+from danmu_negative import EMPTY, UNRESOLVED, report
+from danmu_duration import DURATIONS, probe_segments
+from danmu_records import EpisodeDanmu
+from danmu_tracing import span
+from segment_fetcher import fetch_one, fetch_segments
 
 class MgtvVideoScraper:
     """芒果TV视频信息获取类"""
+    CSV_FIELDS = ['time', 'color', 'content']
+
     def __init__(self, base_dir="danmu_data"):
-        self.session = requests.Session()
+        self._local = threading.local()
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
             "Accept": "application/json, text/plain, */*",
@@ -26,6 +35,14 @@ class MgtvVideoScraper:
         self.save_dir = os.path.join(base_dir, "mgtv")
         os.makedirs(self.save_dir, exist_ok=True)
 
+    @property
+    def session(self):
+        """当前线程的 requests.Session：分段在 segment_fetcher 线程池中并行请求，Session 不保证线程安全"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
     def get_video_list(self, keyword):
         """获取视频列表"""
         searcher = MgtvSearch()
@@ -221,47 +238,107 @@ class MgtvVideoScraper:
         
         return episodes
 
-    def fetch_danmu(self, url, title):
-        """获取视频弹幕"""
+    def fetch_episode(self, url, title, progress=None):
+        """
+        获取视频弹幕到内存，progress(done, total) 为可选的分段进度回调。
+
+        返回 EpisodeDanmu（见 danmu_records，save() 写入 CSV）；没有弹幕或链接无法解析时返回 None 并报告原因
+        （见 danmu_negative）；熔断或重试用尽后的瞬时失败向上抛出（见 circuit_breaker.is_transient），其余失败返回 None。
+        """
+        # 从URL中提取cid和vid，如 https://www.mgtv.com/b/<cid>/<vid>.html
+        parts = url.split(".")
+        _u = parts[-2].split("/") if len(parts) >= 2 else []
+        if len(_u) < 2 or not _u[-2] or not _u[-1]:
+            report(UNRESOLVED, f"不支持的芒果TV链接: {url}")
+            return None
+        cid = _u[-2]
+        vid = _u[-1]
         try:
-            # 从URL中提取cid和vid
-            _u = url.split(".")[-2].split("/")
-            cid = _u[-2]
-            vid = _u[-1]
-            
-            # 获取视频信息
-            params = {'cid': cid, 'vid': vid}
-            res = self.session.get(self.api_video_info, params=params, headers=self.headers)
-            video_info = res.json()
-            
-            # 获取视频时长
-            _time = video_info.get("data", {}).get("info", {}).get("time", "00:00:00")
-            end_time = self._time_to_second(_time.split(":"))
-            
-            # 分段获取弹幕
+            # 视频时长：缓存 -> video/info -> 分段探测（见 danmu_duration）
+            host = urllib.parse.urlsplit(self.api_danmaku).hostname
+            probed = {}
+
+            def fetch(i):
+                return self._fetch_segment(vid, cid, i * 60000)
+
+            def probe():
+                count, results = probe_segments(lambda i: fetch_one("mgtv", host, fetch, i), bool)
+                probed.update({i: items for i, items in results.items() if items})
+                return count * 60000
+
+            end_time = DURATIONS.resolve("mgtv", vid, metadata=lambda: self._video_duration(cid, vid), probe=probe)
+
+            # 分段并行获取弹幕（受 galaxy.bz.mgtv.com 的自适应并发上限约束），按分段顺序合并；
+            # 已取得的分段写入断点，失败后再次获取同一集时只请求缺失的分段
             danmu_list = []
-            for _t in tqdm(range(0, end_time, 60 * 1000), desc="获取弹幕中"):
-                response = self.session.get(
-                    self.api_danmaku,
-                    params={'vid': vid, "cid": cid, "time": _t},
-                    headers=self.headers
-                )
-                data = response.json()
-                if data.get("data", {}).get("items"):
-                    for item in data["data"]["items"]:
-                        danmu_list.append([
-                            item.get('time', 0),  # 时间戳
-                            item.get('color', 16777215),  # 颜色
-                            item.get('content', '')  # 内容
-                        ])
+            segments = range(-(-end_time // 60000))
+            checkpoint = SegmentCheckpoint("mgtv", vid)
+            results = fetch_segments("mgtv", host, fetch, segments,
+                                     stop=lambda items: isinstance(items, Exception), known=probed, checkpoint=checkpoint)
+            for done, (_, items) in enumerate(results, 1):
+                if isinstance(items, Exception):
+                    raise items
+                danmu_list.extend(items)
+                if progress:
+                    progress(done, len(segments))
             
-            # 保存弹幕
-            return self._save_danmu(danmu_list, title)
+            if not danmu_list:
+                checkpoint.discard()
+                report(EMPTY, f"视频 {vid} 没有弹幕")
+                return None
+
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            return EpisodeDanmu(self.CSV_FIELDS, danmu_list, os.path.join(self.save_dir, f"{title}_{timestamp}.csv"), "time",
+                                checkpoint=checkpoint, escapechar='\\', quoting=csv.QUOTE_MINIMAL)
             
         except Exception as e:
+            if is_transient(e):
+                raise
             print(f"获取弹幕出错: {e}")
             return None
 
+    def fetch_danmu(self, url, title, progress=None):
+        """获取视频弹幕并保存为 CSV（见 fetch_episode），返回文件路径，失败时返回 None"""
+        episode = self.fetch_episode(url, title, progress)
+        if episode is None:
+            return None
+        filepath = episode.save()
+        print(f"\n--- 弹幕保存到文件 {filepath} ---")
+        print("--- 完成 ---")
+        return filepath
+
+    def _video_duration(self, cid, vid):
+        """从 video/info 获取视频时长（毫秒），缺失时返回 None"""
+        video_info = retry_call("mgtv", self._get_json, self.api_video_info, {'cid': cid, 'vid': vid})
+        _time = video_info.get("data", {}).get("info", {}).get("time", "00:00:00")
+        return self._time_to_second(_time.split(":")) or None
+
+    def _get_json(self, url, params):
+        response = self.session.get(url, params=params, headers=self.headers)
+        response.raise_for_status()
+        return response.json()
+
+    def _fetch_segment(self, vid, cid, _t):
+        """获取从 _t 毫秒开始的一分钟弹幕，返回 [时间, 颜色, 内容] 列表"""
+        with span("mgtv.segment", start=_t) as segment_span:
+            response = self.session.get(
+                self.api_danmaku,
+                params={'vid': vid, "cid": cid, "time": _t},
+                headers=self.headers
+            )
+            response.raise_for_status()
+            data = response.json()
+            items = data.get("data", {}).get("items") or []
+            segment_span.set_attributes(bytes=len(response.content), comments=len(items))
+        return [
+            [
+                item.get('time', 0),  # 时间戳
+                item.get('color', 16777215),  # 颜色
+                item.get('content', '')  # 内容
+            ]
+            for item in items
+        ]
+
     def _time_to_second(self, time_parts):
         """将时间转换为毫秒数"""
         if len(time_parts) == 3:  # HH:MM:SS
@@ -270,21 +347,6 @@ class MgtvVideoScraper:
             return int(time_parts[0]) * 60 * 1000 + int(time_parts[1]) * 1000
         return 0
 
-    def _save_danmu(self, danmu_list, title):
-        """保存弹幕到CSV文件"""
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{title}_{timestamp}.csv"
-        filepath = os.path.join(self.save_dir, filename)
-        
-        with open(filepath, 'w', encoding='utf-8', newline='') as f:
-            writer = csv.writer(f, escapechar='\\', quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(['time', 'color', 'content'])  # 写入表头
-            writer.writerows(danmu_list)
-            
-        print(f"\n--- 弹幕保存到文件 {filepath} ---")
-        print("--- 完成 ---")
-        return filepath
-
 class MgtvSearch:
     """芒果TV搜索类"""
     def __init__(self):
@@ -2,15 +2,24 @@ import os
 import requests
 import urllib.parse
 import re
-import pandas as pd
-from bs4 import BeautifulSoup
 import json
 import uuid
+from danmu_checkpoint import SegmentCheckpoint
+from danmu_negative import EMPTY, report
+from danmu_records import EpisodeDanmu
+from danmu_tracing import span
+from danmu_duration import DURATIONS, probe_segments
+from segment_fetcher import fetch_one, fetch_segments
+
 class TencentVideoScraper:
     """
     A class for scraping video lists, video details, and fetching danmu (comments) from Tencent Video.
     """
 
+    CSV_FIELDS = ['time_offset', 'create_time', 'content', 'id']
+    SEGMENT_STEP = 30000
+    SEGMENT_HOST = "dm.video.qq.com"
+
     def __init__(self, base_dir="."):
         self.base_dir = base_dir
         os.makedirs(base_dir, exist_ok=True)
@@ -385,53 +394,114 @@ class TencentVideoScraper:
             print(f"Error in _get_next_page_episodes: {e}")
             return []
 
-    def fetch_danmu(self, video_code, num=10000, step=30000):
+    def _fetch_segment(self, video_code, start, end):
+        """
+        Fetch one barrage segment and extract the CSV rows.
+
+        Returns:
+        - list of tuple: (time_offset, create_time, content, id) rows; empty when the segment has no danmu.
+        """
+        url = f'https://dm.video.qq.com/barrage/segment/{video_code}/t/v1/{start}/{end}'
+        with span("tencent.segment", start=start, end=end) as segment_span:
+            response = requests.get(url)
+            response.raise_for_status()
+            data = response.json()
+            rows = [
+                (barrage.get('time_offset', ''), barrage.get('create_time', ''), barrage.get('content', ''), barrage.get('id', ''))
+                for barrage in data.get("barrage_list") or []
+            ]
+            segment_span.set_attributes(bytes=len(response.content), comments=len(rows))
+        return rows
+
+    def segment_count(self, video_code, step=SEGMENT_STEP):
+        """
+        Resolve how many segments the video has.
+
+        Uses the cached duration when available, otherwise probes segments exponentially then by
+        binary search (see danmu_duration) and caches the result.
+
+        Returns:
+        - tuple: (segment count, {segment index: rows} already fetched while probing).
+        """
+        probed = {}
+
+        def fetch(i):
+            return fetch_one("tencent", self.SEGMENT_HOST, self._fetch_segment, video_code, i * step, (i + 1) * step)
+
+        def probe():
+            count, results = probe_segments(fetch, bool)
+            probed.update(results)
+            return count * step
+
+        duration = DURATIONS.resolve("tencent", video_code, probe=probe)
+        return -(-duration // step), {i: rows for i, rows in probed.items() if rows}
+
+    def fetch_episode(self, video_code, num=10000, step=SEGMENT_STEP, progress=None):
         """
-        Fetch danmu (barrage) for a single video code and save it to a CSV file.
+        Fetch danmu (barrage) for a single video code into memory.
+
+        The segment plan comes from segment_count, so no requests are made past the end of the video.
+        Segments are fetched in parallel under the shared per-host concurrency limit
+        (see segment_fetcher) and collected in order.
+        Fetched segments are checkpointed (see danmu_checkpoint): if the episode fails part way,
+        the next call for the same video only requests the missing segments.
 
         Parameters:
         - video_code (str): The unique code of the video.
         - num (int): Maximum number of requests (default: 10000).
         - step (int): Time range step in milliseconds for each request (default: 30000ms).
+        - progress (callable): Optional callback progress(done, total) invoked after each segment.
 
         Returns:
-        - str: Path to the CSV file containing the fetched danmu.
+        - EpisodeDanmu: The rows and how to save them (see danmu_records), or None when the video
+          has no danmu (reported as no_danmaku, see danmu_negative).
+
+        Raises the segment's error when it still fails after retries (or the circuit is open),
+        instead of returning a truncated episode.
         """
-        episodes_danmu_DataFrame = pd.DataFrame()
-        total_danmu_count = 0
+        count, probed = self.segment_count(video_code, step)
+        count = min(count, num)
 
-        for i in range(num):
-            url = f'https://dm.video.qq.com/barrage/segment/{video_code}/t/v1/{i * step}/{(i + 1) * step}'
-            try:
-                response = requests.get(url)
-                response.raise_for_status()
-                data = response.json()
+        def fetch(i):
+            return self._fetch_segment(video_code, i * step, (i + 1) * step)
 
-                if "barrage_list" in data and len(data["barrage_list"]) > 0:
-                    temp_danmu_DataFrame = pd.json_normalize(data["barrage_list"], errors='ignore')
-                    episodes_danmu_DataFrame = pd.concat([episodes_danmu_DataFrame, temp_danmu_DataFrame])
+        checkpoint = SegmentCheckpoint("tencent", f"{video_code}_{step}")
+        segments = fetch_segments("tencent", self.SEGMENT_HOST, fetch, range(count),
+                                  stop=lambda rows: isinstance(rows, Exception), known=probed, checkpoint=checkpoint)
+        collected = []
+        for i, rows in segments:
+            if isinstance(rows, Exception):
+                # 重试后仍失败时整集失败，不返回截断的弹幕
+                print(f"Error fetching segment {i * step}-{(i + 1) * step} of {video_code}: {rows}")
+                raise rows
+            if progress:
+                progress(i + 1, count)
 
-                    batch_count = temp_danmu_DataFrame.shape[0]
-                    total_danmu_count += batch_count
+            if rows:
+                collected.extend(rows)
+                print(f"Request #{i+1}: Retrieved {len(rows)} danmu, Total={len(collected)}")
 
-                    print(f"Request #{i+1}: Retrieved {batch_count} danmu, Total={total_danmu_count}")
-                else:
-                    print(f"No more danmu found at Request #{i+1}. Stopping.")
-                    break
+        if not collected:
+            checkpoint.discard()
+            report(EMPTY, f"视频 {video_code} 没有弹幕")
+            return None
 
-            except Exception as e:
-                print(f"Error fetching data from {url}: {e}")
-                break
-
-        if not episodes_danmu_DataFrame.empty:
-            output_path = os.path.join(self.base_dir, f"video_{video_code}_{total_danmu_count}_danmu.csv")
-            episodes_danmu_DataFrame = episodes_danmu_DataFrame.loc[:, ['time_offset', 'create_time', 'content']]
-            episodes_danmu_DataFrame.to_csv(output_path, mode='w', encoding="utf-8", errors='ignore', index=False)
-            print(f"Danmu saved to {output_path}")
-            return output_path
-
-        print(f"No danmu data fetched for video_code={video_code}.")
-        return None
+        path = os.path.join(self.base_dir, f"video_{video_code}_{len(collected)}_danmu.csv")
+        return EpisodeDanmu(self.CSV_FIELDS, collected, path, "time_offset", checkpoint=checkpoint, errors='ignore')
+
+    def fetch_danmu(self, video_code, num=10000, step=SEGMENT_STEP, progress=None):
+        """
+        Fetch danmu for a single video code and save it to a CSV file (see fetch_episode).
+
+        Returns:
+        - str: Path to the CSV file containing the fetched danmu, or None when the video has no danmu.
+        """
+        episode = self.fetch_episode(video_code, num, step, progress)
+        if episode is None:
+            return None
+        output_path = episode.save()
+        print(f"Danmu saved to {output_path}")
+        return output_path
 
 if __name__ == "__main__":
     scraper = TencentVideoScraper(base_dir="danmu_data")
@@ -6,11 +6,17 @@ import time
 import hashlib
 import base64
 import os
-import csv
 import asyncio
-from tqdm import tqdm
-from retrying import retry
-from datetime import datetime
+import functools
+import math
+from circuit_breaker import OVERLOAD_STATUSES, is_transient, retry_call_async
+from danmu_checkpoint import SegmentCheckpoint
+from danmu_negative import EMPTY, UNRESOLVED, report
+from danmu_duration import DURATIONS, probe_segments_async
+from danmu_records import EpisodeDanmu
+from danmu_metrics import aiohttp_trace_configs
+from danmu_tracing import span
+from segment_fetcher import fetch_one_async, fetch_segments_async
 
 class YoukuSearch:
     def __init__(self):
@@ -28,7 +34,7 @@ class YoukuSearch:
         url = f"https://so.youku.com/search_video/q_{encoded_keyword}"
         print(url)
         try:
-            async with aiohttp.ClientSession() as session:
+            async with aiohttp.ClientSession(trace_configs=aiohttp_trace_configs()) as session:
                 async with session.get(url, headers=self.headers) as response:
                     response.raise_for_status()
                     return await response.text()
@@ -89,36 +95,36 @@ class YoukuSearch:
         return results
 
 class GetDanmuYouku:
+    SEGMENT_HOST = "acs.youku.com"
+
     def __init__(self):
         self.cookies = {}
+        self.known_segments = {}
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
         }
 
-    @retry(stop_max_attempt_number=5, wait_random_min=1000, wait_random_max=2000)
     async def request_data(self, method, url, status_code=None, **kwargs):
-        for attempt in range(5):
-            try:
-                async with aiohttp.ClientSession(cookies=self.cookies) as session:
-                    async with session.request(method, url, **kwargs) as response:
-                        if status_code:
-                            if response.status == status_code:
-                                # 更新cookies
-                                self.cookies.update({k: v.value for k, v in response.cookies.items()})
-                                return response
-                            return None
+        """发送请求；瞬时失败（429 / 5xx / 连接失败）经阿酷的熔断器在全局重试预算内重试（见 circuit_breaker）"""
+        return await retry_call_async("youku", functools.partial(self._request_once, method, url, status_code, **kwargs))
+
+    async def _request_once(self, method, url, status_code=None, **kwargs):
+        async with aiohttp.ClientSession(cookies=self.cookies, trace_configs=aiohttp_trace_configs()) as session:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status in OVERLOAD_STATUSES or response.status >= 500:
+                    response.raise_for_status()
+                if status_code:
+                    if response.status == status_code:
                         # 更新cookies
                         self.cookies.update({k: v.value for k, v in response.cookies.items()})
-                        if method.lower() == "get":
-                            return await response.text()
-                        else:
-                            return await response.json()
-            except aiohttp.ClientError:
-                if attempt < 4:  # 如果不是最后一次尝试
-                    await asyncio.sleep((attempt + 1) * 0.5)  # 随机延迟
-                    continue
-                raise
-        return None
+                        return response
+                    return None
+                # 更新cookies
+                self.cookies.update({k: v.value for k, v in response.cookies.items()})
+                if method.lower() == "get":
+                    return await response.text()
+                else:
+                    return await response.json()
 
     async def get_auth_tokens(self):
         """获取认证所需的token"""
@@ -137,21 +143,75 @@ class GetDanmuYouku:
             'package': 'com.huawei.hwvplayer.youku',
             'ext': 'show',
         }
-        async with aiohttp.ClientSession() as session:
+        result = await retry_call_async("youku", self._get_json, url, params)
+        return result.get('duration')
+
+    async def _get_json(self, url, params):
+        async with aiohttp.ClientSession(trace_configs=aiohttp_trace_configs()) as session:
             async with session.get(url, params=params, headers=self.headers) as response:
-                result = await response.json()
-                return result.get('duration')
+                response.raise_for_status()
+                return await response.json()
 
-    async def get_danmus(self, video_id, max_mat):
-        """获取指定视频的所有弹幕"""
-        danmus = []
-        for mat in tqdm(range(0, int(float(max_mat) / 60) + 1), desc="Fetching danmus"):
+    @staticmethod
+    def segment_count(duration):
+        """弹幕按分钟分段（mat），返回时长（秒）对应的分段数"""
+        return max(math.ceil(float(duration) / 60), 1)
+
+    async def resolve_duration(self, video_id):
+        """
+        视频时长（秒）：缓存 -> show.json -> 分段探测（见 danmu_duration）。
+
+        探测时已取得的分段保存在 known_segments 中，get_danmus 不再重复请求。
+        """
+        loop = asyncio.get_running_loop()
+        probed = {}
+
+        def run(coro):
+            # DURATIONS.resolve 在线程中执行，元数据与探测的协程提交回当前事件循环
+            return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+        def metadata():
+            seconds = run(self.get_video_duration(video_id))
+            return float(seconds) * 1000 if seconds and float(seconds) > 0 else None
+
+        async def fetch(mat):
+            return await fetch_one_async("youku", self.SEGMENT_HOST, self.get_segment, video_id, mat)
+
+        def probe():
+            count, results = run(probe_segments_async(fetch, bool))
+            probed.update({mat: danmus for mat, danmus in results.items() if danmus})
+            return count * 60000
+
+        duration_ms = await asyncio.to_thread(DURATIONS.resolve, "youku", video_id, metadata=metadata, probe=probe)
+        self.known_segments = probed
+        return duration_ms / 1000
+
+    async def get_segment(self, video_id, mat):
+        """获取单个分段（一分钟）的弹幕"""
+        with span("youku.segment", segment=mat) as segment_span:
             msg = self._prepare_danmu_request(video_id, mat)
             response = await self._send_danmu_request(msg)
-            if response:
-                danmus.extend(self._parse_danmu_response(response))
-            # 防止请求过快
-            await asyncio.sleep(0.2)
+            danmus = self._parse_danmu_response(response) if response else []
+            segment_span.set_attribute("comments", len(danmus))
+        return danmus
+
+    async def get_danmus(self, video_id, max_mat, progress=None, checkpoint=None):
+        """
+        获取指定视频的所有弹幕，progress(done, total) 为可选的分段进度回调。
+
+        各分段并发请求，同时在途的请求数由 acs.youku.com 的自适应并发上限控制（见 segment_fetcher），
+        瞬时失败的分段单独重试，结果按分段顺序合并；重试后仍失败时抛出该分段的异常。
+        时长探测时已取得的分段（known_segments）以及断点 checkpoint 中已保存的分段不再请求。
+        """
+        mats = range(0, self.segment_count(max_mat))
+        results = await fetch_segments_async(
+            "youku", self.SEGMENT_HOST, lambda mat: self.get_segment(video_id, mat), mats, progress,
+            self.known_segments, checkpoint)
+        danmus = []
+        for segment in results:
+            if isinstance(segment, Exception):
+                raise segment
+            danmus.extend(segment)
         return danmus
 
     def _prepare_danmu_request(self, video_id, mat):
@@ -189,9 +249,10 @@ class GetDanmuYouku:
             'jsonpIncPrefix': 'utility'
         }
         headers = {**self.headers, 'Content-Type': 'application/x-www-form-urlencoded', 'Referer': 'https://v.youku.com'}
-        async with aiohttp.ClientSession(cookies=self.cookies) as session:
+        async with aiohttp.ClientSession(cookies=self.cookies, trace_configs=aiohttp_trace_configs()) as session:
             async with session.post(url, data={"data": json.dumps(msg).replace(' ', '')},
                               headers=headers, params=params) as response:
+                response.raise_for_status()
                 return await response.json()
 
     def _parse_danmu_response(self, response):
@@ -203,6 +264,7 @@ class GetDanmuYouku:
         
         for danmu in result.get('data', {}).get('result', []):
             danmus.append({
+                'id': danmu.get('id', ''),
                 'show_time': danmu.get('playat'), 
                 'color': json.loads(danmu.get('propertis', '{}')).get('color', 16777215),
                 'content': danmu.get('content', '')
@@ -220,25 +282,19 @@ class GetDanmuYouku:
         text = f"{token}&{t}&24679788&{json.dumps(msg).replace(' ', '')}"
         return hashlib.md5(text.encode()).hexdigest()
 
-async def write_danmu_to_file(danmus, filename):
-    """将弹幕数据写入CSV文件"""
-    if not danmus:
-        print("No danmu data to write")
-        return
+CSV_FIELDS = ['show_time', 'color', 'content', 'id']
 
-    if not os.path.exists('danmu_data/youku/'):
-        os.makedirs('danmu_data/youku/')
-        print('--- New Folder danmu_data/youku/ Created ---')
+def danmu_path(video_id):
+    """视频弹幕 CSV 的路径，由视频ID确定（同一视频总是同一文件，不依赖目录扫描）"""
+    safe_id = "".join(c for c in video_id if c.isalnum() or c in "-_=")
+    if safe_id != video_id:
+        # 过滤掉了字符（甚至全部过滤为空）时追加原始ID的摘要，避免不同视频落到同一文件
+        safe_id = f"{safe_id}_{hashlib.sha1(video_id.encode('utf-8')).hexdigest()[:16]}".lstrip("_")
+    return os.path.join('danmu_data', 'youku', f'video_{safe_id}_danmu.csv')
 
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filepath = f'danmu_data/youku/{filename}_{timestamp}.csv'
-
-    print(f"--- Writing to file {filepath} ---")
-    with open(filepath, 'w', encoding='utf-8', newline='') as csvf:
-        writer = csv.DictWriter(csvf, fieldnames=['show_time', 'color', 'content'])
-        writer.writeheader()
-        writer.writerows(danmus)
-    print("--- DONE ---")
+def danmu_episode(danmus, video_id, checkpoint=None):
+    """将弹幕列表包装为 EpisodeDanmu（见 danmu_records），save() 写入 danmu_path(video_id)"""
+    return EpisodeDanmu.from_dicts(CSV_FIELDS, danmus, danmu_path(video_id), "show_time", checkpoint=checkpoint)
 
 async def extract_real_vid_from_url(url):
     """
@@ -261,7 +317,7 @@ async def extract_real_vid_from_url(url):
         
         # 发送请求获取页面内容
         try:
-            async with aiohttp.ClientSession() as session:
+            async with aiohttp.ClientSession(trace_configs=aiohttp_trace_configs()) as session:
                 async with session.get(new_url, headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"}) as response:
                     html_content = await response.text()
                     
@@ -270,6 +326,7 @@ async def extract_real_vid_from_url(url):
                     match = vid_pattern.search(html_content)
                     if match:
                         return match.group(1)
+                    report(UNRESOLVED, f"页面中未找到优酷视频 vid: {url}")
         except Exception as e:
             print(f"Error extracting vid from URL: {e}")
             return None
@@ -280,43 +337,69 @@ async def extract_real_vid_from_url(url):
             return vid
         except:
             return None
-    
+
+    report(UNRESOLVED, f"不支持的优酷链接: {url}")
     return None
 
-async def get_video_danmus(video_info):
-    """获取视频的弹幕数据并保存"""
-    vid_url = video_info['vid']
-    title = video_info['title']
-    
+async def prepare_danmu_getter(vid_url):
+    """
+    解析真实 vid、获取认证 token 与视频时长
+    :return: (GetDanmuYouku 实例, video_id, 时长)，失败时返回 None
+    """
     # 检查vid是否是URL形式，如果是则提取真实的vid参数
     if vid_url.startswith('http'):
         video_id = await extract_real_vid_from_url(vid_url)
         if not video_id:
             # 如果无法提取，尝试旧方法
+            if 'id_' not in vid_url:
+                return None
             video_id = vid_url.split('id_')[1].split('.html')[0]
     else:
         video_id = vid_url
 
-    print(f"Processing {title} (video_id: {video_id})")
     danmu_getter = GetDanmuYouku()
     
     # 获取认证token
     if not await danmu_getter.get_auth_tokens():
         print("Failed to get authentication tokens")
-        return []
+        return None
 
-    # 获取视频时长
-    duration = await danmu_getter.get_video_duration(video_id)
+    # 获取视频时长（缓存 / show.json / 分段探测）
+    duration = await danmu_getter.resolve_duration(video_id)
     if not duration:
-        print("Failed to get video duration")
-        return []
+        # 时长只会来自 show.json 或分段探测，为 0 说明第一个分段就没有弹幕
+        report(EMPTY, f"视频 {video_id} 没有弹幕")
+        return None
 
-    # 获取弹幕
-    danmus = await danmu_getter.get_danmus(video_id, duration)
-    if danmus:
-        await write_danmu_to_file(danmus, title)
+    return danmu_getter, video_id, duration
 
-    return danmus
+async def get_video_episode(video_info, progress=None):
+    """获取视频的弹幕数据到内存，返回 EpisodeDanmu（未保存），没有弹幕或解析失败时返回 None"""
+    title = video_info['title']
+    prepared = await prepare_danmu_getter(video_info['vid'])
+    if not prepared:
+        return None
+    danmu_getter, video_id, duration = prepared
+    print(f"Processing {title} (video_id: {video_id})")
+
+    # 获取弹幕；中途失败时已取得的分段保留在断点中，下次只请求缺失的分段
+    checkpoint = SegmentCheckpoint("youku", video_id)
+    danmus = await danmu_getter.get_danmus(video_id, duration, progress, checkpoint)
+    if not danmus:
+        report(EMPTY, f"视频 {video_id} 没有弹幕")
+        await asyncio.to_thread(checkpoint.discard)
+        return None
+    return danmu_episode(danmus, video_id, checkpoint)
+
+async def get_video_danmus(video_info, progress=None):
+    """获取视频的弹幕数据并保存，返回 CSV 文件路径，没有弹幕或解析失败时返回 None"""
+    episode = await get_video_episode(video_info, progress)
+    if episode is None:
+        return None
+    print(f"--- Writing to file {episode.path} ---")
+    filepath = await asyncio.to_thread(episode.save)
+    print("--- DONE ---")
+    return filepath
 
 async def search_videos(keyword):
     """
@@ -431,19 +514,37 @@ async def get_video_episodes(search_result, title):
         traceback.print_exc()
         return []
 
-async def download_danmu(vid_url, title):
+async def download_episode(vid_url, title, progress=None):
+    """
+    获取指定视频的弹幕到内存（不保存）
+    :param vid_url: 视频URL
+    :param title: 视频标题
+    :param progress: 可选的分段进度回调 progress(done, total)
+    :return: EpisodeDanmu（见 danmu_records），失败或没有弹幕时返回 None
+    :raises: 熔断或重试用尽后的瞬时失败（见 circuit_breaker.is_transient）
+    """
+    try:
+        return await get_video_episode({"title": title, "vid": vid_url}, progress)
+    except Exception as e:
+        if is_transient(e):
+            raise
+        print(f"Download danmu failed: {e}")
+        return None
+
+async def download_danmu(vid_url, title, progress=None):
     """
     下载指定视频的弹幕
     :param vid_url: 视频URL
     :param title: 视频标题
-    :return: 弹幕列表
+    :param progress: 可选的分段进度回调 progress(done, total)
+    :return: 弹幕CSV文件路径（见 danmu_path），失败或没有弹幕时返回 None
     """
     try:
         video_info = {"title": title, "vid": vid_url}
-        return await get_video_danmus(video_info)
+        return await get_video_danmus(video_info, progress)
     except Exception as e:
         print(f"Download danmu failed: {e}")
-        return []
+        return None
 
 async def main():
     # 示例用法
@@ -464,8 +565,8 @@ async def main():
     
     # # 3. 下载特定集数的弹幕
     # first_episode = episodes[0]
-    # danmus = await download_danmu(first_episode["vid"], first_episode["Title"])
-    # print(f"Downloaded {len(danmus)} danmus for {first_episode['Title']}")
+    # filepath = await download_danmu(first_episode["vid"], first_episode["Title"])
+    # print(f"Downloaded danmus for {first_episode['Title']} to {filepath}")
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
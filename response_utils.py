@@ -0,0 +1,247 @@
+import gzip
+import hashlib
+import importlib.util
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from danmu_metrics import CACHE_REQUESTS
+from danmu_tracing import span
+
+# brotli 在第一次生成 br 响应时才导入，避免增加启动耗时；不可用时仅协商 gzip
+BROTLI_AVAILABLE = importlib.util.find_spec("brotli") is not None
+_brotli = None
+
+# 小于该字节数的响应体不压缩，压缩收益不足以抵消开销
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def encode_json(payload):
+    """紧凑编码 JSON，中文不转义以减小体积"""
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def file_version(filepath):
+    """根据文件修改时间和大小生成数据版本标识"""
+    stat = os.stat(filepath)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def make_etag(*parts):
+    """根据版本信息生成强 ETag"""
+    digest = hashlib.sha1("|".join(str(p) for p in parts).encode('utf-8')).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match, etag):
+    """判断 If-None-Match 是否命中（按 RFC 7232 使用弱比较）"""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    target = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == target:
+            return True
+    return False
+
+
+def choose_encoding(accept_encoding):
+    """根据 Accept-Encoding 选择压缩方式，优先 br，其次 gzip；不接受压缩时返回 None"""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+
+    def q_of(coding):
+        return accepted.get(coding, accepted.get('*', 0.0))
+
+    candidates = (['br'] if BROTLI_AVAILABLE else []) + ['gzip']
+    best = max(candidates, key=lambda c: q_of(c))
+    return best if q_of(best) > 0 else None
+
+
+def _brotli_module():
+    global _brotli
+    if _brotli is None:
+        import brotli
+        _brotli = brotli
+    return _brotli
+
+
+def compress_body(body, encoding):
+    """按指定方式压缩响应体"""
+    if encoding == 'br':
+        return _brotli_module().compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+
+class CachedBody:
+    """一份预先序列化的响应体，按需缓存各压缩编码的变体"""
+
+    def __init__(self, version, body):
+        self.version = version
+        self.variants = {None: body}
+
+    @property
+    def size(self):
+        return sum(len(b) for b in self.variants.values())
+
+    def body_for(self, encoding):
+        """返回指定编码的响应体；响应体过小时不压缩，返回 (body, 实际编码)"""
+        identity = self.variants[None]
+        if not encoding or len(identity) < MIN_COMPRESS_SIZE:
+            return identity, None
+        body = self.variants.get(encoding)
+        if body is None:
+            body = compress_body(identity, encoding)
+            self.variants[encoding] = body
+        return body, encoding
+
+
+class BodyCache:
+    """
+    预序列化响应体的 LRU 缓存，按 (剧集, 格式) 等键存储。
+
+    每个条目记录生成时的数据版本，版本不一致即视为失效并重建。命中率记录在指标 danmu_cache_requests_total{cache=name}。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, name="body"):
+        self.max_bytes = max_bytes
+        self.name = name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(key)
+            else:
+                entry = None
+        CACHE_REQUESTS.inc(self.name, "miss" if entry is None else "hit")
+        return entry
+
+    def put(self, key, version, body):
+        entry = CachedBody(version, body)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= old.size
+            self._entries[key] = entry
+            self._size += entry.size
+            self._evict()
+        return entry
+
+    def account(self, entry, added):
+        """记录条目新增的压缩变体大小"""
+        with self._lock:
+            self._size += added
+            self._evict()
+
+    def invalidate(self, match):
+        """删除所有满足 match(key) 的条目"""
+        with self._lock:
+            for key in [k for k in self._entries if match(k)]:
+                self._size -= self._entries.pop(key).size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+
+
+def _negotiate(request_headers, version):
+    """协商压缩方式并生成响应头；If-None-Match 命中时返回 304 标记"""
+    encoding = choose_encoding(request_headers.get('Accept-Encoding'))
+    headers = {
+        'Content-Type': 'application/json; charset=utf-8',
+        'Vary': 'Accept-Encoding',
+    }
+    not_modified = False
+    if version is not None:
+        # 不同编码的表示需要不同的强 ETag；命中时无需序列化响应体
+        etag = make_etag(version, encoding or 'identity')
+        headers['ETag'] = etag
+        headers['Cache-Control'] = 'no-cache'
+        not_modified = etag_matches(request_headers.get('If-None-Match'), etag)
+    return encoding, headers, not_modified
+
+
+def build_json_response(payload, request_headers, version=None):
+    """
+    构造带协商压缩与 ETag 的 JSON 响应，与具体 Web 框架无关。
+
+    :param payload: 待序列化的响应数据
+    :param request_headers: 请求头（支持 .get 的映射）
+    :param version: 数据版本标识；提供时生成强 ETag 并处理 If-None-Match
+    :return: (status, headers, body)
+    """
+    encoding, headers, not_modified = _negotiate(request_headers, version)
+    if not_modified:
+        return 304, headers, b''
+
+    body = encode_json(payload)
+    if encoding and len(body) >= MIN_COMPRESS_SIZE:
+        body = compress_body(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return 200, headers, body
+
+
+def build_cached_json_response(cache, key, version, payload_fn, request_headers):
+    """
+    与 build_json_response 相同，但响应体从 BodyCache 中取预先序列化（及压缩）的字节。
+
+    :param cache: BodyCache 实例
+    :param key: 缓存键，如 ("download", source, episode_id)
+    :param version: 底层弹幕数据版本，变化时缓存自动失效
+    :param payload_fn: 缓存未命中时调用，返回待序列化的响应数据
+    :return: (status, headers, body)
+    """
+    encoding, headers, not_modified = _negotiate(request_headers, version)
+    if not_modified:
+        return 304, headers, b''
+
+    entry = cache.get(key, version)
+    if entry is None:
+        payload = payload_fn()
+        with span("response.encode_json") as encode_span:
+            entry = cache.put(key, version, encode_json(payload))
+            encode_span.set_attribute("bytes", entry.size)
+    before = entry.size
+    with span("response.compress", encoding=encoding or "identity", cached=True) as compress_span:
+        body, used_encoding = entry.body_for(encoding)
+        if entry.size != before:
+            compress_span.set_attribute("cached", False)
+            cache.account(entry, entry.size - before)
+        compress_span.set_attribute("bytes", len(body))
+    if used_encoding:
+        headers['Content-Encoding'] = used_encoding
+    return 200, headers, body
@@ -0,0 +1,472 @@
+"""
+弹幕分段的并行抓取与按上游域名的自适应并发控制（AIMD）。
+
+每个上游域名（dm.video.qq.com、cmts.iqiyi.com、galaxy.bz.mgtv.com、acs.youku.com…）有一个进程内共享的
+AimdLimiter，同时进行的所有下载共用同一个并发上限：
+- 请求成功且延迟正常（不超过基线延迟的 DANMU_HOST_LATENCY_TOLERANCE 倍）时加性增长，每满一个窗口上限 +1；
+- 遇到 429 / 5xx / 超时 / 连接失败时乘性减小（默认减半），同一个窗口内的多次失败只减一次；
+- 其余失败（404、解析错误等）不改变上限。
+当前上限与在途请求数通过指标 danmu_upstream_concurrency_limit / danmu_upstream_in_flight 暴露。
+
+fetch_segments 按上限滑动窗口提交分段请求并按分段顺序产出结果，调用方可以边收边写 CSV；
+fetch_segments_async 是供 aiohttp 爬虫使用的协程版本。两者都经平台熔断器请求，瞬时失败的分段
+在全局重试预算内单独重试（见 circuit_breaker），每次重试重新占用限流名额。
+传入 checkpoint 时已保存的分段不再请求，新取得的分段随到随存（见 danmu_checkpoint）。
+
+对冲请求：一个分段超过该域名最近成功请求的 p95 延迟仍未返回时，再发出一个相同的请求，取先成功的结果，
+整集耗时不再由最慢的分段决定。对冲请求受预算（DANMU_HEDGE_RATIO，默认为分段请求数的 10%）与空闲名额限制，
+在途请求数最多超出限流上限的 DANMU_HEDGE_RATIO 比例（至少 1 个）。
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from circuit_breaker import RetryBudget, is_overload, retry_call, retry_call_async
+from danmu_metrics import HEDGED_REQUESTS, UPSTREAM_CONCURRENCY_LIMIT, UPSTREAM_IN_FLIGHT
+
+INITIAL_LIMIT = float(os.environ.get("DANMU_HOST_CONCURRENCY_INITIAL", "4"))
+MIN_LIMIT = float(os.environ.get("DANMU_HOST_CONCURRENCY_MIN", "1"))
+MAX_LIMIT = float(os.environ.get("DANMU_HOST_CONCURRENCY_MAX", "32"))
+# 延迟超过基线的该倍数时视为拥塞前兆，不再增长上限
+LATENCY_TOLERANCE = float(os.environ.get("DANMU_HOST_LATENCY_TOLERANCE", "3"))
+DECREASE_FACTOR = 0.5
+# 分段请求线程池（与 async_runtime 的线程池分开，爬虫线程在其中等待分段结果不会互相占用）
+SEGMENT_WORKERS = int(os.environ.get("DANMU_SEGMENT_WORKERS", "64"))
+# 对冲请求：最多占分段请求数的该比例（0 为关闭）；每个域名至少有 HEDGE_MIN_SAMPLES 个成功样本后才启用
+HEDGE_RATIO = float(os.environ.get("DANMU_HEDGE_RATIO", "0.1"))
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+_pool = ThreadPoolExecutor(max_workers=SEGMENT_WORKERS, thread_name_prefix="danmu-segment")
+# 对冲预算与重试预算同为令牌桶：每个分段存入 HEDGE_RATIO 个令牌，每个对冲请求消耗 1 个，最多积累 10 个
+HEDGE_BUDGET = RetryBudget(ratio=HEDGE_RATIO, min_per_second=0, cap=10)
+
+
+class AimdLimiter:
+    """单个上游域名的自适应并发上限，线程与协程均可使用"""
+
+    def __init__(self, host, initial=INITIAL_LIMIT, minimum=MIN_LIMIT, maximum=MAX_LIMIT):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = min(max(initial, minimum), maximum)
+        self.in_flight = 0
+        self.baseline = None  # 成功请求延迟的滑动平均（秒）
+        self._latencies = deque(maxlen=LATENCY_WINDOW)  # 最近成功请求的延迟，用于对冲阈值
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = deque()
+        self._publish()
+
+    # ---- 获取 / 释放 ----
+
+    def try_acquire(self, overcommit=0):
+        """不等待地获取名额；overcommit 允许在途请求数超出上限的个数（对冲请求使用）"""
+        with self._cond:
+            return self._try_acquire_locked(overcommit)
+
+    def _try_acquire_locked(self, overcommit=0):
+        if self.in_flight < int(self.limit) + overcommit:
+            self.in_flight += 1
+            UPSTREAM_IN_FLIGHT.set(self.host, value=self.in_flight)
+            return True
+        return False
+
+    def acquire(self):
+        with self._cond:
+            while not self._try_acquire_locked():
+                self._cond.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._try_acquire_locked():
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, latency=None, outcome="ok"):
+        """
+        归还一个名额并根据结果调整上限。
+
+        :param latency: 请求耗时（秒），未实际发出请求时为 None
+        :param outcome: ok / overload（429、5xx、超时）/ other（其他失败，不影响上限）
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if latency is not None:
+                if outcome == "ok":
+                    self._on_success(latency)
+                elif outcome == "overload":
+                    self._on_overload()
+            self._publish()
+            self._wake_locked()
+
+    def _on_success(self, latency):
+        healthy = self.baseline is None or latency <= self.baseline * LATENCY_TOLERANCE
+        self.baseline = latency if self.baseline is None else self.baseline * 0.9 + latency * 0.1
+        self._latencies.append(latency)
+        if healthy and self.limit < self.maximum:
+            # 每满一个窗口（limit 个成功请求）增长 1
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+    def _on_overload(self):
+        now = time.monotonic()
+        # 同一窗口内已发出的请求可能接连失败，只按第一次失败减小
+        if now - self._last_decrease < max(self.baseline or 0.0, 0.1):
+            return
+        self._last_decrease = now
+        self.limit = max(self.limit * DECREASE_FACTOR, self.minimum)
+
+    def _wake_locked(self):
+        free = int(self.limit) - self.in_flight
+        if free <= 0:
+            return
+        self._cond.notify(free)
+        while free > 0 and self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            if not waiter.done():
+                loop.call_soon_threadsafe(_resolve, waiter)
+                free -= 1
+
+    def hedge_delay(self):
+        """对冲阈值：最近成功请求延迟的 p95（秒）；样本不足或对冲关闭时返回 None"""
+        if HEDGE_RATIO <= 0:
+            return None
+        with self._cond:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) * HEDGE_PERCENTILE // 100, len(ordered) - 1)]
+
+    def _publish(self):
+        UPSTREAM_CONCURRENCY_LIMIT.set(self.host, value=round(self.limit, 2))
+        UPSTREAM_IN_FLIGHT.set(self.host, value=self.in_flight)
+
+    # ---- 包装一次请求 ----
+
+    def _finish(self, started, exc):
+        outcome = "ok" if exc is None else ("overload" if is_overload(exc) else "other")
+        self.release(time.monotonic() - started, outcome)
+
+    def run(self, fn, *args):
+        """在已获取名额的前提下执行 fn 并归还名额"""
+        started = time.monotonic()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self._finish(started, e)
+            raise
+        self._finish(started, None)
+        return result
+
+    def call(self, fn, *args):
+        """获取名额后执行 fn"""
+        self.acquire()
+        return self.run(fn, *args)
+
+    async def call_async(self, coro_fn, *args):
+        """获取名额后 await coro_fn(*args)"""
+        await self.acquire_async()
+        return await self.run_async(coro_fn, *args)
+
+    async def run_async(self, coro_fn, *args):
+        """run 的协程版本：在已获取名额的前提下 await coro_fn(*args) 并归还名额"""
+        started = time.monotonic()
+        try:
+            result = await coro_fn(*args)
+        except asyncio.CancelledError:
+            self.release()
+            raise
+        except Exception as e:
+            self._finish(started, e)
+            raise
+        self._finish(started, None)
+        return result
+
+    def snapshot(self):
+        with self._cond:
+            return {"host": self.host, "limit": round(self.limit, 2), "inFlight": self.in_flight,
+                    "baselineMs": round(self.baseline * 1000, 1) if self.baseline else None}
+
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(host):
+    """返回上游域名对应的共享限流器"""
+    limiter = _limiters.get(host)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(host)
+            if limiter is None:
+                limiter = _limiters[host] = AimdLimiter(host)
+    return limiter
+
+
+def snapshot():
+    """所有上游域名当前的并发上限、在途请求数与基线延迟"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return [limiter.snapshot() for limiter in limiters]
+
+
+def fetch_segments(platform, host, fetch, indices, stop=None, known=None, checkpoint=None):
+    """
+    在线程池中并行抓取分段，按 indices 的顺序产出 (index, 结果或异常)。
+
+    同时在途的请求数由 host 的限流器决定；stop(result) 返回 True 时（如企鹅遇到空分段）停止提交新分段，
+    已提交但尚未开始的分段被取消，已开始的分段结果被丢弃。
+    等待中的分段超过该域名的 p95 延迟仍未返回时发出对冲请求（见 _await_hedged）。
+
+    :param platform: 熔断器与重试统计使用的平台名（tencent / iqiyi / mgtv）
+    :param fetch: 阻塞函数 fetch(index) -> 结果，失败时抛出异常；产出的异常为重试后仍失败或熔断（CircuitOpenError）
+    :param known: 可选的 {序号: 结果}（如时长探测时已取得的分段），这些分段不再请求
+    :param checkpoint: 可选的 SegmentCheckpoint（见 danmu_checkpoint）：已保存的分段不再请求，新取得的分段随到随存
+    """
+    limiter = limiter_for(host)
+    known = dict(known or {})
+    if checkpoint is not None:
+        known = _resume(checkpoint, known)
+        fetch = checkpoint.recording(fetch)
+    pending = deque()
+    remaining = iter(indices)
+    index = None
+    exhausted = False
+    try:
+        while True:
+            # 没有在途分段时等待名额，否则只按限流器的空闲名额提交
+            while not exhausted:
+                if index is None:
+                    index = next(remaining, _END)
+                if index is _END:
+                    exhausted = True
+                    break
+                if index in known:
+                    pending.append((index, _completed(known.pop(index)), None))
+                    index = None
+                    continue
+                if pending:
+                    if not limiter.try_acquire():
+                        break
+                else:
+                    limiter.acquire()
+                HEDGE_BUDGET.deposit()
+                pending.append((index, _submit(platform, limiter, fetch, index), time.monotonic()))
+                index = None
+            if not pending:
+                return
+            done_index, future, started = pending.popleft()
+            result = future.result() if started is None else _await_hedged(platform, limiter, fetch, done_index, future, started)
+            yield done_index, result
+            if stop is not None and stop(result):
+                exhausted = True
+                _cancel(pending, limiter)
+    finally:
+        _cancel(pending, limiter)
+
+
+def _resume(checkpoint, known):
+    """合并断点中已保存的分段与 known，并把断点中还没有的 known 分段写入断点"""
+    saved = checkpoint.load()
+    checkpoint.record_many({
+        index: result for index, result in known.items()
+        if index not in saved and not isinstance(result, Exception)
+    })
+    saved.update(known)
+    return saved
+
+
+def fetch_one(platform, host, fetch, *args):
+    """单个请求：占用 host 的限流名额，经平台熔断器并在重试预算内重试"""
+    return retry_call(platform, limiter_for(host).call, fetch, *args)
+
+
+def _completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+_END = object()
+
+
+def _submit(platform, limiter, fetch, index):
+    # 复制上下文，分段的追踪 span 挂在当前 span 之下
+    context = contextvars.copy_context()
+    return _pool.submit(context.run, _capture, platform, limiter, fetch, index)
+
+
+def _capture(platform, limiter, fetch, index):
+    """在已占用的限流名额内执行首次请求，重试时重新获取名额"""
+    held = True
+
+    def attempt():
+        nonlocal held
+        if held:
+            held = False
+            return limiter.run(fetch, index)
+        return limiter.call(fetch, index)
+
+    try:
+        return retry_call(platform, attempt)
+    except Exception as e:
+        return e
+    finally:
+        if held:  # 熔断打开，请求未发出
+            limiter.release()
+
+
+def _cancel(pending, limiter):
+    while pending:
+        _, future, started = pending.popleft()
+        if started is not None and future.cancel():
+            limiter.release()
+
+
+def _try_hedge(limiter):
+    """
+    是否可以发出一个对冲请求（消耗预算并占用一个名额，不等待）。
+
+    分段窗口通常已占满限流名额，对冲请求可以超出上限 HEDGE_RATIO 比例（至少 1 个）。
+    """
+    if not HEDGE_BUDGET.withdraw():
+        HEDGED_REQUESTS.inc(limiter.host, "no_budget")
+        return False
+    if not limiter.try_acquire(overcommit=max(1, int(limiter.limit * HEDGE_RATIO))):
+        HEDGED_REQUESTS.inc(limiter.host, "no_slot")
+        return False
+    HEDGED_REQUESTS.inc(limiter.host, "fired")
+    return True
+
+
+def _await_hedged(platform, limiter, fetch, index, future, started):
+    """等待分段结果；超过 p95 仍未返回时发出一个重复请求，取先成功的结果"""
+    delay = limiter.hedge_delay()
+    if delay is None:
+        return future.result()
+    try:
+        return future.result(timeout=max(delay - (time.monotonic() - started), 0))
+    except FutureTimeout:
+        pass
+    if not _try_hedge(limiter):
+        return future.result()
+
+    hedge = _submit(platform, limiter, fetch, index)
+    waiting = {future, hedge}
+    result = None
+    while waiting:
+        done, waiting = wait(waiting, return_when=FIRST_COMPLETED)
+        for finished in done:
+            result = finished.result()
+            if not isinstance(result, Exception):
+                # 落后的请求无法中断，完成后自行归还名额，结果丢弃
+                if finished is hedge:
+                    HEDGED_REQUESTS.inc(limiter.host, "won")
+                return result
+    return result
+
+
+async def fetch_segments_async(platform, host, fetch, indices, progress=None, known=None, checkpoint=None):
+    """
+    协程版本：并发抓取全部分段，返回按 indices 顺序排列的 [结果或异常]。
+
+    :param fetch: 协程函数 fetch(index) -> 结果
+    :param progress: 可选回调 progress(done, total)，每完成一个分段调用一次
+    :param known: 可选的 {序号: 结果}，这些分段不再请求
+    :param checkpoint: 可选的 SegmentCheckpoint，断点文件在线程池中读写
+    """
+    limiter = limiter_for(host)
+    indices = list(indices)
+    known = dict(known or {})
+    if checkpoint is not None:
+        known = await asyncio.to_thread(_resume, checkpoint, known)
+    done = 0
+
+    async def run(index):
+        nonlocal done
+        try:
+            if index in known:
+                return known[index]
+            result = await fetch_hedged(index)
+            if checkpoint is not None and not isinstance(result, Exception):
+                await asyncio.to_thread(checkpoint.record, index, result)
+            return result
+        finally:
+            done += 1
+            if progress:
+                progress(done, len(indices))
+
+    async def fetch_hedged(index):
+        # 先占用名额再计时，排队等待名额的时间不触发对冲
+        await limiter.acquire_async()
+        HEDGE_BUDGET.deposit()
+        primary = asyncio.ensure_future(_capture_async(platform, limiter, fetch, index))
+        delay = limiter.hedge_delay()
+        if delay is None:
+            return await primary
+        finished, _ = await asyncio.wait({primary}, timeout=delay)
+        if finished or not _try_hedge(limiter):
+            return await primary
+        hedge = asyncio.ensure_future(_capture_async(platform, limiter, fetch, index))
+        return await _first_success_async(limiter, primary, hedge)
+
+    return await asyncio.gather(*(run(index) for index in indices))
+
+
+async def fetch_one_async(platform, host, fetch, *args):
+    """fetch_one 的协程版本"""
+    return await retry_call_async(platform, limiter_for(host).call_async, fetch, *args)
+
+
+async def _capture_async(platform, limiter, fetch, index):
+    """_capture 的协程版本（调用前已占用名额）"""
+    held = True
+
+    async def attempt():
+        nonlocal held
+        if held:
+            held = False
+            return await limiter.run_async(fetch, index)
+        return await limiter.call_async(fetch, index)
+
+    try:
+        return await retry_call_async(platform, attempt)
+    except Exception as e:
+        return e
+    finally:
+        if held:
+            limiter.release()
+
+
+async def _first_success_async(limiter, primary, hedge):
+    waiting = {primary, hedge}
+    result = None
+    try:
+        while waiting:
+            done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                result = finished.result()
+                if not isinstance(result, Exception):
+                    if finished is hedge:
+                        HEDGED_REQUESTS.inc(limiter.host, "won")
+                    return result
+        return result
+    finally:
+        # 取消落后的请求，名额在其取消处理中归还
+        for task in waiting:
+            task.cancel()
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from flask import Flask, jsonify, request
+
+import async_app
+import async_runtime
+from async_runtime import run_blocking, run_coro
+
+WORKERS = 4
+
+
+@pytest.fixture
+def bridged(monkeypatch):
+    """每个用例使用独立的小线程池（服务器事件循环退出时会关闭其默认线程池）"""
+    monkeypatch.setattr(async_runtime, "_executor", ThreadPoolExecutor(WORKERS))
+    monkeypatch.setattr(async_runtime, "_bridge_executor", ThreadPoolExecutor(WORKERS))
+    monkeypatch.setattr(async_runtime, "_loop", None)
+    monkeypatch.setattr(async_runtime, "_loop_thread_id", None)
+
+    flask_app = Flask(__name__)
+
+    @flask_app.route("/api/echo/<path:name>")
+    def echo(name):
+        return jsonify({"name": name, "source": request.args.get("source")})
+
+    @flask_app.route("/api/blocking")
+    def blocking():
+        # 与真实路由一样，在视图中经 run_coro 等待 run_blocking 的任务
+        async def work():
+            await run_blocking(threading.Event().wait, 0.1)
+            return True
+        return jsonify({"ok": run_coro(work(), timeout=10)})
+
+    async def get_all(paths):
+        async with TestClient(TestServer(async_app.create_async_app(flask_app))) as client:
+            responses = await asyncio.wait_for(asyncio.gather(*(client.get(path) for path in paths)), 15)
+            return [(response.status, await response.json()) for response in responses]
+
+    return lambda paths: asyncio.run(get_all(paths))
+
+
+def test_bridge_passes_non_ascii_query_and_path(bridged):
+    [(status, payload)] = bridged(["/api/echo/%E5%89%A7%E9%9B%86?source=%E4%BC%81%E9%B9%85&x=a%26b"])
+    assert status == 200
+    assert payload == {"name": "剧集", "source": "企鹅"}
+
+
+def test_concurrent_bridged_requests_do_not_deadlock(bridged):
+    results = bridged(["/api/blocking"] * (WORKERS * 2))
+    assert results == [(200, {"ok": True})] * (WORKERS * 2)
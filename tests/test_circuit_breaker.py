@@ -0,0 +1,119 @@
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError, RetryBudget, retry_call
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(circuit_breaker, "time", clock)
+    return clock
+
+
+def _open(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        breaker.record_failure(ConnectionError("reset"))
+
+
+def test_opens_after_consecutive_transient_failures(clock):
+    breaker = CircuitBreaker("test-open", failure_threshold=3, reset_timeout=30)
+    breaker.record_failure(ConnectionError("reset"))
+    breaker.record_failure(ConnectionError("reset"))
+    assert breaker.state == CLOSED
+    breaker.record_failure(ConnectionError("reset"))
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_non_transient_failures_and_success_reset_count(clock):
+    breaker = CircuitBreaker("test-reset", failure_threshold=2, reset_timeout=30)
+    breaker.record_failure(ConnectionError("reset"))
+    breaker.record_failure(ValueError("bad json"))  # 非瞬时失败不计入
+    assert breaker.state == CLOSED and breaker.failures == 1
+    breaker.record_success()
+    breaker.record_failure(ConnectionError("reset"))
+    assert breaker.state == CLOSED and breaker.failures == 1
+
+
+def test_half_open_allows_one_probe_and_closes_on_success(clock):
+    breaker = CircuitBreaker("test-half-open", failure_threshold=2, reset_timeout=30)
+    _open(breaker)
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock.now += 1
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # 探测请求在途时其余请求仍被拒绝
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.failures == 0
+    breaker.before_call()
+
+
+def test_failed_probe_reopens_for_a_full_timeout(clock):
+    breaker = CircuitBreaker("test-reopen", failure_threshold=2, reset_timeout=30)
+    _open(breaker)
+    clock.now += 30
+    breaker.before_call()
+    breaker.record_failure(ConnectionError("still down"))
+    assert breaker.state == OPEN
+    clock.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.now += 1
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+
+
+def test_cancelled_probe_frees_the_slot(clock):
+    breaker = CircuitBreaker("test-cancel", failure_threshold=1, reset_timeout=30)
+    _open(breaker)
+    clock.now += 30
+    breaker.before_call()
+    breaker.cancel_probe()
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+
+
+def test_retry_call_stops_when_budget_is_empty(clock, monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "RETRY_BUDGET", RetryBudget(ratio=0, min_per_second=0, cap=0))
+    calls = []
+
+    def overloaded():
+        calls.append(1)
+        raise ConnectionError("reset")
+
+    with pytest.raises(ConnectionError) as raised:
+        retry_call("test-budget", overloaded)
+    assert len(calls) == 1
+    # 预算用尽后抛出的仍是瞬时失败，接口按 503 处理
+    assert circuit_breaker.is_transient(raised.value)
+
+
+def test_retry_call_retries_transient_failures_within_budget(clock, monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "RETRY_BUDGET", RetryBudget())
+    results = iter([ConnectionError("reset"), "ok"])
+
+    def flaky():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    assert retry_call("test-retry", flaky) == "ok"
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import threading
+
+from danmu_checkpoint import SegmentCheckpoint
+from segment_fetcher import fetch_segments, fetch_segments_async
+
+
+class _Upstream:
+    """分段 i 返回 [i]；failing 中的分段抛出非瞬时错误（不重试）"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.requested = []
+        self._lock = threading.Lock()
+
+    def __call__(self, index):
+        with self._lock:
+            self.requested.append(index)
+        if index in self.failing:
+            raise ValueError(f"segment {index} failed")
+        return [index]
+
+
+def test_resume_after_partial_failure_fetches_only_missing_segments(tmp_path):
+    first = _Upstream(failing={3})
+    results = dict(fetch_segments("test-checkpoint", "checkpoint.test", first, range(6),
+                                  checkpoint=SegmentCheckpoint("test", "ep1", directory=str(tmp_path))))
+    assert isinstance(results[3], ValueError)
+    saved = {index for index, result in results.items() if not isinstance(result, Exception)}
+
+    retry = _Upstream()
+    checkpoint = SegmentCheckpoint("test", "ep1", directory=str(tmp_path))
+    resumed = list(fetch_segments("test-checkpoint", "checkpoint.test", retry, range(6), checkpoint=checkpoint))
+    assert sorted(retry.requested) == sorted(set(range(6)) - saved)
+    assert resumed == [(index, [index]) for index in range(6)]
+
+    checkpoint.discard()
+    assert not os.path.exists(checkpoint.path)
+
+
+def test_async_resume_uses_saved_segments(tmp_path):
+    SegmentCheckpoint("test", "ep2", directory=str(tmp_path)).record_many({0: [0], 2: [2]})
+    requested = []
+
+    async def fetch(index):
+        requested.append(index)
+        return [index]
+
+    checkpoint = SegmentCheckpoint("test", "ep2", directory=str(tmp_path))
+    results = asyncio.run(fetch_segments_async("test-checkpoint", "checkpoint.test", fetch, range(4), checkpoint=checkpoint))
+    assert results == [[0], [1], [2], [3]]
+    assert sorted(requested) == [1, 3]
+    assert checkpoint.load() == {0: [0], 1: [1], 2: [2], 3: [3]}
+
+
+def test_truncated_last_line_is_skipped(tmp_path):
+    checkpoint = SegmentCheckpoint("test", "ep3", directory=str(tmp_path))
+    checkpoint.record(0, [[1000, "a"]])
+    with open(checkpoint.path, "a", encoding="utf-8") as f:
+        f.write('[1, [[2000, "b"')
+    assert checkpoint.load() == {0: [[1000, "a"]]}
+
+
+def test_expired_checkpoint_is_removed(tmp_path):
+    checkpoint = SegmentCheckpoint("test", "ep4", directory=str(tmp_path), ttl=60)
+    checkpoint.record(0, [0])
+    old = os.path.getmtime(checkpoint.path) - 61
+    os.utime(checkpoint.path, (old, old))
+    assert checkpoint.load() == {}
+    assert not os.path.exists(checkpoint.path)
+
+
+def test_discarded_checkpoint_ignores_late_segments(tmp_path):
+    checkpoint = SegmentCheckpoint("test", "ep5", directory=str(tmp_path))
+    checkpoint.record(0, [0])
+    checkpoint.discard()
+    checkpoint.record(1, [1])  # 整集保存后才返回的对冲请求
+    assert not os.path.exists(checkpoint.path)
@@ -0,0 +1,39 @@
+from danmu_density import limit_density
+
+
+def _danmaku(times, text=lambda i: f"弹幕{i}"):
+    return [[t, 0, 16777215, "guest", text(i)] for i, t in enumerate(times)]
+
+
+def test_under_limit_returns_everything():
+    items = _danmaku([1, 2, 3])
+    assert limit_density(items, 3) == items
+    assert limit_density(items, 0) == []
+
+
+def test_cap_spreads_across_timeline():
+    # 片头 10 秒内 1000 条，之后每 10 秒 2 条
+    items = _danmaku(sorted([i / 100 for i in range(1000)] + [10 + i * 5 for i in range(18)]))
+    limited = limit_density(items, 100, bucket_seconds=10)
+    assert len(limited) <= 100
+    assert [item[0] for item in limited] == sorted(item[0] for item in limited)
+    # 后面稀疏的桶全部保留，而不是只返回片头
+    assert sum(1 for item in limited if item[0] >= 10) == 18
+    assert limited == limit_density(items, 100, bucket_seconds=10)
+
+
+def test_per_bucket_cap():
+    items = _danmaku([i / 10 for i in range(600)])  # 60 秒，每秒 10 条
+    limited = limit_density(items, 1000, bucket_seconds=10, per_bucket=5)
+    counts = {}
+    for item in limited:
+        counts[int(item[0] // 10)] = counts.get(int(item[0] // 10), 0) + 1
+    assert counts == {bucket: 5 for bucket in range(6)}
+
+
+def test_bucket_prefers_distinct_texts():
+    items = _danmaku([i / 10 for i in range(50)], text=lambda i: "666" if i % 5 else f"内容{i}")
+    limited = limit_density(items, 10, bucket_seconds=10)
+    texts = [item[4] for item in limited]
+    # 11 种不同文本中选 10 条，不会选重复的 “666”
+    assert len(texts) == len(set(texts)) == 10
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import math
+
+import pytest
+
+import get_youkudanmuku
+from danmu_duration import METADATA, PROBE, DurationCache, probe_segments, probe_segments_async
+
+
+def test_youku_zero_probe_is_not_cached(tmp_path, monkeypatch):
+    path = tmp_path / "durations.json"
+    cache = DurationCache(str(path))
+    monkeypatch.setattr(get_youkudanmuku, "DURATIONS", cache)
+    getter = get_youkudanmuku.GetDanmuYouku()
+
+    async def no_metadata(video_id):
+        raise RuntimeError("show.json 不可用")
+
+    async def empty_segment(video_id, mat):
+        return []
+
+    monkeypatch.setattr(getter, "get_video_duration", no_metadata)
+    monkeypatch.setattr(getter, "get_segment", empty_segment)
+
+    assert asyncio.run(getter.resolve_duration("XNempty")) == 0
+    assert cache.get("youku", "XNempty") is None
+    assert not path.exists() or "youku|XNempty" not in json.loads(path.read_text(encoding="utf-8"))
+
+
+def test_youku_probe_result_is_cached(tmp_path, monkeypatch):
+    cache = DurationCache(str(tmp_path / "durations.json"))
+    monkeypatch.setattr(get_youkudanmuku, "DURATIONS", cache)
+    getter = get_youkudanmuku.GetDanmuYouku()
+
+    async def no_metadata(video_id):
+        return None
+
+    async def segment(video_id, mat):
+        return [{"mat": mat}] if mat < 5 else []
+
+    monkeypatch.setattr(getter, "get_video_duration", no_metadata)
+    monkeypatch.setattr(getter, "get_segment", segment)
+
+    assert asyncio.run(getter.resolve_duration("XNfive")) == 300
+    assert cache.get("youku", "XNfive") == 300000
+    # 探测时取得的有弹幕分段交给 get_danmus 复用
+    assert 4 in getter.known_segments and set(getter.known_segments) <= set(range(5))
+
+
+@pytest.mark.parametrize("count", [0, 1, 2, 3, 4, 7, 8, 15, 16, 31, 32, 100])
+@pytest.mark.parametrize("first", [0, 1])
+def test_probe_finds_segment_count_at_boundaries(count, first):
+    requested = []
+
+    def fetch(index):
+        requested.append(index)
+        return index - first < count
+
+    found, results = probe_segments(fetch, bool, first)
+    assert found == count
+    # 每个分段只请求一次，结果原样交还调用方
+    assert sorted(results) == sorted(requested) and len(set(requested)) == len(requested)
+    assert all(results[index] == (index - first < count) for index in results)
+    # 指数 + 二分：约 2·log2(分段数) 次请求
+    assert len(requested) <= 2 * math.ceil(math.log2(count + 1)) + 1
+
+
+@pytest.mark.parametrize("count", [0, 1, 7, 8, 100])
+def test_probe_async_matches_sync(count):
+    async def fetch(index):
+        return index < count
+
+    assert asyncio.run(probe_segments_async(fetch, bool)) == probe_segments(lambda index: index < count, bool)
+
+
+def test_probe_duration_expires_but_metadata_does_not(tmp_path):
+    cache = DurationCache(str(tmp_path / "durations.json"), probe_ttl=60)
+    cache.put("mgtv", "probed", 120000, PROBE)
+    cache.put("mgtv", "metadata", 90000, METADATA)
+    entries = json.loads((tmp_path / "durations.json").read_text(encoding="utf-8"))
+    for entry in entries.values():
+        entry["resolved_at"] -= 61
+    (tmp_path / "durations.json").write_text(json.dumps(entries), encoding="utf-8")
+
+    reloaded = DurationCache(str(tmp_path / "durations.json"), probe_ttl=60)
+    assert reloaded.get("mgtv", "probed") is None
+    assert reloaded.get("mgtv", "metadata") == 90000
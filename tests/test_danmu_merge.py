@@ -0,0 +1,48 @@
+import random
+
+from danmu_merge import MIN_ALIGN_COUNT, estimate_offset, merge_danmaku, normalize_text
+
+
+def _stream(seed, count=400, duration=600):
+    rng = random.Random(seed)
+    return sorted(rng.uniform(0, duration) for _ in range(count))
+
+
+def test_offset_recovers_shift_between_sources():
+    reference = _stream(1)
+    shifted = [t + 12 for t in reference]
+    assert estimate_offset(reference, shifted) == 12
+    assert estimate_offset(reference, [t - 7 for t in reference if t >= 7]) == -7
+
+
+def test_too_few_comments_are_not_aligned():
+    reference = _stream(2, count=MIN_ALIGN_COUNT - 1)
+    assert estimate_offset(reference, [t + 12 for t in reference]) == 0
+
+
+def test_merge_shifts_source_and_suppresses_duplicates():
+    reference = [(t, f"ok{chr(0x4e00 + i)}") for i, t in enumerate(_stream(3))]
+    # 另一平台的时间轴晚 12 秒，弹幕内容相同（全角 / 标点不同）
+    shifted = [(t + 12, f"ＯＫ {text[2:]}！") for t, text in reference]
+    merged, offsets = merge_danmaku({"tencent": reference, "bilibili": shifted})
+    assert offsets == {"tencent": 0, "bilibili": 12}
+    # 对齐后每条弹幕只保留一份，时间落回基准时间轴
+    reference_times = {text: t for t, text in reference}
+    assert len(merged) == len(reference)
+    assert all(abs(t - reference_times[normalize_text(text)]) < 1e-6 for t, text, _ in merged)
+    assert [t for t, _, _ in merged] == sorted(t for t, _, _ in merged)
+
+
+def test_dedup_window():
+    items = [(0.0, "哈哈哈哈"), (3.0, "哈哈哈"), (9.0, "哈哈"), (9.5, "好看")]
+    merged, _ = merge_danmaku({"a": items}, window=5, align=False)
+    # 3 秒处的重复被抑制；9 秒距上一条保留的相同文本超过窗口，保留
+    assert [(t, text) for t, text, _ in merged] == [(0.0, "哈哈哈哈"), (9.0, "哈哈"), (9.5, "好看")]
+
+    merged, _ = merge_danmaku({"a": items}, window=0, align=False)
+    assert len(merged) == len(items)
+
+
+def test_normalize_text():
+    assert normalize_text("ＡＢＣ！！ ") == "abc"
+    assert normalize_text("哈哈哈哈哈") == "哈哈"
@@ -0,0 +1,59 @@
+import pytest
+
+import danmu_negative
+from danmu_negative import EMPTY, UNRESOLVED, NegativeCache, capture, report
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(danmu_negative, "time", clock)
+    return clock
+
+
+def test_entry_expires_after_its_reason_ttl(clock):
+    cache = NegativeCache({EMPTY: 600, UNRESOLVED: 3600})
+    cache.put("企鹅", "ep1", EMPTY, "没有弹幕")
+    cache.put("企鹅", "ep2", UNRESOLVED, "无法解析")
+
+    clock.now += 599
+    cached = cache.get("企鹅", "ep1")
+    assert cached.reason == EMPTY
+    assert cached.to_payload() == {"code": 404, "reason": EMPTY, "message": "没有弹幕", "retryAfter": 1}
+
+    clock.now += 1
+    assert cache.get("企鹅", "ep1") is None
+    assert cache.get("企鹅", "ep2").to_payload()["code"] == 422
+
+    clock.now += 3000
+    assert cache.get("企鹅", "ep2") is None
+
+
+def test_zero_ttl_reason_is_not_cached(clock):
+    cache = NegativeCache({EMPTY: 0})
+    error = cache.put("企鹅", "ep1", EMPTY, "没有弹幕")
+    assert error.reason == EMPTY
+    assert cache.get("企鹅", "ep1") is None
+
+
+def test_discard_removes_entry(clock):
+    cache = NegativeCache({EMPTY: 600})
+    cache.put("企鹅", "ep1", EMPTY, "没有弹幕")
+    cache.discard("企鹅", "ep1")
+    assert cache.get("企鹅", "ep1") is None
+
+
+def test_report_is_visible_only_inside_capture():
+    report(EMPTY, "不在 capture 中只打印")
+    with capture() as outcome:
+        assert outcome.reason is None
+        report(UNRESOLVED, "无法解析")
+    assert (outcome.reason, outcome.message) == (UNRESOLVED, "无法解析")
@@ -0,0 +1,57 @@
+import io
+
+import pytest
+
+import danmaku_service
+import danmu_heatmap
+from danmu_records import EpisodeDanmu, danmu_columns, parse_millis, read_danmu_csv, to_millis
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1500", 1500),
+    (1500.7, 1500),
+    ("01:02:03.5", 3723500),
+    ("02:03", 123000),
+])
+def test_to_millis_formats(value, expected):
+    assert to_millis(value) == expected
+
+
+def test_parse_millis_returns_none_when_unparsable():
+    assert parse_millis("") is None
+    assert parse_millis("abc") is None
+    assert parse_millis(float("nan")) is None
+
+
+@pytest.mark.parametrize("columns, expected", [
+    (['time_offset', 'create_time', 'content', 'id'], (0, 2)),
+    (['create_time', 'time_offset', 'content'], (1, 2)),
+    (['timepoint', 'ct', 'content', 'id'], (0, 2)),
+    (['show_time', 'color', 'content', 'id'], (0, 2)),
+    (['time', 'color', 'content'], (0, 2)),
+    (['a', 'b'], (0, 1)),
+])
+def test_danmu_columns(columns, expected):
+    assert danmu_columns(columns) == expected
+
+
+def test_read_danmu_csv_skips_short_and_unparsable_rows():
+    lines = io.StringIO("show_time,color,content\n1000,1,a\x00b\nbad,1,x\n2000\n00:03,1,c\n", newline='')
+    assert list(read_danmu_csv(lines)) == [(1000, "ab"), (3000, "c")]
+
+
+def test_saved_file_parses_like_memory_records(tmp_path):
+    rows = [("2000", "16777215", "第二条"), ("00:01", "16777215", "第一条"), ("x", "0", "坏时间")]
+    episode = EpisodeDanmu(['time', 'color', 'content'], rows, str(tmp_path / "ep.csv"), "time")
+    expected = episode.danmakus()
+    with open(episode.save(), 'rb') as f:
+        assert danmaku_service.parse_downloaded_danmakus(f.read()) == expected
+    assert [d["time"] for d in expected] == [1000, 2000]
+
+
+def test_heatmap_uses_same_columns_and_parser(tmp_path):
+    path = tmp_path / "ep.csv"
+    path.write_text("create_time,time_offset,content\n9,1000,a\n9,00:05,b\n9,bad,c\n", encoding="utf-8")
+    _, times = danmu_heatmap.load_times(str(path))
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        assert times.tolist() == [time_ms for time_ms, _ in read_danmu_csv(f)] == [1000, 5000]
@@ -0,0 +1,15 @@
+from danmu_refresh import _DedupIndex
+
+
+def test_rows_with_ids_are_deduplicated_by_id_only():
+    dedup = _DedupIndex([{"time_offset": "1000", "content": "666", "id": "a"}], "time_offset")
+
+    assert dedup.is_new({"time_offset": "1000", "content": "666", "id": "b"})
+    assert not dedup.is_new({"time_offset": "1000", "content": "666", "id": "a"})
+
+
+def test_rows_without_ids_fall_back_to_time_and_content():
+    dedup = _DedupIndex([{"time_offset": "1000", "content": "666"}], "time_offset")
+
+    assert not dedup.is_new({"time_offset": "1000", "content": "666"})
+    assert dedup.is_new({"time_offset": "2000", "content": "666"})
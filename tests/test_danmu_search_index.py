@@ -0,0 +1,40 @@
+import csv
+import os
+
+import danmu_search_index
+
+
+def _write_csv(path, rows):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time_offset', 'create_time', 'content'])
+        writer.writerows(rows)
+
+
+def test_readers_are_bounded_and_released_on_rebuild(tmp_path, monkeypatch):
+    monkeypatch.setattr(danmu_search_index, "SEARCH_INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(danmu_search_index, "MAX_READERS", 2)
+    monkeypatch.setattr(danmu_search_index, "_readers", danmu_search_index.OrderedDict())
+
+    readers = []
+    for i in range(3):
+        path = tmp_path / f"ep{i}.csv"
+        _write_csv(path, [(1000, 0, "前方高能"), (2000, 0, f"第{i}集")])
+        danmu_search_index.build_index("企鹅", f"ep{i}", str(path))
+        matches, truncated = danmu_search_index.search("企鹅", f"ep{i}", "高能")
+        assert matches == [{"time": 1000, "text": "前方高能"}] and not truncated
+        readers.append(danmu_search_index._readers[danmu_search_index.index_path("企鹅", f"ep{i}")])
+
+    # 超出上限时最久未用的连接被关闭
+    assert len(danmu_search_index._readers) == 2
+    assert readers[0].closed and not readers[2].closed
+    # 淘汰后仍可检索（重新打开）
+    assert danmu_search_index.search("企鹅", "ep0", "第0集")[0] == [{"time": 2000, "text": "第0集"}]
+
+    # 弹幕文件更新后重建索引，旧连接随之释放
+    path = tmp_path / "ep2.csv"
+    _write_csv(path, [(500, 0, "新的高能")])
+    os.utime(path, ns=(1, 1))
+    danmu_search_index.build_index("企鹅", "ep2", str(path))
+    assert readers[2].closed
+    assert danmu_search_index.search("企鹅", "ep2", "高能")[0] == [{"time": 500, "text": "新的高能"}]
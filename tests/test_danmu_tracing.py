@@ -0,0 +1,30 @@
+import json
+
+import danmu_tracing
+
+
+def test_force_header_requires_operator_opt_in(monkeypatch):
+    monkeypatch.setattr(danmu_tracing, "SAMPLE_RATE", 0.0)
+    monkeypatch.setattr(danmu_tracing, "ALLOW_HEADER", False)
+    assert not danmu_tracing.should_sample("1")
+    assert not danmu_tracing.should_sample("0")
+
+    monkeypatch.setattr(danmu_tracing, "ALLOW_HEADER", True)
+    assert danmu_tracing.should_sample("1")
+    assert not danmu_tracing.should_sample(None)
+
+
+def test_trace_file_rotates_by_size(tmp_path, monkeypatch):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(danmu_tracing, "TRACE_FILE", str(path))
+    monkeypatch.setattr(danmu_tracing, "TRACE_FILE_MAX_BYTES", 2000)
+
+    for i in range(20):
+        root = danmu_tracing.start_trace("GET /api/danmaku/download", True, request=i)
+        root.end_ns = root.start_ns + 1
+        danmu_tracing._export_file([root])
+
+    assert path.stat().st_size <= 2000
+    assert (tmp_path / "traces.jsonl.1").stat().st_size <= 2000
+    last = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()][-1]
+    assert last["spans"][0]["attributes"]["request"] == 19
@@ -0,0 +1,30 @@
+import asyncio
+
+import danmaku_service
+from download_jobs import PRIORITY_NORMAL, PRIORITY_PREFETCH, STATUS_QUEUED, STATUS_RUNNING, JobManager
+
+
+def test_foreground_job_starts_while_prefetch_fills_source(monkeypatch):
+    release = None
+
+    async def fake_get_danmaku_file(source, danmaku_id, keyword, progress=None, refresh=False):
+        await release.wait()
+        return None
+
+    monkeypatch.setattr(danmaku_service, "get_danmaku_file", fake_get_danmaku_file)
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        manager = JobManager(max_workers=8, per_source=2, prefetch_workers=4, prefetch_rate=600, prefetch_per_source=2)
+        prefetches = [await manager.submit("企鹅", f"ep{i}", priority=PRIORITY_PREFETCH) for i in range(4)]
+        assert [job.status for job in prefetches] == [STATUS_RUNNING] * 2 + [STATUS_QUEUED] * 2
+
+        foreground = [await manager.submit("企鹅", f"fg{i}", priority=PRIORITY_NORMAL) for i in range(3)]
+        statuses = [job.status for job in foreground]
+        release.set()
+        await asyncio.gather(*manager._tasks)
+        return statuses
+
+    # 预取占满该源的预取上限时，前台任务仍有完整的每源槽位
+    assert asyncio.run(scenario()) == [STATUS_RUNNING, STATUS_RUNNING, STATUS_QUEUED]
@@ -0,0 +1,41 @@
+import pytest
+
+import app as app_module
+import danmaku_service
+import download_jobs
+
+
+@pytest.fixture
+def prefetched(monkeypatch):
+    calls = []
+    monkeypatch.setattr(download_jobs, "prefetch_episodes", lambda source, ids, *args: calls.append(ids) or [])
+    return calls
+
+
+@pytest.mark.parametrize("body", [
+    {},
+    {"episodes": "ep1"},
+    {"episodes": [{"title": "第1集"}]},
+    {"episodes": ["ep1", None]},
+])
+def test_prefetch_rejects_episodes_without_id(prefetched, body):
+    response = app_module.app.test_client().post("/api/danmaku/prefetch", json=body)
+    assert response.get_json()["code"] == 400
+    assert prefetched == []
+
+
+def test_prefetch_accepts_ids_and_episode_dicts(prefetched):
+    body = {"episodes": [{"id": "ep1", "title": "第1集"}, "ep2", 3]}
+    response = app_module.app.test_client().post("/api/danmaku/prefetch", json=body)
+    assert response.get_json()["code"] == 202
+    assert prefetched == [["ep1", "ep2", "3"]]
+
+
+def test_episode_list_prefetch_skips_entries_without_id(prefetched, monkeypatch):
+    async def episodes(source, video_id, keyword):
+        return {"code": 200, "episodes": [{"id": "ep1", "title": "第1集"}, {"title": "预告"}]}
+
+    monkeypatch.setattr(danmaku_service, "episodes", episodes)
+    response = app_module.app.test_client().get("/api/danmaku/episodes?videoId=v&prefetch=1")
+    assert response.get_json()["code"] == 200
+    assert prefetched == [["ep1"]]
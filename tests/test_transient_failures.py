@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+import pytest
+import requests
+
+import danmaku_service
+import get_mgtv_danmu
+from circuit_breaker import CircuitOpenError
+
+
+class _FailingDurations:
+    def __init__(self, error):
+        self.error = error
+
+    def resolve(self, platform, video_id, metadata=None, probe=None):
+        raise self.error
+
+
+def _overloaded():
+    response = requests.Response()
+    response.status_code = 503
+    return requests.HTTPError("503 Server Error", response=response)
+
+
+@pytest.mark.parametrize("error", [CircuitOpenError("mgtv 上游熔断中"), _overloaded()])
+def test_mgtv_transient_failure_propagates(tmp_path, monkeypatch, error):
+    monkeypatch.setattr(get_mgtv_danmu, "DURATIONS", _FailingDurations(error))
+    scraper = get_mgtv_danmu.MgtvVideoScraper(str(tmp_path))
+    with pytest.raises(type(error)):
+        scraper.fetch_episode("https://www.mgtv.com/b/1/2.html", "测试")
+
+
+def test_mgtv_other_failure_returns_none(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_mgtv_danmu, "DURATIONS", _FailingDurations(ValueError("bad json")))
+    scraper = get_mgtv_danmu.MgtvVideoScraper(str(tmp_path))
+    assert scraper.fetch_episode("https://www.mgtv.com/b/1/2.html", "测试") is None
+
+
+@pytest.mark.parametrize("error, code", [
+    (CircuitOpenError("mgtv 上游熔断中"), 503),
+    (_overloaded(), 503),
+    (ValueError("bad json"), 500),
+])
+def test_download_maps_transient_failure_to_503(monkeypatch, error, code):
+    async def failing_fetch(source, danmaku_id, keyword, progress=None):
+        raise error
+
+    monkeypatch.setattr(danmaku_service, "fetch_danmaku_episode", failing_fetch)
+    _, _, body = asyncio.run(danmaku_service.download("芒果", "https://www.mgtv.com/b/1/transient.html", "", {}))
+    assert json.loads(body)["code"] == code